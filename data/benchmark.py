@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+"""
+Benchmark the conversion of synthetic data to data buffers.
+
+Each benchmark runs in its own process, on inputs generated with a given
+number of rows, classes and bins, and reports for each stage the wall time,
+the rows per second, the bytes written and the peak RSS of the process at the
+end of the stage. The peak RSS is the high-water mark of the process so far,
+not the peak of the stage alone, since the stages run one after the other.
+"""
+
+import os
+import os.path
+import json
+import time
+import platform
+import subprocess
+import tempfile
+import multiprocessing
+from contextlib import redirect_stdout
+import numpy as np
+import pandas as pd
+from profiler import peak_rss
+
+BENCHMARKS = ["csv", "parquet", "mnist", "mn", "json2lz4", "json2png"]
+
+
+def synthetic_points(rows, classes, seed=0):
+    "Draw rows points around one center per class, returning x, y and class codes"
+    rng = np.random.RandomState(seed)
+    codes = rng.randint(classes, size=rows)
+    angles = 2 * np.pi * codes / classes
+    x = rng.normal(size=rows) + 3 * np.cos(angles)
+    y = rng.normal(size=rows) + 3 * np.sin(angles)
+    return x, y, codes
+
+
+def synthetic_frame(rows, classes, seed=0):
+    x, y, codes = synthetic_points(rows, classes, seed)
+    names = np.array(["c%d"%i for i in range(classes)])
+    return pd.DataFrame({"x": x, "y": y, "category": names[codes]})
+
+
+def synthetic_histograms(params, seed=0):
+    "Bin synthetic points, returning the histograms and counts of each class"
+    from binning import histogram_cube, class_counts
+    x, y, codes = synthetic_points(params["rows"], params["classes"], seed)
+    bins = (params["width"], params["height"])
+    cube = histogram_cube(x, y, codes, params["classes"], bins, [[-5, 5], [-5, 5]])
+    totals = class_counts(codes, params["classes"])
+    histograms = {"c%d"%i: cube[i] for i in range(params["classes"])}
+    counts = {"c%d"%i: int(totals[i]) for i in range(params["classes"])}
+    return histograms, counts
+
+
+def directory_size(directory):
+    return sum(os.path.getsize(os.path.join(path, name))
+               for (path, _, names) in os.walk(directory) for name in names)
+
+
+def measure(results, benchmark, stage, function, rows, directory):
+    """
+    Run function as a stage of a benchmark, appending its measures to results,
+    with the peak RSS of the process so far in peak_rss
+    """
+    written = directory_size(directory)
+    start = time.perf_counter()
+    value = function()
+    seconds = time.perf_counter() - start
+    results.append({"benchmark": benchmark,
+                    "stage": stage,
+                    "seconds": seconds,
+                    "rows": rows,
+                    "rows_per_sec": rows / seconds if seconds > 0 else None,
+                    "peak_rss": peak_rss(),
+                    "bytes_written": directory_size(directory) - written})
+    return value
+
+
+def bench_csv(directory, params, results):
+    from binning import histogram_cube, class_counts
+    from databuffer import write_databuffers
+    from csv2json import csv_to_databuffers
+    rows, width, height = params["rows"], params["width"], params["height"]
+    filename = os.path.join(directory, "bench.csv")
+    synthetic_frame(rows, params["classes"]).to_csv(filename, index=False)
+    xy_range = [[-5, 5], [-5, 5]]
+
+    def bin_frame(df):
+        cat_column = df["category"].astype("category")
+        codes = cat_column.cat.codes.values
+        ncat = len(cat_column.cat.categories)
+        cube = histogram_cube(df["x"].values, df["y"].values, codes, ncat,
+                              (width, height), xy_range)
+        totals = class_counts(codes, ncat)
+        return ({cat: cube[i] for i, cat in enumerate(cat_column.cat.categories)},
+                {cat: int(totals[i]) for i, cat in enumerate(cat_column.cat.categories)})
+
+    df = measure(results, "csv", "read",
+                 lambda: pd.read_csv(filename, usecols=["x", "y", "category"]),
+                 rows, directory)
+    histograms, counts = measure(results, "csv", "bin", lambda: bin_frame(df),
+                                 rows, directory)
+    measure(results, "csv", "serialize",
+            lambda: write_databuffers(os.path.join(directory, "stage"),
+                                      {"source": {}}, histograms, counts),
+            rows, directory)
+    measure(results, "csv", "total",
+            lambda: csv_to_databuffers(filename, "x", "y", "category",
+                                       width=width, height=height),
+            rows, directory)
+
+
+def bench_parquet(directory, params, results):
+    import fastparquet
+    from databuffer import write_databuffers
+    from expressions import Expression
+    from parq2json import bin_parquet, parquet_to_databuffers
+    rows, width, height = params["rows"], params["width"], params["height"]
+    filename = os.path.join(directory, "bench.parq")
+    df = synthetic_frame(rows, params["classes"])
+    df["category"] = df["category"].astype("category")
+    fastparquet.write(filename, df, row_group_offsets=1000000)
+    del df
+    pf = fastparquet.ParquetFile(filename)
+    measure(results, "parquet", "read",
+            lambda: [len(df) for df in pf.iter_row_groups(columns=["x", "y", "category"],
+                                                          categories=["category"])],
+            rows, directory)
+    # the bounds are given, so the row groups are read and binned once
+    expressions = [Expression(text, pf.columns) for text in ("x", "y", "category")]
+    histograms, counts = measure(results, "parquet", "bin",
+                                 lambda: bin_parquet(pf, filename, *expressions,
+                                                     [-5, -5, 5, 5], width, height,
+                                                     jobs=params["jobs"])[:2],
+                                 rows, directory)
+    measure(results, "parquet", "serialize",
+            lambda: write_databuffers(os.path.join(directory, "stage"),
+                                      {"source": {}}, histograms, counts),
+            rows, directory)
+    measure(results, "parquet", "total",
+            lambda: parquet_to_databuffers(filename, "x", "y", "category",
+                                           width=width, height=height,
+                                           jobs=params["jobs"]),
+            rows, directory)
+
+
+def bench_mnist(directory, params, results):
+    from binning import histogram_cube, class_counts
+    from databuffer import write_databuffers
+    from mnist2json import mnist_to_databuffers, read_embedding, read_labels
+    rows, width, height = params["rows"], params["width"], params["height"]
+    x, y, codes = synthetic_points(rows, params["classes"])
+    filename = os.path.join(directory, "bench.txt")
+    labels = os.path.join(directory, "bench_labels.txt")
+    np.savetxt(filename, np.column_stack([x, y]), fmt="%f")
+    np.savetxt(labels, codes, fmt="%d")
+
+    def bin_embedding(embedding, labels):
+        values, codes = np.unique(labels, return_inverse=True)
+        cube = histogram_cube(embedding[:, 0], embedding[:, 1], codes, len(values),
+                              (width, height), [[-5, 5], [-5, 5]])
+        totals = class_counts(codes, len(values))
+        return ({value.item(): cube[i] for i, value in enumerate(values)},
+                {value.item(): int(totals[i]) for i, value in enumerate(values)})
+
+    embedding, values = measure(results, "mnist", "read",
+                                lambda: (read_embedding(filename), read_labels(labels)),
+                                rows, directory)
+    histograms, counts = measure(results, "mnist", "bin",
+                                 lambda: bin_embedding(embedding, values),
+                                 rows, directory)
+    measure(results, "mnist", "serialize",
+            lambda: write_databuffers(os.path.join(directory, "stage"),
+                                      {"source": {}}, histograms, counts),
+            rows, directory)
+    measure(results, "mnist", "total",
+            lambda: mnist_to_databuffers(filename, labels, width=width, height=height),
+            rows, directory)
+
+
+def bench_mn(directory, params, results):
+    "The samples are drawn, not read, so the bin stage draws and bins them"
+    from databuffer import write_databuffers
+    from mn2json import mn2json, sample_block
+    classes = params["classes"]
+    size = params["rows"] // classes
+    bins = (params["width"], params["height"])
+    bounds = [[-5, 5], [-5, 5]]
+    angles = 2 * np.pi * np.arange(classes) / classes
+    means = np.column_stack([3 * np.cos(angles), 3 * np.sin(angles)]).tolist()
+    entropy = np.random.SeedSequence(0).entropy
+
+    def draw_and_bin():
+        blocks = [sample_block((i, 0, mean, [[1, 0], [0, 1]], size, entropy, bins, bounds, 0))
+                  for (i, mean) in enumerate(means)]
+        return ({str(i + 1): histo for (i, _, histo, _) in blocks},
+                {str(i + 1): int(histo.sum()) for (i, _, histo, _) in blocks})
+
+    histograms, counts = measure(results, "mn", "bin", draw_and_bin,
+                                 params["rows"], directory)
+    measure(results, "mn", "serialize",
+            lambda: write_databuffers(os.path.join(directory, "stage"),
+                                      {"source": {}}, histograms, counts),
+            params["rows"], directory)
+    measure(results, "mn", "total",
+            lambda: mn2json(os.path.join(directory, "mn"), size,
+                            params["width"], params["height"], means,
+                            [[1, 0], [0, 1]], bounds,
+                            seed=0, jobs=params["jobs"]),
+            params["rows"], directory)
+
+
+def bench_json2lz4(directory, params, results):
+    from databuffer import write_databuffers
+    from json2lz4 import json2lz4
+    histograms, counts = synthetic_histograms(params)
+    root = os.path.join(directory, "bench")
+    write_databuffers(root, {"source": {}}, histograms, counts)
+    names = [root + "_cat_%s.json"%key for key in histograms]
+    measure(results, "json2lz4", "total", lambda: [json2lz4(name) for name in names],
+            len(names) * params["width"] * params["height"], directory)
+
+
+def bench_json2png(directory, params, results):
+    from databuffer import write_databuffers
+    from json2png import json2png
+    histograms, counts = synthetic_histograms(params)
+    root = os.path.join(directory, "bench")
+    write_databuffers(root, {"source": {}}, histograms, counts)
+    names = [root + "_cat_%s.json"%key for key in histograms]
+    measure(results, "json2png", "total", lambda: [json2png(name) for name in names],
+            len(names) * params["width"] * params["height"], directory)
+
+
+def run_benchmark(name, params, connection):
+    "Run one benchmark in a temporary directory, sending its measures to connection"
+    results = []
+    with tempfile.TemporaryDirectory(prefix="bench_" + name) as directory, \
+         open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        try:
+            globals()["bench_" + name](directory, params, results)
+        except Exception as e:  # report missing dependencies and go on
+            results.append({"benchmark": name, "error": "%s: %s"%(type(e).__name__, e)})
+    connection.send(results)
+    connection.close()
+
+
+def run_process(context, name, params):
+    """
+    Run one benchmark in a new process of context, returning its measures.
+    The process is not a daemon, as a pool worker would be, so that the
+    converters can start their own pool with --jobs.
+    """
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=run_benchmark, args=(name, params, sender))
+    process.start()
+    sender.close()
+    try:
+        results = receiver.recv()
+    except EOFError:  # the process died without sending its measures
+        results = None
+    process.join()
+    if results is None:
+        results = [{"benchmark": name, "error": "exit code %s"%process.exitcode}]
+    return results
+
+
+def git_version():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(benchmarks=BENCHMARKS, rows=1000000, classes=5, width=512, height=512,
+              jobs=1):
+    """
+    Run the benchmarks, each in a new process so that its peak RSS is its own,
+    and return a report with their measures
+    """
+    params = {"rows": rows, "classes": classes, "width": width, "height": height,
+              "jobs": jobs}
+    # spawn, since a forked process starts with the peak RSS of its parent
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for name in benchmarks:
+        results += run_process(context, name, params)
+    return {"version": git_version(),
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "params": params,
+            "results": results}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the data buffer converters")
+    parser.add_argument("benchmarks", nargs="*", default=BENCHMARKS,
+                        help="benchmarks to run among %s"%", ".join(BENCHMARKS))
+    parser.add_argument("--rows", type=int, default=1000000, nargs="?",
+                        help="number of rows of the synthetic inputs")
+    parser.add_argument("--classes", type=int, default=5, nargs="?",
+                        help="number of classes of the synthetic inputs")
+    parser.add_argument("--width", type=int, default=512, nargs="?",
+                        help="width of the binned image")
+    parser.add_argument("--height", type=int, default=512, nargs="?",
+                        help="height of the binned image")
+    parser.add_argument("--jobs", type=int, default=1, nargs="?",
+                        help="number of processes of the converters that have --jobs")
+    parser.add_argument("--output", default="benchmark.json", nargs="?",
+                        help="json file where the results are saved")
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark %s"%name)
+    report = benchmark(args.benchmarks, rows=args.rows, classes=args.classes,
+                       width=args.width, height=args.height, jobs=args.jobs)
+    for result in report["results"]:
+        if "error" in result:
+            print("%-9s %s"%(result["benchmark"], result["error"]))
+        else:
+            print("%-9s %-10s %8.3fs %12.0f rows/s %8.1f MB peak RSS so far %10d bytes"%(
+                result["benchmark"], result["stage"], result["seconds"],
+                result["rows_per_sec"] or 0, result["peak_rss"] / 2**20,
+                result["bytes_written"]))
+    with open(args.output, "w") as outf:
+        json.dump(report, outf, indent=2)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"Shared binning core for the data buffer converters"
+
+import numpy as np
+
+
+def bin_indices(values, nbins, vmin, vmax):
+    """
+    Return the bin index of each value in nbins equal bins over [vmin, vmax],
+    or -1 for values outside the range (and NaNs).
+    Bins follow np.histogram2d: half-open, except the last that includes vmax.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    edges = np.linspace(vmin, vmax, nbins + 1)
+    index = (values - vmin) * (nbins / (vmax - vmin))
+    np.nan_to_num(index, copy=False)
+    np.floor(index, out=index)
+    np.clip(index, 0, nbins - 1, out=index)
+    index = index.astype(np.intp)
+    # fix the floating point rounding errors against the real edges
+    index -= (values < edges[index]) & (index > 0)
+    index += (values >= edges[index + 1]) & (index < nbins - 1)
+    index[~((values >= vmin) & (values <= vmax))] = -1
+    return index
+
+
+def edge_indices(values, edges):
+    """
+    Return the bin index of each value between increasing edges, or -1 for
+    values outside [edges[0], edges[-1]] (and NaNs).
+    Bins follow np.histogram: half-open, except the last that includes the
+    last edge.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    index = np.searchsorted(edges, values, side="right") - 1
+    index[values == edges[-1]] = len(edges) - 2
+    index[~((values >= edges[0]) & (values <= edges[-1]))] = -1
+    return index
+
+
+def histogram_cube(x, y, codes, n_classes, bins, xy_range, out=None):
+    """
+    Count the (x, y, class) triples in a single pass into a cube of shape
+    (n_classes, height, width), where bins is (width, height) and xy_range is
+    [[xmin, xmax], [ymin, ymax]] as for np.histogram2d.
+    codes holds the class index of each point; negative codes are ignored
+    and None means that all the points belong to a single class.
+    The counts are added to out when it is given.
+    """
+    width, height = bins
+    (xmin, xmax), (ymin, ymax) = xy_range
+    xi = bin_indices(x, width, xmin, xmax)
+    yi = bin_indices(y, height, ymin, ymax)
+    keep = (xi >= 0) & (yi >= 0)
+    flat = yi
+    flat *= width
+    flat += xi
+    if codes is not None:
+        codes = np.asarray(codes)
+        keep &= (codes >= 0) & (codes < n_classes)
+        flat += codes.astype(np.intp) * (width * height)
+    size = n_classes * width * height
+    counts = np.bincount(flat[keep], minlength=size).reshape(n_classes, height, width)
+    if out is None:
+        return counts
+    out += counts
+    return out
+
+
+def class_counts(codes, n_classes):
+    "Count the points of each class, including the ones outside the bins"
+    codes = np.asarray(codes)
+    return np.bincount(codes[(codes >= 0) & (codes < n_classes)],
+                       minlength=n_classes)
+
+
+def merge_histograms(histograms, counts, other_histograms, other_counts):
+    """
+    Add the per-class histograms and counts of other_histograms/other_counts
+    into histograms/counts, appending the new classes after the known ones.
+    Return the merged (histograms, counts).
+    """
+    for (key, histo) in other_histograms.items():
+        if key in histograms:
+            histograms[key] += histo
+        else:
+            histograms[key] = histo
+        counts[key] = other_counts[key] + counts.get(key, 0)
+    return histograms, counts
+
+
+def downsample(cube):
+    """
+    Sum the 2x2 blocks of bins of a (n_classes, height, width) cube, padding
+    it with an empty row and column when its size is odd.
+    """
+    n, height, width = cube.shape
+    if height % 2 or width % 2:
+        padded = np.zeros((n, height + height % 2, width + width % 2), dtype=cube.dtype)
+        padded[:, :height, :width] = cube
+        cube = padded
+    return block_sum(cube, 2, 2)
+
+
+def block_sum(cube, ky, kx):
+    """
+    Sum the ky x kx blocks of bins of a (n_classes, height, width) cube whose
+    height and width are multiples of ky and kx.
+    """
+    n, height, width = cube.shape
+    return cube.reshape(n, height // ky, ky, width // kx, kx).sum(axis=(2, 4))
+
+
+def grid(bounds, width, height=None):
+    """
+    Return the range [[xmin, xmax], [ymin, ymax]] and bins (width, height)
+    of a binning over bounds [xmin, ymin, xmax, ymax]. When height is None,
+    it keeps the aspect ratio of the bounds.
+    """
+    xmin, ymin, xmax, ymax = bounds
+    xy_range = [[float(xmin), float(xmax)], [float(ymin), float(ymax)]]
+    if ymax == ymin or xmax == xmin:
+        raise ValueError("Invalid bounds: {}".format(xy_range))
+    if height is None:
+        ratio = (ymax - ymin) / (xmax - xmin)
+        height = int(width * ratio)
+    return xy_range, (width, height)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+"""
+Turn numeric values into classes with fixed edges, e.g., flight delays into
+delay buckets.
+
+The edges are explicit, uniform between two values, or at the quantiles of
+the values, and are fixed before binning, so that the values of all the
+chunks or row groups of a file, read one after the other or in several
+processes, get the same classes. The edges that are not given are computed
+in a first pass that reads only the columns of the category.
+"""
+
+import numpy as np
+from binning import edge_indices
+from stats import QuantileSketch
+
+
+def _label(vmin, vmax, last):
+    return "[%g, %g%s"%(vmin, vmax, "]" if last else ")")
+
+
+class Buckets(object):
+    """
+    Classes of the values between increasing edges: the class i holds the
+    values in [edges[i], edges[i+1]), the last one also holds the last edge,
+    and the other values have no class
+    """
+    def __init__(self, edges):
+        edges = np.asarray(edges, dtype=np.float64)
+        if len(edges) < 2 or np.any(np.diff(edges) <= 0):
+            raise ValueError("Expected at least two increasing edges, got {}".format(edges.tolist()))
+        self.edges = edges
+        self.labels = [_label(edges[i], edges[i+1], i == len(edges) - 2)
+                       for i in range(len(edges) - 1)]
+
+    @classmethod
+    def uniform(cls, vmin, vmax, count):
+        "Return count buckets of the same width between vmin and vmax"
+        return cls(np.linspace(vmin, vmax, count + 1))
+
+    @classmethod
+    def quantiles(cls, sketch, count):
+        """
+        Return at most count buckets with about as many values each, from the
+        quantiles of a sketch; equal quantiles are merged into one edge
+        """
+        edges = np.unique(sketch.quantiles(np.linspace(0, 1, count + 1)))
+        if len(edges) < count + 1:
+            print("Only %d distinct quantile buckets instead of %d"%(len(edges) - 1, count))
+        return cls(edges)
+
+    def codes(self, values):
+        "Return the class of each value, or -1"
+        return edge_indices(values, self.edges)
+
+    def to_json(self):
+        return {"edges": self.edges.tolist()}
+
+
+def category_buckets(category, count=None, vmin=None, vmax=None, edges=None,
+                     quantiles=False, chunks=()):
+    """
+    Return the buckets of the values of a category expression: the explicit
+    edges, count uniform buckets between vmin and vmax, or count buckets at
+    quantiles, or None without edges nor count.
+    The missing vmin and vmax, and the quantiles, are computed over chunks,
+    an iterable of data frames with the columns of the category, that is
+    only read when needed.
+    """
+    if edges:
+        return Buckets(edges)
+    if not count:
+        return None
+    if not quantiles and vmin is not None and vmax is not None:
+        return Buckets.uniform(vmin, vmax, count)
+    print("Computing the buckets of %s"%category)
+    sketch = QuantileSketch()
+    for df in chunks:
+        values = category.evaluate(df)
+        if vmin is not None or vmax is not None:
+            values = values[(values >= (-np.inf if vmin is None else vmin)) &
+                            (values <= (np.inf if vmax is None else vmax))]
+        sketch.update(values)
+    if sketch.count == 0:
+        raise ValueError("No values to compute the buckets of {}".format(category))
+    if quantiles:
+        return Buckets.quantiles(sketch, count)
+    return Buckets.uniform(sketch.min if vmin is None else vmin,
+                           sketch.max if vmax is None else vmax, count)
+
+
+def parse_edges(text):
+    "Return the edges of a comma separated list"
+    return [float(edge) for edge in text.split(",")]
+
+
+def add_bucket_arguments(parser):
+    "Add the options of the buckets of a numeric category to an argument parser"
+    parser.add_argument("--catvalnum", type=int, default=None, nargs="?",
+                        help="turn the numeric category into this number of classes")
+    parser.add_argument("--catvalmin", type=float, default=None, nargs="?",
+                        help="min of the values turned into classes (the min of the values by default)")
+    parser.add_argument("--catvalmax", type=float, default=None, nargs="?",
+                        help="max of the values turned into classes (the max of the values by default)")
+    parser.add_argument("--catvalquantiles", action="store_true",
+                        help="classes with about as many values each instead of the same width")
+    parser.add_argument("--catvaledges", type=parse_edges, default=None, nargs="?",
+                        help="comma separated edges of the classes of the numeric category")
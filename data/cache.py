@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+"""
+Cache the count cubes of the conversions on disk.
+
+An entry holds the per-class histograms and counts of an input file binned
+with some bins and range. It is keyed by a fingerprint of the input (its
+path, size and modification time, or the hash of its content) and of the
+columns read, and by the bins and range.
+A later conversion of the same input is served from an entry when its bins
+are made of whole bins of the entry: the same bins, bins that merge an
+integer number of bins of the entry (e.g., a width that divides its width),
+or a sub-rectangle aligned on its bins. The points lying exactly on the edges
+of a sub-rectangle may be counted in the neighbour bins.
+The entries are evicted in least recently used order to keep the cache
+under a maximum size.
+"""
+
+import os
+import os.path
+import json
+import hashlib
+import numpy as np
+from binning import block_sum
+from databuffer import buffer_dtype
+
+CACHE_DIRECTORY = os.path.join(os.path.expanduser("~"), ".cache", "multiclass-density-maps")
+CACHE_SIZE = 1 << 30
+
+
+def file_hash(filename, chunk_size=1 << 20):
+    "Return the sha1 of the content of a file"
+    sha1 = hashlib.sha1()
+    with open(filename, "rb") as inf:
+        for chunk in iter(lambda: inf.read(chunk_size), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def _digest(data):
+    return hashlib.sha1(json.dumps(data, sort_keys=True).encode("utf8")).hexdigest()
+
+
+def _window(cached, wanted, nbins):
+    """
+    Return the first bin and the number of bins per bin of a binning of
+    [vmin, vmax] in nbins bins inside the cached one ((vmin, vmax), nbins),
+    or None if its edges are not edges of the cached bins
+    """
+    (cmin, cmax), cbins = cached
+    (vmin, vmax) = wanted
+    step = (cmax - cmin) / cbins
+    factor = (vmax - vmin) / nbins / step
+    start = (vmin - cmin) / step
+    if round(factor) < 1 or not np.isclose(factor, round(factor), rtol=0, atol=1e-6) \
+       or not np.isclose(start, round(start), rtol=0, atol=1e-6):
+        return None
+    factor = int(round(factor))
+    start = int(round(start))
+    if start < 0 or start + factor * nbins > cbins:
+        return None
+    return start, factor
+
+
+class ConversionCache(object):
+    """
+    A directory of count cubes, with at most max_size bytes.
+    With hash_input, the inputs are identified by the hash of their content
+    instead of their path and modification time.
+    """
+    def __init__(self, directory=CACHE_DIRECTORY, max_size=CACHE_SIZE, hash_input=False):
+        self.directory = directory
+        self.max_size = max_size
+        self.hash_input = hash_input
+        os.makedirs(directory, exist_ok=True)
+
+    def source(self, filename, **columns):
+        "Return the fingerprint of an input file read with some columns and options"
+        stat = os.stat(filename)
+        if self.hash_input:
+            source = {"size": stat.st_size, "sha1": file_hash(filename)}
+        else:
+            source = {"path": os.path.abspath(filename), "size": stat.st_size,
+                      "mtime": stat.st_mtime_ns}
+        source.update(columns)
+        return _digest(source)
+
+    def _entries(self, source):
+        "Return the metadata of the entries of a source"
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as inf:
+                    meta = json.load(inf)
+            except (OSError, ValueError):
+                continue
+            if meta.get("source") == source:
+                meta["key"] = name[:-len(".json")]
+                entries.append(meta)
+        return entries
+
+    def lookup(self, source, bins, xy_range):
+        """
+        Return the histograms and counts of a source binned with bins
+        (width, height) over xy_range, re-aggregated from a cached entry, or
+        None when no entry has compatible bins
+        """
+        best = None
+        for meta in self._entries(source):
+            windows = [_window((meta["range"][axis], meta["bins"][axis]),
+                               xy_range[axis], bins[axis]) for axis in (0, 1)]
+            if None in windows:
+                continue
+            size = meta["bins"][0] * meta["bins"][1]
+            if best is None or size < best[0]:
+                best = (size, meta, windows)
+        if best is None:
+            return None
+        (_, meta, ((xstart, xfactor), (ystart, yfactor))) = best
+        path = os.path.join(self.directory, meta["key"])
+        try:
+            cube = np.load(path + ".npy", mmap_mode="r")
+        except (OSError, ValueError):
+            return None
+        width, height = bins
+        cube = cube[:, ystart:ystart + yfactor * height, xstart:xstart + xfactor * width]
+        cube = block_sum(np.asarray(cube, dtype=np.int64), yfactor, xfactor)
+        for name in (path + ".npy", path + ".json"):
+            os.utime(name)
+        print("Using cached bins %s of %s"%(meta["bins"], meta["key"]))
+        histograms = {value: cube[i] for (i, value) in enumerate(meta["values"])}
+        counts = dict(zip(meta["values"], meta["counts"]))
+        return histograms, counts
+
+    def store(self, source, bins, xy_range, histograms, counts):
+        """
+        Store the histograms and counts of a source binned with bins over
+        xy_range, then evict the least recently used entries over the
+        maximum size
+        """
+        values = [value.item() if isinstance(value, np.generic) else value
+                  for value in histograms]
+        key = _digest({"source": source, "bins": list(bins), "range": xy_range})
+        path = os.path.join(self.directory, key)
+        cube = np.stack([histograms[value] for value in histograms]) if histograms \
+            else np.zeros((0, bins[1], bins[0]), dtype=np.int64)
+        np.save(path + ".npy", cube.astype(buffer_dtype(cube)))
+        meta = {"source": source,
+                "bins": list(bins),
+                "range": xy_range,
+                "values": values,
+                "counts": [int(counts[value]) for value in histograms]}
+        with open(path + ".json", "w") as outf:
+            json.dump(meta, outf)
+        self.evict()
+
+    def evict(self):
+        "Remove the least recently used entries until the cache fits in its maximum size"
+        entries = {}
+        for name in os.listdir(self.directory):
+            key, ext = os.path.splitext(name)
+            if ext not in (".npy", ".json"):
+                continue
+            stat = os.stat(os.path.join(self.directory, name))
+            (used, size) = entries.get(key, (0, 0))
+            entries[key] = (max(used, stat.st_mtime), size + stat.st_size)
+        total = sum(size for (_, size) in entries.values())
+        for key in sorted(entries, key=lambda key: entries[key][0]):
+            if total <= self.max_size:
+                break
+            for ext in (".npy", ".json"):
+                name = os.path.join(self.directory, key + ext)
+                if os.path.exists(name):
+                    os.remove(name)
+            total -= entries[key][1]
+
+
+def add_cache_arguments(parser):
+    "Add the options of the cache to an argument parser"
+    parser.add_argument("--cache", default=None, nargs="?", const=CACHE_DIRECTORY,
+                        help="directory of the cache of binned data (%s by default)"%CACHE_DIRECTORY)
+    parser.add_argument("--cache-size", dest="cache_size", type=float,
+                        default=CACHE_SIZE / 2**20, nargs="?",
+                        help="maximum size of the cache in MB")
+    parser.add_argument("--cache-hash", dest="cache_hash", action="store_true",
+                        help="identify the input files of the cache by the hash of their content")
+
+
+def cache_from_arguments(args):
+    "Return the cache of the parsed options, or None"
+    if args.cache is None:
+        return None
+    return ConversionCache(args.cache, int(args.cache_size * 2**20), args.cache_hash)
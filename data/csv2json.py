@@ -1,73 +1,208 @@
 #!/usr/bin/env python
 
 import os.path
-import json
-import numpy as np
 import pandas as pd
-import pyproj
+from databuffer import write_databuffers, load_for_append, write_appended, schema_root, \
+    class_keys, schema_categories, FORMATS, SPARSE_DENSITY, QUANTILES
+from binning import histogram_cube, class_counts, merge_histograms, grid
+from cache import add_cache_arguments, cache_from_arguments
+from profiler import Profiler
+from stats import Statistics, load_stats, save_stats, stats_path
+from projection import projected_columns, to_lonlat
+from expressions import Expression, read_columns, statistics_columns, evaluate_xy
+from buckets import category_buckets, add_bucket_arguments
+from tiling import add_rebin_arguments, rebin_from_arguments
+from smoothing import add_smooth_arguments, smooth_from_arguments
+
+def csv_expressions(filename, *texts):
+    "Return the expressions of the columns of a csv file"
+    columns = list(pd.read_csv(filename, nrows=0).columns)
+    return [Expression(text, columns) for text in texts]
+
+def csv_statistics(filename, x, y, chunksize=None, profiler=None,
+                   source_projection=None, projection=None, threads=1):
+    """
+    Compute the statistics of the x and y expressions, and of their
+    projection from source_projection to projection, reading the file in
+    chunks
+    """
+    profiler = profiler or Profiler(False)
+    stats = Statistics(statistics_columns(x, y, source_projection, projection))
+    for index, df in enumerate(profiler.iterate("bounds", pd.read_csv(filename,
+                                                                     usecols=read_columns(x, y),
+                                                                     chunksize=chunksize or 1000000))):
+        evaluate_xy(df, x, y, stats, profiler, index, source_projection, projection, threads)
+    return stats
+
+def string_categories(cat_histograms, cat_counts):
+    "Key histograms and counts by their categories as strings, merging e.g. 1 and '1'"
+    histograms = {}
+    counts = {}
+    for cat in cat_histograms:
+        merge_histograms(histograms, counts, {str(cat): cat_histograms[cat]},
+                         {str(cat): cat_counts[cat]})
+    return histograms, counts
+
+def bin_csv(filename, x, y, category, bounds, width, height=None,
+            chunksize=None, require_bounds=False, profiler=None,
+            source_projection=None, projection=None, threads=1):
+    """
+    Read and bin a csv file, computing the missing bounds [xmin, ymin, xmax,
+    ymax] from the data. x, y and category are expressions of its columns,
+    and only the columns they reference are read. With source_projection,
+    the x and y values are projected from it to projection (by threads)
+    before binning, and the bounds are projected ones.
+    Return the histograms and counts of each category, the range and bins of
+    the binning, and the statistics of the file, computed while binning.
+    """
+    profiler = profiler or Profiler(False)
+    if None in bounds and require_bounds:
+        raise ValueError("Missing bounds, xmin/ymin/xmax/ymax required: {}".format(bounds))
+    px, py = projected_columns(x, y, source_projection, projection)
+    stats = Statistics(statistics_columns(x, y, source_projection, projection))
+    usecols = read_columns(x, y, category)
+    scanned = None
+    if chunksize:
+        # stream the file, only scanning x and y first if bounds are missing
+        if None in bounds:
+            print("Incomplete bounds, computing min/max")
+            scanned = csv_statistics(filename, x, y, chunksize, profiler, source_projection,
+                                     projection, threads).bounds(px, py)
+        chunks = profiler.iterate("read", pd.read_csv(filename, usecols=usecols,
+                                                      chunksize=chunksize))
+    else:
+        with profiler.stage("read") as record:
+            df = pd.read_csv(filename, usecols=usecols)
+            record["rows"] = len(df)
+        xy = evaluate_xy(df, x, y, stats, profiler, None, source_projection, projection, threads)
+        scanned = stats.bounds(px, py)
+        chunks = [df]
+    if scanned is not None:
+        bounds = [s if b is None else b for (b, s) in zip(bounds, scanned)]
+    if None in bounds:
+        raise ValueError("Cannot compute bounds of an empty file: {}".format(filename))
+    xy_range, bins = grid(bounds, width, height)
+    print("Range: %s, bins: %s"%(xy_range, bins))
+    cat_histograms = {}
+    cat_counts = {}
+
+    for index, df in enumerate(chunks):
+        if chunksize:
+            print("Accessing chunk len=%d"%len(df))
+            xy = evaluate_xy(df, x, y, stats, profiler, index, source_projection, projection,
+                           threads)
+        with profiler.stage("categorize", index=index, rows=len(df)):
+            values, codes = category.categorize(df)
+        with profiler.stage("bin", index=index, rows=len(df)):
+            cube = histogram_cube(xy[0], xy[1], codes, len(values), bins, xy_range)
+            totals = class_counts(codes, len(values))
+        for i, cat in enumerate(values):
+            if cat in cat_histograms:
+                cat_histograms[cat] += cube[i]
+            else:
+                cat_histograms[cat] = cube[i]
+            cat_counts[cat] = int(totals[i]) + cat_counts.get(cat, 0)
+    if len({isinstance(cat, str) for cat in cat_counts}) > 1:
+        # the dtype of the category is inferred per chunk, e.g., numbers in the
+        # first chunks and strings in a later one: the values are then strings,
+        # as when the whole column is read at once
+        cat_histograms, cat_counts = string_categories(cat_histograms, cat_counts)
+    stats.add_counts(str(category), cat_counts)
+    return cat_histograms, cat_counts, xy_range, bins, stats
 
 def csv_to_databuffers(filename, x, y, category, width=512, height=None,
                        xmin=None, ymin=None, xmax=None, ymax=None,
-                       projection=None, catnames=False):
-    proj = lambda x, y, inverse :  (x, y)
+                       projection=None, catnames=False,
+                       chunksize=None, require_bounds=False, buffer_format="json",
+                       tile_size=None, append=None, profile=False, sparse=None,
+                       cache=None, source_projection=None, threads=1,
+                       catvalnum=None, catvalmin=None, catvalmax=None, catvaledges=None,
+                       catvalquantiles=False, rebin=None, smooth=None,
+                       quantiles=None):
     root, ext = os.path.splitext(filename)
     if ext != ".csv":
         raise ValueError("Expected a .csv file, got ({}) {}".format(ext, filename))
 
-    df = pd.read_csv(filename, usecols=[x, y, category])
-    df[category] = df[category].astype("category")
-    description = {"source": {"filename": filename, "type": "csv"}}
-    if projection:
+    expressions = csv_expressions(filename, x, y, category)
+    profiler = Profiler(profile)
+    if append:
+        # reuse the bounds and bins of the existing buffers
+        (description, [xmin, ymin, xmax, ymax], (width, height),
+         previous, previous_counts) = load_for_append(append)
+    else:
+        description = {"source": {"filename": filename, "type": "csv"}}
+    if projection and not append:
         description["projection"] = {"type": projection}
-        proj = pyproj.Proj(init=projection, preserve_units=True)
-
-    if xmin is None:
-        xmin = df[x].min()
-    if ymin is None:
-        ymin = df[y].min()
-    if xmax is None:
-        xmax = df[x].max()
-    if ymax is None:
-        ymax = df[y].max()
-    xy_range = [[float(xmin), float(xmax)], [float(ymin), float(ymax)]]
-    if ymax == ymin or xmax == xmin:
-        raise ValueError("Invalid bounds: {}".format(xy_range))
-    if height is None:
-        ratio = (ymax - ymin) / (xmax - xmin)
-        height = int(width * ratio)
-    bins = (width, height)
-    print("Range: %s, bins: %s"%(xy_range, bins))
+    if append and "projection" in description:
+        projection = description["projection"]["type"]
+    if source_projection:
+        if not projection:
+            raise ValueError("A --projection is required to project from {}".format(source_projection))
+        description["source"]["projection"] = source_projection
+    if append and "bin" in description["encoding"]["z"] and not catvaledges:
+        # the classes of a numeric category keep their edges
+        catvaledges = description["encoding"]["z"]["bin"]["edges"]
+    category_expr = expressions[2]
+    chunks = () if catvaledges or not catvalnum else \
+        profiler.iterate("buckets", pd.read_csv(filename, usecols=category_expr.columns,
+                                                chunksize=chunksize or 1000000))
+    buckets = category_buckets(category_expr, catvalnum, catvalmin, catvalmax, catvaledges,
+                               catvalquantiles, chunks)
+    category_expr.buckets = buckets
+
+    bounds = [xmin, ymin, xmax, ymax]
+    if None in bounds:
+        # reuse the statistics of a previous conversion of the file
+        known = load_stats(filename)
+        known = known and known.bounds(*projected_columns(x, y, source_projection, projection))
+        if known:
+            print("Using the bounds of %s"%stats_path(filename))
+            bounds = [k if b is None else b for (b, k) in zip(bounds, known)]
+    cached = None
+    if cache and not append:
+        source = cache.source(filename, program="csv2json", x=x, y=y, category=category,
+                              source_projection=source_projection, projection=projection,
+                              buckets=buckets and buckets.to_json())
+        if None not in bounds:
+            xy_range, bins = grid(bounds, width, height)
+            cached = cache.lookup(source, bins, xy_range)
+    if cached:
+        cat_histograms, cat_counts = cached
+    else:
+        (cat_histograms, cat_counts,
+         xy_range, bins, stats) = bin_csv(filename, *expressions, bounds, width, height,
+                                          chunksize, require_bounds, profiler,
+                                          source_projection, projection, threads)
+        save_stats(filename, stats)
+        if cache and not append:
+            cache.store(source, bins, xy_range, cat_histograms, cat_counts)
+    (xmin, xmax), (ymin, ymax) = xy_range
+    width, height = bins
+
     histograms = {}
     counts = {}
-    cat_column = df[category]
-    values = cat_column.cat.categories
-
-    for i, cat in enumerate(values):
-        df_cat = df.loc[cat_column == cat, [x, y]]
-        (histo, xedges, yedges) = np.histogram2d(df_cat[x], df_cat[y],
-                                                 normed=False,
-                                                 bins=bins, range=xy_range)
-        if isinstance(bins, list):
-            if (xedges != bins[0]).any():
-                print("X Edges differ: %s"%xedges)
-                bins = [xedges, yedges]
-            if (yedges != bins[1]).any():
-                print("Y Edges differ: %s"%yedges)
-                bins = [xedges, yedges]
-        else:
-            bins = [xedges, yedges]
-        if isinstance(cat, str):
-            key = cat
-        if catnames:
-            key = str(cat)
-        else:
-            key = i+1
-        histograms[key] = histo
-        counts[key] = len(df_cat) + counts.get(key, 0)
+    # the buckets stay in the order of their values, and the appended
+    # categories keep the keys of their buffers
+    cats = buckets.labels if buckets else sorted(cat_histograms)
+    keys, categories = class_keys(cats, catnames,
+                                  schema_categories(description) if append else None)
+    for (key, cat) in zip(keys, cats):
+        histograms[key] = cat_histograms[cat]
+        counts[key] = cat_counts[cat]
+
+    if append:
+        with profiler.stage("write"):
+            write_appended(append, description, previous, previous_counts,
+                           histograms, counts, filename, tile_size, sparse, rebin, smooth,
+                           quantiles, dict(zip(keys, categories)))
+        profiler.write(schema_root(append))
+        return
 
     if projection:
-        xmin, ymin = proj(xmin, ymin, inverse=True)
-        xmax, ymax = proj(xmax, ymax, inverse=True)
+        # kept to append on the same edges, since the domains only round trip approximately
+        description["projection"]["bounds"] = [float(xmin), float(ymin), float(xmax), float(ymax)]
+        xmin, ymin = to_lonlat(xmin, ymin, projection)
+        xmax, ymax = to_lonlat(xmax, ymax, projection)
         xtype = "latitude"
         ytype = "longitude"
     else:
@@ -101,31 +236,18 @@ def csv_to_databuffers(filename, x, y, category, width=512, height=None,
               "type": "nominal", # or ordinal
               "scale": {
                   "domain": list(histograms.keys())
-                  }
+                  },
+              "categories": categories
              }
         }
+    if buckets:
+        description["encoding"]["z"]["type"] = "ordinal"
+        description["encoding"]["z"]["bin"] = buckets.to_json()
 
-    print("Writing files")
-    count = 0
-    buffers = []
-    for (key, histo) in histograms.items():
-        histo = histo.T
-        histo = np.flipud(histo)
-        hmin = np.min(histo)
-        hmax = np.max(histo)
-        outfile = root + "_cat_%s.json"%key
-        with open(outfile, "w") as outf:
-            json.dump(histo.tolist(), outf)
-        data = {"url": outfile,
-                "count": counts[key],
-                "value": key,
-                "range": [int(hmin), int(hmax)]}
-        buffers.append(data)
-        count += counts[key]
-    description["buffers"] = buffers
-    description["source"]["rows"] = count
-    with open(root + "_data.json", "w") as outf:
-        json.dump(description, outf, indent=2)
+    with profiler.stage("write"):
+        write_databuffers(root, description, histograms, counts, buffer_format,
+                          tile_size, sparse, rebin, smooth, quantiles)
+    profiler.write(root)
 
 
 if __name__ == "__main__":
@@ -134,9 +256,9 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Compute data buffers from a csv file")
     parser.add_argument("infile",
                         help="Input csv file")
-    parser.add_argument("x", help="x column name")
-    parser.add_argument("y", help="y column name")
-    parser.add_argument("category", help="category column name")
+    parser.add_argument("x", help="x column name or expression, e.g., ARR_DELAY/DISTANCE")
+    parser.add_argument("y", help="y column name or expression")
+    parser.add_argument("category", help="category column name or expression")
     parser.add_argument("--catnames", dest="catnames", action="store_false",
                         help="Force category names instead of integers")
     parser.add_argument("--width", type=int, default=512, nargs="?",
@@ -153,9 +275,44 @@ if __name__ == "__main__":
                         help="ymax of bbox")
     parser.add_argument("--projection", default=None, nargs="?",
                         help="Geographic projection applied to these coordinates")
+    parser.add_argument("--source-projection", dest="source_projection", default=None, nargs="?",
+                        help="projection of the x and y columns, e.g., epsg:4326 for longitudes and latitudes, projected to --projection before binning")
+    parser.add_argument("--threads", type=int, default=1, nargs="?",
+                        help="number of threads projecting the coordinates and smoothing the buffers")
+    parser.add_argument("--chunksize", type=int, default=None, nargs="?",
+                        help="Stream the csv file by chunks of this number of rows")
+    parser.add_argument("--require-bounds", dest="require_bounds", action="store_true",
+                        help="Fail instead of scanning the file when a bound is missing")
+    parser.add_argument("--format", dest="buffer_format", default="json", choices=FORMATS,
+                        help="format of the data buffers")
+    parser.add_argument("--sparse", type=float, default=None, nargs="?", const=SPARSE_DENSITY,
+                        help="write the json and binary buffers with at most this fraction of non-empty bins (%g by default) as sparse buffers"%SPARSE_DENSITY)
+    parser.add_argument("--quantiles", type=int, default=None, nargs="?", const=QUANTILES,
+                        help="also write the quantiles of the non-empty bins of each buffer and of all of them, in this number of intervals (%d by default)"%QUANTILES)
+    parser.add_argument("--pyramid", dest="tile_size", type=int, default=None, nargs="?",
+                        help="also write a pyramid of tiles of this size")
+    parser.add_argument("--append", default=None, nargs="?",
+                        help="_data.json schema file of the buffers to add the rows into")
+    parser.add_argument("--profile", action="store_true",
+                        help="write the time and memory of each stage in _profile.json")
+    add_bucket_arguments(parser)
+    add_cache_arguments(parser)
+    add_rebin_arguments(parser)
+    add_smooth_arguments(parser)
     args = parser.parse_args()
     print("args: %s"%args)
     csv_to_databuffers(args.infile, args.x, args.y, args.category,
                        width=args.width, height=args.height,
                        xmin=args.xmin, xmax=args.xmax, ymin=args.ymin, ymax=args.ymax,
-                       projection=args.projection, catnames=args.catnames)
+                       projection=args.projection, catnames=args.catnames,
+                       chunksize=args.chunksize, require_bounds=args.require_bounds,
+                       buffer_format=args.buffer_format, tile_size=args.tile_size,
+                       append=args.append, profile=args.profile, sparse=args.sparse,
+                       cache=cache_from_arguments(args),
+                       source_projection=args.source_projection, threads=args.threads,
+                       catvalnum=args.catvalnum, catvalmin=args.catvalmin,
+                       catvalmax=args.catvalmax, catvaledges=args.catvaledges,
+                       catvalquantiles=args.catvalquantiles,
+                       rebin=rebin_from_arguments(args),
+                       smooth=smooth_from_arguments(args),
+                       quantiles=args.quantiles)
@@ -1,78 +1,73 @@
 #!/usr/bin/env python
 
 import os.path
-import json
 import numpy as np
 import pandas as pd
+from databuffer import write_databuffers, FORMATS, SPARSE_DENSITY
+from binning import histogram_cube, class_counts
+from expressions import Expression, read_columns
+from buckets import Buckets
+from projection import to_lonlat
 
 def csv_to_databuffers(filename, x, y, category, width=512, height=None,
                        xmin=None, ymin=None, xmax=None, ymax=None,
                        projection=None, catnames=False, catfilter=None,
-                       catvalmin=None, catvalmax=None, catvalnum=None):
+                       catvalmin=None, catvalmax=None, catvalnum=None,
+                       buffer_format='json', sparse=None):
     proj = lambda x, y, inverse :  (x, y)
     root, ext = os.path.splitext(filename)
     if ext != '.csv':
         raise ValueError('Expected a .csv file, got ({}) {}'.format(ext, filename))
 
-    # Make operation on two colums
-    if '/' in x and '/' in y:
-        x1 = x[:x.index('/')]
-        x2 = x[x.index('/')+1:]
-        y1 = y[:y.index('/')]
-        y2 = y[y.index('/')+1:]
-        df = pd.read_csv(filename, usecols=[x1, x2, y1, y2, category])
-        df[x] = df[x1]/df[x2]
-        df[y] = df[y1]/df[y2]
-    if '/' in y:
-        y1 = y[:y.index('/')]
-        y2 = y[y.index('/')+1:]
-        df = pd.read_csv(filename, usecols=[x, y1, y2, category])
-        df[y] = df[y1]/df[y2]
-
-    elif '/' in x:
-        x1 = x[:x.index('/')]
-        x2 = x[x.index('/')+1:]
-        df = pd.read_csv(filename, usecols=[x1, x2, y, category])
-        df[x] = df[x1]/df[x2]
-
-    else :
-         df = pd.read_csv(filename, usecols=[x, y, category])
+    # x, y and category can be expressions of the columns, e.g., a/b
+    columns = list(pd.read_csv(filename, nrows=0).columns)
+    x_expr, y_expr, cat_expr = [Expression(text, columns) for text in (x, y, category)]
+    df = pd.read_csv(filename, usecols=read_columns(x_expr, y_expr, cat_expr))
+    xs = x_expr.evaluate(df)
+    ys = y_expr.evaluate(df)
+    cat_values = pd.Series(cat_expr.evaluate(df), copy=False)
 
+    keep = None
     # filter the categories
     if catfilter:
-        df = df[df[category].isin( catfilter.split(','))] #filter categories
-
-
-    print(catvalmin)
-    print(catvalmax)
+        keep = cat_values.isin(catfilter.split(',')).values #filter categories
 
     # transform a numerical data into categories
     if catvalnum:
-        if catvalmin and catvalmax:
-            df = df[(df[category] >= float(catvalmin)) & (df[category] <= float(catvalmax))]
-        elif catvalmin:
-            df = df[(df[category] >= float(catvalmin))]
-        elif catvalmax:
-            df = df[(df[category] <= float(catvalmax))]
-
-        df[category] = pd.cut(df[category], int(catvalnum))
-
-
-    df[category] = df[category].astype("category")
+        in_range = np.ones(len(cat_values), dtype=bool) if keep is None else keep
+        if catvalmin:
+            in_range = in_range & (cat_values >= float(catvalmin)).values
+        if catvalmax:
+            in_range = in_range & (cat_values <= float(catvalmax)).values
+        keep = in_range
+
+    if keep is not None:
+        xs, ys, cat_values = xs[keep], ys[keep], cat_values[keep]
+    buckets = None
+    if catvalnum:
+        # fixed edges, as in the converters that stream the file
+        numbers = np.asarray(cat_values, dtype=np.float64)
+        buckets = Buckets.uniform(float(catvalmin) if catvalmin else np.nanmin(numbers),
+                                  float(catvalmax) if catvalmax else np.nanmax(numbers),
+                                  int(catvalnum))
+        values = buckets.labels
+        codes = buckets.codes(numbers)
+    else:
+        cat_column = cat_values.astype("category")
+        values = cat_column.cat.categories
+        codes = cat_column.cat.codes.values
     description = {'source': {"filename": filename, "type": "csv"}}
     if projection:
         description['projection'] = {"type": projection}
-        import pyproj
-        proj = pyproj.Proj(init=projection, preserve_units=True)
 
     if xmin is None:
-        xmin = df[x].min()
+        xmin = np.nanmin(xs)
     if ymin is None:
-        ymin = df[y].min()
+        ymin = np.nanmin(ys)
     if xmax is None:
-        xmax = df[x].max()
+        xmax = np.nanmax(xs)
     if ymax is None:
-        ymax = df[y].max()
+        ymax = np.nanmax(ys)
     xy_range = [[float(xmin), float(xmax)], [float(ymin), float(ymax)]]
     if ymax == ymin or xmax == xmin:
         raise ValueError('Invalid bounds: {}'.format(xy_range))
@@ -82,39 +77,28 @@ def csv_to_databuffers(filename, x, y, category, width=512, height=None,
     bins = (width, height)
 
     print('Range: %s, bins: %s'%(xy_range, bins))
-    print('Size: %s items'%(df[x].size))
+    print('Size: %s items'%(xs.size))
 
     histograms = {}
     counts = {}
-    cat_column = df[category]
-    values = cat_column.cat.categories
+    cube = histogram_cube(xs, ys, codes, len(values),
+                          bins, xy_range)
+    totals = class_counts(codes, len(values))
 
     for i, cat in enumerate(values):
-        df_cat = df.loc[cat_column == cat, [x, y]]
-        (histo, xedges, yedges) = np.histogram2d(df_cat[x], df_cat[y],
-                                                 normed=False,
-                                                 bins=bins, range=xy_range)
-        if isinstance(bins, list):
-            if (xedges != bins[0]).any():
-                print('X Edges differ: %s'%xedges)
-                bins = [xedges, yedges]
-            if (yedges != bins[1]).any():
-                print('Y Edges differ: %s'%yedges)
-                bins = [xedges, yedges]
-        else:
-            bins = [xedges, yedges]
         if isinstance(cat, str):
             key = cat
         if catnames:
             key = str(cat)
         else:
             key = i+1
-        histograms[key] = histo
-        counts[key] = len(df_cat) + counts.get(key, 0)
+        histograms[key] = cube[i] / np.sum(cube[i]) * 100
+        counts[key] = int(totals[i])
 
     if projection:
-        xmin, ymin = proj(xmin, ymin, inverse=True)
-        xmax, ymax = proj(xmax, ymax, inverse=True)
+        description['projection']['bounds'] = [float(xmin), float(ymin), float(xmax), float(ymax)]
+        xmin, ymin = to_lonlat(xmin, ymin, projection)
+        xmax, ymax = to_lonlat(xmax, ymax, projection)
         xtype = "latitude"
         ytype = "longitude"
     else:
@@ -151,29 +135,12 @@ def csv_to_databuffers(filename, x, y, category, width=512, height=None,
                   }
              }
         }
+    if buckets:
+        description['encoding']['z']['type'] = 'ordinal'
+        description['encoding']['z']['bin'] = buckets.to_json()
 
-    print('Writing files')
-    count = 0
-    buffers = []
-    for (key, histo) in histograms.items():
-        histo = histo.T
-        histo = np.flipud(histo)
-        histo = histo / np.sum(histo) * 100
-        hmin = np.min(histo)
-        hmax = np.max(histo)
-        outfile = root + '_cat_%s.json'%key
-        with open(outfile, 'w') as outf:
-            json.dump(histo.tolist(), outf)
-        data = {'url': outfile,
-                'count': counts[key],
-                'value': key,
-                'range': [int(hmin), int(hmax)]}
-        buffers.append(data)
-        count += counts[key]
-    description['buffers'] = buffers
-    description['source']['rows'] = count
-    with open(root + '_data.json', 'w') as outf:
-        json.dump(description, outf, indent=2)
+    write_databuffers(root, description, histograms, counts, buffer_format,
+                      sparse=sparse)
 
 
 if __name__ == '__main__':
@@ -182,9 +149,9 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Compute heatmap from csv')
     parser.add_argument('infile',
                         help='Input csv file')
-    parser.add_argument('x', help='x column name')
-    parser.add_argument('y', help='y column name')
-    parser.add_argument('category', help='category column name')
+    parser.add_argument('x', help='x column name or expression, e.g., a/b')
+    parser.add_argument('y', help='y column name or expression')
+    parser.add_argument('category', help='category column name or expression')
     parser.add_argument('--catnames', dest='catnames', action='store_false',
                         help='Force category names instead of integers')
     parser.add_argument('--width', type=int, default=512, nargs='?',
@@ -210,6 +177,10 @@ if __name__ == '__main__':
                         help='min of values before turning them into categories)')
     parser.add_argument('--catvalmax', default=None, nargs='?',
                         help='max of values before turning them into categories')
+    parser.add_argument('--format', dest='buffer_format', default='json', choices=FORMATS,
+                        help='format of the data buffers')
+    parser.add_argument('--sparse', type=float, default=None, nargs='?', const=SPARSE_DENSITY,
+                        help='write the json and binary buffers with at most this fraction of non-empty bins (%g by default) as sparse buffers'%SPARSE_DENSITY)
 
     args = parser.parse_args()
     print('args: %s'%args)
@@ -217,4 +188,5 @@ if __name__ == '__main__':
                        width=args.width, height=args.height,
                        xmin=args.xmin, xmax=args.xmax, ymin=args.ymin, ymax=args.ymax,
                        projection=args.projection, catfilter=args.catfilter,
-                       catvalnum=args.catvalnum, catvalmin=args.catvalmin, catvalmax=args.catvalmax)
+                       catvalnum=args.catvalnum, catvalmin=args.catvalmin, catvalmax=args.catvalmax,
+                       buffer_format=args.buffer_format, sparse=args.sparse)
@@ -0,0 +1,783 @@
+#!/usr/bin/env python
+"""
+Read and write data buffers and their schema file.
+
+Data buffers are written either as json 2D arrays or in a binary format:
+- 4 bytes: the magic string MDMB
+- 4 bytes: the length of the header, as a little-endian uint32
+- the header, a json object with the dtype, shape and class values of the
+  buffers, padded with spaces so that the data starts on 64 bytes
+- the raw little-endian counts in C order, with shape (classes, height, width)
+A binary file holds one class, or all the classes in the multiclass format.
+The npy format holds all the classes in a .npy file instead. In both, the
+classes are contiguous and each entry of the schema buffers has the index,
+byte offset and dtype of its class in the file, to read it with a single
+range request.
+
+Mostly empty buffers can be written as sparse buffers, in the CSR layout:
+for each row, the columns (indices) and counts of its non-empty bins, the
+bins of row i being at indptr[i]:indptr[i+1]. A sparse json buffer is an
+object with the shape, indptr, indices and counts; a sparse binary buffer
+has "sparse": "csr", the number of non-empty bins (nnz) and the indexDtype
+in its header, followed by the indptr (uint32), indices and counts arrays,
+each one padded to 8 bytes. Their entry in the schema file has
+"sparse": "csr".
+
+The buffers can also be written as a pyramid of tiles: the finest level is
+the binned grid and each coarser level sums the 2x2 bins of the previous one,
+down to a level that fits in a single tile.
+They can be rebinned too, into the tiles of a tiling (see tiling.py), and
+smoothed with several bandwidths (see smoothing.py).
+
+The distribution of the non-empty bins of each buffer, and of all of them,
+can be written in the schema file as a table of quantiles, so that the
+equidepth and log scales are set up without reading all the bins.
+"""
+
+import os
+import os.path
+import glob
+import gzip
+import json
+import struct
+import multiprocessing
+import numpy as np
+from binning import downsample, merge_histograms
+from tiling import write_rebin
+from smoothing import smooth_cube
+
+MAGIC = b"MDMB"
+ALIGNMENT = 64
+FORMATS = ["json", "binary", "multiclass", "npy"]
+# the formats that write all the classes in a single file, and its suffix
+CUBE_FORMATS = {"multiclass": "_data.dbuf", "npy": "_data.npy"}
+INTEGER_DTYPES = ["|u1", "<u2", "<u4", "|i1", "<i2", "<i4"]
+ENCODINGS = [None, "delta", "zigzag"]
+# buffers with at most this fraction of non-empty bins are written sparse
+SPARSE_DENSITY = 0.25
+# the decimals kept in the smoothed buffers
+SMOOTH_DECIMALS = 4
+# the number of intervals between the quantiles of the bins
+QUANTILES = 100
+TILE_URLS = {"json": "{z}/{x}/{y}_cat_{value}.json",
+             "binary": "{z}/{x}/{y}_cat_{value}.dbuf",
+             "multiclass": "{z}/{x}/{y}.dbuf",
+             "npy": "{z}/{x}/{y}.npy"}
+
+
+def is_integral(histo):
+    "Return True when all the values of a histogram are integers"
+    if np.issubdtype(histo.dtype, np.integer):
+        return True
+    return bool(np.all(np.isfinite(histo)) and np.all(np.mod(histo, 1) == 0))
+
+
+def buffer_dtype(histo):
+    """
+    Return the smallest little-endian dtype that stores the values of a
+    histogram exactly: an unsigned (or signed, with negative values) integer
+    of 1, 2 or 4 bytes, or float64.
+    """
+    if histo.size == 0:
+        return np.dtype("|u1")
+    if is_integral(histo):
+        hmin = histo.min()
+        hmax = histo.max()
+        for dtype in INTEGER_DTYPES:
+            info = np.iinfo(dtype)
+            if info.min <= hmin and hmax <= info.max:
+                return np.dtype(dtype)
+    return np.dtype("<f8")
+
+
+def encode_rows(histo, encoding=None, band_rows=None):
+    """
+    Encode a 2D integral histogram before compression, returning it in the
+    smallest dtype that fits:
+    - None: the values,
+    - "delta": the difference of each row with the previous one,
+    - "zigzag": the row differences, mapped to unsigned integers with
+      zigzag encoding (0, -1, 1, -2... become 0, 1, 2, 3...).
+    With band_rows, the first row of each band of band_rows rows is kept so
+    that the bands can be decoded independently.
+    """
+    if encoding not in ENCODINGS:
+        raise ValueError("Unknown encoding: {}".format(encoding))
+    if encoding is None:
+        return histo.astype(buffer_dtype(histo), copy=False)
+    if not is_integral(histo):
+        raise ValueError("Cannot {} encode a histogram of non integral values".format(encoding))
+    histo = np.asarray(histo, dtype=np.int64)
+    delta = histo.copy()
+    delta[1:] -= histo[:-1]
+    if band_rows:
+        delta[::band_rows] = histo[::band_rows]
+    if encoding == "zigzag":
+        delta = (delta << 1) ^ (delta >> 63)
+    return delta.astype(buffer_dtype(delta))
+
+
+def decode_rows(data, encoding=None):
+    "Decode the rows of a histogram (or of one band) encoded by encode_rows"
+    if encoding is None:
+        return data
+    delta = np.array(data, dtype=np.int64)
+    if encoding == "zigzag":
+        delta = (delta >> 1) ^ -(delta & 1)
+    return np.cumsum(delta, axis=0, out=delta)
+
+
+def write_buffer(filename, histos, values, dtype=None):
+    """
+    Write a list of histograms with the same shape in the binary format,
+    returning the dtype and the offset of the data in the file
+    """
+    cube = np.stack(histos)
+    if dtype is None:
+        dtype = buffer_dtype(cube)
+    dtype = np.dtype(dtype).newbyteorder("<")
+    header = {"dtype": dtype.str,
+              "shape": list(cube.shape),
+              "values": list(values)}
+    with open(filename, "wb") as outf:
+        offset = write_header(outf, header)
+        outf.write(np.ascontiguousarray(cube, dtype=dtype).tobytes())
+    return dtype, offset
+
+
+def write_npy(filename, histos, dtype=None):
+    """
+    Write a list of histograms with the same shape as a .npy file,
+    returning the dtype and the offset of the data in the file
+    """
+    cube = np.stack(histos)
+    if dtype is None:
+        dtype = buffer_dtype(cube)
+    dtype = np.dtype(dtype).newbyteorder("<")
+    np.save(filename, np.ascontiguousarray(cube, dtype=dtype))
+    return dtype, np.load(filename, mmap_mode="r").offset
+
+
+def write_cube(filename, histos, values, buffer_format):
+    """
+    Write the histograms of all the classes in a single file in a format of
+    CUBE_FORMATS, returning the dtype and the offset of each class in the file
+    """
+    if buffer_format == "npy":
+        dtype, offset = write_npy(filename, histos)
+    else:
+        dtype, offset = write_buffer(filename, histos, values)
+    size = histos[0].size * dtype.itemsize if histos else 0
+    return dtype, [offset + i * size for i in range(len(histos))]
+
+
+def write_header(outf, header, magic=MAGIC):
+    """
+    Write the magic string and the json header of a binary file, padded to
+    ALIGNMENT, returning their length
+    """
+    header = json.dumps(header).encode("utf8")
+    header += b" " * (-(len(magic) + 4 + len(header)) % ALIGNMENT)
+    outf.write(magic)
+    outf.write(struct.pack("<I", len(header)))
+    outf.write(header)
+    return len(magic) + 4 + len(header)
+
+
+def to_sparse(histo):
+    "Return the CSR arrays (indptr, indices, counts) of the non-empty bins of a 2D histogram"
+    rows, indices = np.nonzero(histo)
+    indptr = np.zeros(len(histo) + 1, dtype=np.int64)
+    np.cumsum(np.count_nonzero(histo, axis=1), out=indptr[1:])
+    return indptr, indices, histo[rows, indices]
+
+
+def to_dense(shape, indptr, indices, counts):
+    "Return the 2D histogram of shape (height, width) of CSR arrays"
+    histo = np.zeros(shape, dtype=counts.dtype)
+    rows = np.repeat(np.arange(shape[0]), np.diff(indptr))
+    histo[rows, indices] = counts
+    return histo
+
+
+def is_sparse(histo, density=SPARSE_DENSITY):
+    "Return True when at most a fraction density of the bins of a histogram are not empty"
+    return np.count_nonzero(histo) <= density * histo.size
+
+
+def write_sparse_json(filename, histo):
+    "Write a 2D histogram as a sparse json buffer"
+    indptr, indices, counts = to_sparse(histo)
+    with open(filename, "w") as outf:
+        json.dump({"shape": list(histo.shape),
+                   "indptr": indptr.tolist(),
+                   "indices": indices.tolist(),
+                   "counts": counts.tolist()}, outf)
+
+
+def write_sparse_buffer(filename, histo, value):
+    "Write a 2D histogram as a sparse binary buffer"
+    indptr, indices, counts = to_sparse(histo)
+    sections = [indptr.astype("<u4"),
+                indices.astype(buffer_dtype(np.array([0, histo.shape[1]]))),
+                counts.astype(buffer_dtype(counts))]
+    header = {"dtype": sections[2].dtype.str,
+              "shape": [1] + list(histo.shape),
+              "values": [value],
+              "sparse": "csr",
+              "nnz": len(counts),
+              "indexDtype": sections[1].dtype.str}
+    with open(filename, "wb") as outf:
+        write_header(outf, header)
+        for section in sections:
+            data = section.tobytes()
+            outf.write(data + b"\0" * (-len(data) % 8))
+
+
+def read_sparse_buffer(filename, header):
+    "Read the CSR arrays (indptr, indices, counts) of a sparse binary buffer"
+    height = header["shape"][-2]
+    nnz = header["nnz"]
+    offset = header["offset"]
+    sections = []
+    for (dtype, length) in [("<u4", height + 1),
+                            (header["indexDtype"], nnz),
+                            (header["dtype"], nnz)]:
+        dtype = np.dtype(dtype)
+        sections.append(np.fromfile(filename, dtype=dtype, count=length, offset=offset))
+        offset += length * dtype.itemsize
+        offset += -offset % 8
+    return tuple(sections)
+
+
+def read_json_histogram(filename):
+    "Read a json buffer, dense or sparse and possibly gzipped, as a 2D array"
+    with _open_json_buffer(filename) as inf:
+        data = json.load(inf)
+    if isinstance(data, dict):
+        return to_dense(tuple(data["shape"]), np.array(data["indptr"], dtype=np.int64),
+                        np.array(data["indices"], dtype=np.intp), np.array(data["counts"]))
+    return np.array(data)
+
+
+def read_header(filename, magic=MAGIC):
+    "Read the header of a binary buffer file, adding the offset of the data"
+    with open(filename, "rb") as inf:
+        if inf.read(len(magic)) != magic:
+            raise ValueError("Not a binary data buffer: {}".format(filename))
+        (length,) = struct.unpack("<I", inf.read(4))
+        header = json.loads(inf.read(length).decode("utf8"))
+    header["offset"] = len(magic) + 4 + length
+    return header
+
+
+def read_buffer(filename):
+    """
+    Map a binary buffer file in memory, returning its header and a read-only
+    array of shape (classes, height, width).
+    Sparse buffers are read and made dense.
+    """
+    header = read_header(filename)
+    if header.get("sparse"):
+        shape = tuple(header["shape"][-2:])
+        return header, to_dense(shape, *read_sparse_buffer(filename, header))[np.newaxis]
+    cube = np.memmap(filename, dtype=np.dtype(header["dtype"]), mode="r",
+                     offset=header["offset"], shape=tuple(header["shape"]))
+    return header, cube
+
+
+# the characters of a json array of numbers that are not part of the numbers
+JSON_SEPARATORS = bytes.maketrans(b"[],", b"   ")
+
+
+def json_buffer_root(filename):
+    "Return the root name of a .json or .json.gz data buffer"
+    root, ext = os.path.splitext(filename)
+    if ext == ".gz":
+        root, ext = os.path.splitext(root)
+    if ext != ".json":
+        raise ValueError("Not a json file ({}): {}".format(ext, filename))
+    return root
+
+
+def _open_json_buffer(filename):
+    if filename.endswith(".gz"):
+        return gzip.open(filename, "rb")
+    return open(filename, "rb")
+
+
+def json_buffer_shape(filename, chunk_size=1 << 20):
+    "Return the shape (height, width) of a json data buffer by scanning its brackets"
+    rows = 0
+    width = None
+    head = b""
+    with _open_json_buffer(filename) as inf:
+        for chunk in iter(lambda: inf.read(chunk_size), b""):
+            rows += chunk.count(b"[")
+            if width is None:
+                # the width is the number of values in the first row
+                head += chunk
+                end = head.find(b"]")
+                if end >= 0:
+                    start = head.find(b"[", head.find(b"[") + 1)
+                    row = head[start + 1:end] if 0 <= start < end else b""
+                    width = row.count(b",") + 1 if row.strip() else 0
+                    head = None
+    if width is None:
+        raise ValueError("Not a json 2D array: {}".format(filename))
+    return (rows - 1, width)
+
+
+def _parse_numbers(text, flat, pos):
+    "Parse the space separated numbers of text into flat from pos, returning the next pos"
+    text = text.strip()
+    if not text:  # np.fromstring would return [-1]
+        return pos
+    values = np.fromstring(text, dtype=np.float64, sep=" ")
+    if pos + len(values) > flat.size:
+        raise ValueError("Too many numbers, expected {}".format(flat.size))
+    flat[pos:pos + len(values)] = values
+    return pos + len(values)
+
+
+def read_json_buffer(filename, dtype=np.float64, chunk_size=1 << 20):
+    """
+    Parse a json data buffer (a 2D array of numbers, possibly gzipped) into
+    an array of the given dtype, allocated once.
+    The file is read by chunks of chunk_size bytes whose numbers are parsed
+    straight into the array, without building nested lists.
+    Sparse buffers are made dense.
+    """
+    with _open_json_buffer(filename) as inf:
+        if inf.read(64).lstrip().startswith(b"{"):
+            return read_json_histogram(filename).astype(dtype)
+    shape = json_buffer_shape(filename, chunk_size)
+    histo = np.empty(shape, dtype=dtype)
+    flat = histo.reshape(-1)
+    pos = 0
+    tail = b""
+    with _open_json_buffer(filename) as inf:
+        for chunk in iter(lambda: inf.read(chunk_size), b""):
+            text = tail + chunk.translate(JSON_SEPARATORS)
+            # keep the last number for the next chunk, it may be cut
+            cut = text.rfind(b" ") + 1
+            tail = text[cut:]
+            pos = _parse_numbers(text[:cut], flat, pos)
+    pos = _parse_numbers(tail, flat, pos)
+    if pos != flat.size:
+        raise ValueError("Expected {} numbers in {}, got {}".format(flat.size, filename, pos))
+    return histo
+
+
+def json_buffer_files(paths):
+    "Expand the directories of paths into their _cat_*.json(.gz) data buffers"
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(glob.glob(os.path.join(path, "*_cat_*.json")) +
+                            glob.glob(os.path.join(path, "*_cat_*.json.gz")))
+        else:
+            files.append(path)
+    return files
+
+
+def is_up_to_date(filename, outname):
+    "Return True when outname exists and is newer than filename"
+    return os.path.exists(outname) and \
+        os.path.getmtime(outname) >= os.path.getmtime(filename)
+
+
+def convert_buffers(function, paths, jobs=1, force=False):
+    """
+    Apply a converter function(filename, force) to the json data buffers of
+    paths (files or directories) using jobs processes, and return the names
+    of the files that it wrote.
+    """
+    files = json_buffer_files(paths)
+    tasks = [(function, filename, force) for filename in files]
+    if jobs == 1 or len(files) <= 1:
+        written = [_convert_task(task) for task in tasks]
+    else:
+        with multiprocessing.Pool(min(jobs, len(files))) as pool:
+            written = pool.map(_convert_task, tasks, chunksize=1)
+    return [name for name in written if name is not None]
+
+
+def _convert_task(task):
+    (function, filename, force) = task
+    return function(filename, force=force)
+
+
+def buffer_path(schema_filename, url):
+    "Return the path of a buffer url relative to its schema file"
+    if os.path.exists(url):
+        return url
+    return os.path.join(os.path.dirname(schema_filename), os.path.basename(url))
+
+
+def load_databuffers(filename):
+    """
+    Load a schema file and its data buffers, returning the schema and a
+    dictionary of 2D arrays keyed by class value.
+    The dense binary buffers are memory-mapped, not read, and the sparse
+    buffers are made dense.
+    """
+    with open(filename) as inf:
+        description = json.load(inf)
+    return description, load_buffers(filename, description["buffers"])
+
+
+def load_buffers(filename, buffers):
+    """
+    Load the data buffers of entries of a schema file, e.g., its smoothed
+    buffers, as a dictionary of 2D arrays keyed by class value
+    """
+    histograms = {}
+    for buf in buffers:
+        path = buffer_path(filename, buf["url"])
+        if path.endswith(".json"):
+            histograms[buf["value"]] = read_json_histogram(path)
+        elif path.endswith(".npy"):
+            histograms[buf["value"]] = np.load(path, mmap_mode="r")[buf["index"]]
+        else:
+            _, cube = read_buffer(path)
+            histograms[buf["value"]] = cube[buf.get("index", 0)]
+    return histograms
+
+
+def write_tile(directory, zoom, tx, ty, tile, values, buffer_format):
+    "Write the buffers of a tile of shape (classes, tile_size, tile_size)"
+    url = TILE_URLS[buffer_format]
+    os.makedirs(os.path.join(directory, str(zoom), str(tx)), exist_ok=True)
+    if buffer_format in CUBE_FORMATS:
+        outfile = os.path.join(directory, url.format(z=zoom, x=tx, y=ty))
+        write_cube(outfile, list(tile), values, buffer_format)
+        return
+    for (value, histo) in zip(values, tile):
+        outfile = os.path.join(directory, url.format(z=zoom, x=tx, y=ty, value=value))
+        if buffer_format == "json":
+            with open(outfile, "w") as outf:
+                json.dump(histo.tolist(), outf)
+        else:
+            write_buffer(outfile, [histo], [value])
+
+
+def write_pyramid(root, histograms, tile_size=256, buffer_format="json"):
+    """
+    Write the pyramid of tiles of the histograms in root_tiles/z/x/y, skipping
+    the empty tiles, and return its description for the schema file.
+    The zoom 0 fits in one tile, the tiles are tile_size x tile_size bins and
+    y grows downwards.
+    """
+    values = list(histograms.keys())
+    level = np.stack([np.flipud(histograms[key]) for key in values])
+    _, height, width = level.shape
+    max_zoom = 0
+    while (tile_size << max_zoom) < max(width, height):
+        max_zoom += 1
+    directory = root + "_tiles"
+    levels = []
+    for zoom in range(max_zoom, -1, -1):
+        if zoom != max_zoom:
+            level = downsample(level)
+        _, height, width = level.shape
+        tiles = []
+        for ty in range(0, -(-height // tile_size)):
+            for tx in range(0, -(-width // tile_size)):
+                tile = level[:, ty*tile_size:(ty+1)*tile_size, tx*tile_size:(tx+1)*tile_size]
+                if not tile.any():
+                    continue
+                if tile.shape[1:] != (tile_size, tile_size):
+                    padded = np.zeros((len(values), tile_size, tile_size), dtype=tile.dtype)
+                    padded[:, :tile.shape[1], :tile.shape[2]] = tile
+                    tile = padded
+                write_tile(directory, zoom, tx, ty, tile, values, buffer_format)
+                tiles.append([tx, ty])
+        print("Zoom %d: %d tiles"%(zoom, len(tiles)))
+        levels.append({"zoom": zoom,
+                       "width": width,
+                       "height": height,
+                       "binSize": 1 << (max_zoom - zoom),
+                       "tiles": tiles,
+                       "range": [[int(np.min(histo)), int(np.max(histo))] for histo in level]})
+    levels.reverse()
+    return {"tileSize": tile_size,
+            "maxZoom": max_zoom,
+            "url": directory + "/" + TILE_URLS[buffer_format],
+            "levels": levels}
+
+
+def bin_distribution(histos, quantiles=QUANTILES):
+    """
+    Return the distribution of the non-empty bins of some histograms: their
+    number and their quantiles 0, 1/quantiles, ..., 1, the first and last
+    being the min and max of the bins
+    """
+    values = np.concatenate([np.asarray(histo).ravel() for histo in histos])
+    values = values[values > 0]
+    levels = np.linspace(0, 1, quantiles + 1)
+    return {"levels": quantiles,
+            "bins": len(values),
+            "quantiles": np.quantile(values, levels).tolist() if len(values) else []}
+
+
+def write_buffers(root, histograms, counts, buffer_format="json", sparse=None,
+                  quantiles=None):
+    """
+    Write the data buffers of histograms in a format, flipped so that their
+    first row is the top, and return their entries of the schema file, with
+    the distribution of their bins when quantiles is given
+    """
+    buffers = []
+    flipped = []
+    for (key, histo) in histograms.items():
+        histo = np.flipud(histo)
+        hmin = np.min(histo)
+        hmax = np.max(histo)
+        sparse_histo = sparse is not None and buffer_format not in CUBE_FORMATS \
+            and is_sparse(histo, sparse)
+        if buffer_format == "json":
+            outfile = root + "_cat_%s.json"%key
+            if sparse_histo:
+                write_sparse_json(outfile, histo)
+            else:
+                with open(outfile, "w") as outf:
+                    json.dump(histo.tolist(), outf)
+        elif buffer_format == "binary":
+            outfile = root + "_cat_%s.dbuf"%key
+            if sparse_histo:
+                write_sparse_buffer(outfile, histo, key)
+            else:
+                write_buffer(outfile, [histo], [key])
+        else:
+            outfile = root + CUBE_FORMATS[buffer_format]
+            flipped.append(histo)
+        # the smoothed buffers are not integral
+        vrange = [int(hmin), int(hmax)] if is_integral(histo) else [float(hmin), float(hmax)]
+        data = {"url": outfile,
+                "count": counts[key],
+                "value": key,
+                "range": vrange}
+        if buffer_format in CUBE_FORMATS:
+            data["index"] = len(flipped) - 1
+        if sparse_histo:
+            data["sparse"] = "csr"
+        if quantiles:
+            data["distribution"] = bin_distribution([histo], quantiles)
+        buffers.append(data)
+    if flipped:
+        dtype, offsets = write_cube(root + CUBE_FORMATS[buffer_format], flipped,
+                                    list(histograms.keys()), buffer_format)
+        for (data, offset) in zip(buffers, offsets):
+            data["offset"] = int(offset)
+            data["dtype"] = dtype.str
+    return buffers
+
+
+def write_smoothed(root, smooth, histograms, counts, buffer_format="json", sparse=None,
+                   quantiles=None):
+    """
+    Write the histograms blurred with each bandwidth of a smooth spec in
+    root_smooth<bandwidth> buffers, and return the smooth entry of the
+    schema file, with the buffers of each bandwidth, and their distribution
+    when quantiles is given
+    """
+    values = list(histograms.keys())
+    cube = np.stack([histograms[value] for value in values])
+    method = smooth.get("method", "gaussian")
+    levels = []
+    for bandwidth in smooth["bandwidths"]:
+        blurred = smooth_cube(cube, bandwidth, method, smooth.get("threads", 1))
+        # the counts are not negative, and the last decimals are noise
+        blurred = np.round(np.maximum(blurred, 0), SMOOTH_DECIMALS)
+        buffers = write_buffers("%s_smooth%g"%(root, bandwidth), dict(zip(values, blurred)),
+                                counts, buffer_format, sparse, quantiles)
+        level = {"bandwidth": bandwidth, "buffers": buffers}
+        if quantiles:
+            level["distribution"] = bin_distribution(blurred, quantiles)
+        levels.append(level)
+    return {"method": method, "bandwidths": list(smooth["bandwidths"]), "levels": levels}
+
+
+def write_databuffers(root, description, histograms, counts, buffer_format="json",
+                      tile_size=None, sparse=None, rebin=None, smooth=None, quantiles=None):
+    """
+    Write the data buffers and the schema file of a conversion.
+    histograms maps class values to 2D arrays of shape (height, width) whose
+    first row is the bottom (ymin) of the bins, and counts maps them to the
+    number of rows of each class.
+    When tile_size is given, a pyramid of tiles is also written.
+    When sparse is given, the json and binary buffers with at most this
+    fraction of non-empty bins are written sparse.
+    When rebin is given, the buffers are also aggregated into its tiles.
+    When smooth is given, the buffers blurred with its bandwidths are also
+    written.
+    When quantiles is given, the distribution of the non-empty bins of each
+    buffer, and of all the buffers, is a table of quantiles 0, 1/quantiles,
+    ..., 1.
+    """
+    if buffer_format not in FORMATS:
+        raise ValueError("Unknown buffer format: {}".format(buffer_format))
+    print("Writing files")
+    buffers = write_buffers(root, histograms, counts, buffer_format, sparse, quantiles)
+    description["buffers"] = buffers
+    if sparse is not None and buffer_format not in CUBE_FORMATS:
+        # kept to write the appended buffers sparse the same way
+        description["sparseDensity"] = sparse
+    if quantiles:
+        description["distribution"] = bin_distribution(histograms.values(), quantiles)
+    description["source"]["rows"] = sum(counts[key] for key in histograms)
+    if tile_size:
+        description["pyramid"] = write_pyramid(root, histograms, tile_size, buffer_format)
+    if rebin:
+        projection = description.get("projection", {}).get("type")
+        description["rebin"], aggregates = write_rebin(
+            root, rebin, np.stack([np.flipud(histograms[key]) for key in histograms]),
+            schema_bounds(description), projection, buffer_format)
+        for (data, tiles) in zip(buffers, aggregates):
+            data["tiles"] = tiles.tolist()
+    if smooth:
+        description["smooth"] = write_smoothed(root, smooth, histograms, counts,
+                                               buffer_format, sparse, quantiles)
+    with open(root + "_data.json", "w") as outf:
+        json.dump(description, outf, indent=2)
+
+
+def schema_root(filename):
+    "Return the root name of the files of a conversion from its schema file"
+    if not filename.endswith("_data.json"):
+        raise ValueError("Expected a _data.json schema file, got {}".format(filename))
+    return filename[:-len("_data.json")]
+
+
+def schema_format(description):
+    "Return the format of the data buffers of a schema"
+    buf = description["buffers"][0]
+    if buf["url"].endswith(".json"):
+        return "json"
+    if buf["url"].endswith(".npy"):
+        return "npy"
+    return "multiclass" if "index" in buf else "binary"
+
+
+def schema_bounds(description):
+    """
+    Return the bounds [xmin, ymin, xmax, ymax] of the binning of a schema,
+    projected if needed
+    """
+    if "bounds" in description.get("projection", {}):
+        return list(description["projection"]["bounds"])
+    encoding = description["encoding"]
+    xdomain = encoding["x"]["scale"]["domain"]
+    ydomain = encoding["y"]["scale"]["domain"]
+    xmin, xmax = min(xdomain), max(xdomain)
+    ymin, ymax = min(ydomain), max(ydomain)
+    if "projection" in description:
+        # the older schemas only have the domains, inverse projected, which
+        # only round trip approximately
+        from projection import from_lonlat
+        xmin, ymin = from_lonlat(xmin, ymin, description["projection"]["type"])
+        xmax, ymax = from_lonlat(xmax, ymax, description["projection"]["type"])
+    return [xmin, ymin, xmax, ymax]
+
+
+def class_keys(categories, catnames=True, known=None):
+    """
+    Return the keys of the buffers of some categories, and the categories as
+    json values: the categories as strings with catnames, or their rank from
+    1 otherwise. known maps the categories of existing buffers to their
+    keys, that they keep, the other categories being ranked after them.
+    """
+    known = known or {}
+    keys = []
+    values = []
+    rank = len(known)
+    for cat in categories:
+        cat = cat.item() if isinstance(cat, np.generic) else cat
+        if cat in known:
+            key = known[cat]
+        elif catnames:
+            key = str(cat)
+        else:
+            rank += 1
+            key = rank
+        keys.append(key)
+        values.append(cat)
+    return keys, values
+
+
+def schema_categories(description):
+    """
+    Return the keys of the buffers of a schema file by category, to add new
+    rows into them. The schema files without categories are only matched
+    when their keys are the categories, as strings.
+    """
+    z = description["encoding"]["z"]
+    domain = z["scale"]["domain"]
+    if "categories" in z:
+        return dict(zip(z["categories"], domain))
+    if all(isinstance(key, str) for key in domain):
+        return {key: key for key in domain}
+    raise ValueError("Cannot match the classes {} without their categories, "
+                     "convert the data again".format(domain))
+
+
+def load_for_append(filename):
+    """
+    Load a schema file and its data buffers to add new rows into them.
+    Return the schema, the bounds [xmin, ymin, xmax, ymax] and bins
+    (width, height) of its binning, and its histograms and counts, as
+    expected by write_databuffers.
+    """
+    description, buffers = load_databuffers(filename)
+    encoding = description["encoding"]
+    bins = (encoding["x"]["bin"]["maxbins"], encoding["y"]["bin"]["maxbins"])
+    histograms = {}
+    counts = {}
+    for buf in description["buffers"]:
+        histo = np.flipud(buffers[buf["value"]])
+        if bins != (histo.shape[1], histo.shape[0]):
+            raise ValueError("Invalid buffer shape for {}: {}".format(buf["value"], histo.shape))
+        histograms[buf["value"]] = np.array(histo, dtype=np.int64)
+        counts[buf["value"]] = buf["count"]
+    return description, schema_bounds(description), bins, histograms, counts
+
+
+def write_appended(filename, description, histograms, counts,
+                   new_histograms, new_counts, source, tile_size=None, sparse=None,
+                   rebin=None, smooth=None, quantiles=None, categories=None):
+    """
+    Add the histograms and counts of new rows read from source to the ones
+    loaded by load_for_append, and write them back with their schema file.
+    The new histograms are keyed as returned by class_keys, with the
+    schema_categories of the schema, and categories maps their keys to
+    their categories.
+    The buffers are written sparse when sparse is given or with the sparse
+    density they were written with, and rebinned, smoothed and with their
+    distribution when rebin, smooth and quantiles are given or when they
+    were.
+    """
+    if categories is not None:
+        known = {key: cat for (cat, key) in schema_categories(description).items()}
+        known.update(categories)
+    histograms, counts = merge_histograms(histograms, counts, new_histograms, new_counts)
+    z = description["encoding"]["z"]
+    z["scale"]["domain"] = list(histograms.keys())
+    if categories is not None:
+        z["categories"] = [known[key] for key in z["scale"]["domain"]]
+    description["source"].setdefault("appended", []).append(source)
+    if tile_size is None and "pyramid" in description:
+        tile_size = description["pyramid"]["tileSize"]
+    if sparse is None and "sparseDensity" in description:
+        sparse = description["sparseDensity"]
+    elif sparse is None and any("sparse" in buf for buf in description["buffers"]):
+        sparse = SPARSE_DENSITY
+    if rebin is None:
+        rebin = description.get("rebin")
+    if smooth is None:
+        smooth = description.get("smooth")
+    if quantiles is None:
+        quantiles = description.get("distribution", {}).get("levels")
+    write_databuffers(schema_root(filename), description, histograms, counts,
+                      schema_format(description), tile_size, sparse, rebin, smooth,
+                      quantiles)
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+"""
+Vectorized expressions of columns, to bin derived values, e.g., the ratio of
+two columns ("ARR_DELAY / DISTANCE"), "log1p(DISTANCE)" or
+"clip(ARR_DELAY, -60, 180)", instead of plain columns.
+
+An expression is parsed once and evaluated on each chunk or row group read
+with only the columns it references. It returns a NumPy array, computed with
+numexpr when it is installed and supports the expression, and with NumPy
+otherwise; a plain column is returned as is, without any copy.
+The operators &, | and ~ are the logical and, or and not, e.g., to combine
+comparisons, whatever the type of their operands; numexpr would compute
+them bitwise on integers, so they are always evaluated with NumPy.
+Column names that are not Python identifiers are written between backquotes,
+e.g., "`arrival delay` / DISTANCE".
+"""
+
+import ast
+import re
+import numpy as np
+import pandas as pd
+from projection import project_values, projected_columns
+
+try:
+    import numexpr
+except ImportError:  # numexpr is optional
+    numexpr = None
+
+FUNCTIONS = {
+    "abs": np.abs,
+    "sqrt": np.sqrt,
+    "exp": np.exp,
+    "expm1": np.expm1,
+    "log": np.log,
+    "log10": np.log10,
+    "log2": np.log2,
+    "log1p": np.log1p,
+    "sin": np.sin,
+    "cos": np.cos,
+    "tan": np.tan,
+    "arcsin": np.arcsin,
+    "arccos": np.arccos,
+    "arctan": np.arctan,
+    "arctan2": np.arctan2,
+    "sinh": np.sinh,
+    "cosh": np.cosh,
+    "tanh": np.tanh,
+    "floor": np.floor,
+    "ceil": np.ceil,
+    "round": np.round,
+    "minimum": np.minimum,
+    "maximum": np.maximum,
+    "clip": np.clip,
+    "where": np.where,
+}
+# the operators that are logical here, and bitwise on integers in numexpr
+LOGICAL_OPERATORS = (ast.BitAnd, ast.BitOr, ast.Invert)
+# the functions that numexpr evaluates in all its versions
+NUMEXPR_FUNCTIONS = {"abs", "sqrt", "exp", "expm1", "log", "log10", "log1p",
+                     "sin", "cos", "tan", "arcsin", "arccos", "arctan", "arctan2",
+                     "sinh", "cosh", "tanh", "where"}
+NUMEXPR_DTYPES = {np.dtype(t) for t in (np.bool_, np.int32, np.int64, np.float32, np.float64)}
+
+OPERATORS = {
+    ast.Add: np.add,
+    ast.Sub: np.subtract,
+    ast.Mult: np.multiply,
+    ast.Div: np.true_divide,
+    ast.FloorDiv: np.floor_divide,
+    ast.Mod: np.mod,
+    ast.Pow: np.power,
+    ast.BitAnd: np.logical_and,
+    ast.BitOr: np.logical_or,
+    ast.USub: np.negative,
+    ast.UAdd: np.positive,
+    ast.Invert: np.logical_not,
+    ast.Lt: np.less,
+    ast.LtE: np.less_equal,
+    ast.Gt: np.greater,
+    ast.GtE: np.greater_equal,
+    ast.Eq: np.equal,
+    ast.NotEq: np.not_equal,
+}
+CONSTANTS = {"pi": np.pi, "e": np.e}
+
+_QUOTED = re.compile(r"`([^`]*)`")
+
+
+class Expression(object):
+    """
+    An expression of the columns of a table, or a plain column.
+    With columns, the names of the columns of the table, a text that is the
+    name of a column is always that column, even if it could be parsed, and
+    the columns named like a constant (pi or e) are columns, not constants.
+    """
+    def __init__(self, text, columns=None):
+        self.text = text
+        # the buckets of a numeric category, if any
+        self.buckets = None
+        if columns is not None and text in columns:
+            self.column = text
+            self.columns = [text]
+            return
+        quoted = []
+
+        def quote(match):
+            quoted.append(match.group(1))
+            return "_quoted%d"%(len(quoted) - 1)
+        try:
+            tree = ast.parse(_QUOTED.sub(quote, text).strip(), mode="eval").body
+        except SyntaxError:
+            raise ValueError("Invalid expression: {}".format(text))
+        self._names = {}
+        self._numexpr = numexpr is not None
+        self._check(tree, quoted, columns)
+        self.columns = list(dict.fromkeys(self._names.values()))
+        unknown = [name for name in self.columns if columns is not None and name not in columns]
+        if unknown:
+            raise ValueError("Unknown columns {} in expression: {}".format(unknown, text))
+        self._tree = tree
+        self.column = self.columns[0] if isinstance(tree, ast.Name) else None
+        if self._numexpr and self.column is None:
+            self._source = ast.unparse(tree)
+
+    def _check(self, node, quoted, columns):
+        "Check that only the supported nodes are in a tree, recording the column names"
+        if isinstance(node, ast.Name):
+            if node.id in CONSTANTS and (columns is None or node.id not in columns):
+                return
+            match = re.match(r"^_quoted(\d+)$", node.id)
+            self._names[node.id] = quoted[int(match.group(1))] if match else node.id
+        elif isinstance(node, ast.Constant):
+            if isinstance(node.value, str):
+                self._numexpr = False
+            elif not isinstance(node.value, (int, float, bool)):
+                raise ValueError("Unsupported constant {!r} in: {}".format(node.value, self.text))
+        elif isinstance(node, ast.BinOp) and type(node.op) in OPERATORS:
+            self._numexpr &= not isinstance(node.op, (ast.FloorDiv,) + LOGICAL_OPERATORS)
+            self._check(node.left, quoted, columns)
+            self._check(node.right, quoted, columns)
+        elif isinstance(node, ast.UnaryOp) and type(node.op) in OPERATORS:
+            self._numexpr &= not isinstance(node.op, LOGICAL_OPERATORS)
+            self._check(node.operand, quoted, columns)
+        elif isinstance(node, ast.Compare) and len(node.ops) == 1 \
+             and type(node.ops[0]) in OPERATORS:
+            self._check(node.left, quoted, columns)
+            self._check(node.comparators[0], quoted, columns)
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name) \
+             and node.func.id in FUNCTIONS and not node.keywords:
+            self._numexpr &= node.func.id in NUMEXPR_FUNCTIONS
+            for arg in node.args:
+                self._check(arg, quoted, columns)
+        else:
+            raise ValueError("Unsupported {} in expression: {}".format(
+                type(node).__name__, self.text))
+
+    def __str__(self):
+        return self.text
+
+    def __repr__(self):
+        return "Expression(%r)"%self.text
+
+    def evaluate(self, df):
+        "Return the values of the expression for the rows of a data frame, as an array"
+        if self.column is not None:
+            return df[self.column].values
+        arrays = {name: df[column].values for (name, column) in self._names.items()}
+        if self._numexpr and all(array.dtype in NUMEXPR_DTYPES for array in arrays.values()):
+            return numexpr.evaluate(self._source, local_dict=dict(CONSTANTS, **arrays))
+        return self._evaluate(self._tree, arrays)
+
+    def _evaluate(self, node, arrays):
+        if isinstance(node, ast.Name):
+            return arrays[node.id] if node.id in arrays else CONSTANTS[node.id]
+        if isinstance(node, ast.Constant):
+            return node.value
+        if isinstance(node, ast.BinOp):
+            return OPERATORS[type(node.op)](self._evaluate(node.left, arrays),
+                                            self._evaluate(node.right, arrays))
+        if isinstance(node, ast.UnaryOp):
+            return OPERATORS[type(node.op)](self._evaluate(node.operand, arrays))
+        if isinstance(node, ast.Compare):
+            return OPERATORS[type(node.ops[0])](self._evaluate(node.left, arrays),
+                                                self._evaluate(node.comparators[0], arrays))
+        return FUNCTIONS[node.func.id](*[self._evaluate(arg, arrays) for arg in node.args])
+
+    def categorize(self, df):
+        """
+        Return the categories of the values of the expression in a data frame,
+        and their codes; with buckets, the categories are their labels
+        """
+        if self.buckets is not None:
+            return self.buckets.labels, self.buckets.codes(self.evaluate(df))
+        values = df[self.column] if self.column is not None else self.evaluate(df)
+        categorical = pd.Categorical(values)
+        return categorical.categories, categorical.codes
+
+
+def read_columns(*expressions):
+    "Return the columns to read to evaluate some expressions"
+    return list(dict.fromkeys(column for expression in expressions
+                              for column in expression.columns))
+
+
+def statistics_columns(x, y, source_projection=None, projection=None):
+    "Return the x and y expressions, and their projected columns, of the statistics"
+    px, py = projected_columns(x, y, source_projection, projection)
+    return list(dict.fromkeys([str(x), str(y), px, py]))
+
+
+def evaluate_xy(df, x, y, stats, profiler, index=None,
+                source_projection=None, projection=None, threads=1):
+    """
+    Return the x and y values of the rows of a chunk, projected from
+    source_projection to projection by threads, and add them to stats
+    """
+    with profiler.stage("evaluate", index=index, rows=len(df)):
+        xs, ys = x.evaluate(df), y.evaluate(df)
+    with profiler.stage("project", index=index, rows=len(df)):
+        pxs, pys = project_values(xs, ys, source_projection, projection, threads)
+    with profiler.stage("stats", index=index, rows=len(df)):
+        px, py = projected_columns(x, y, source_projection, projection)
+        stats.update(df, {str(x): xs, str(y): ys, px: pxs, py: pys})
+    return pxs, pys
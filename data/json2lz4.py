@@ -1,29 +1,50 @@
 #!/usr/bin/env python
 
-import os.path
-import json
-import gzip
 import numpy as np
 import lz4.frame
+from databuffer import json_buffer_root, read_json_buffer, is_up_to_date, convert_buffers, \
+    ENCODINGS
+from lz4buffer import write_lz4_buffer, BAND_ROWS
 
-def json2lz4(fname):
-    root, ext = os.path.splitext(fname)
-    fopen = open
-    if ext == '.gz':
-        fopen = gzip.open
-        root, ext = os.path.splitext(root)
-    if ext != '.json':
-        raise ValueError('Not a json file (%s): %s'%(ext, fname))
-    with fopen(fname, 'r') as injson:
-        histo = np.array(json.load(injson), dtype=np.int32)
-        linear = histo.ravel()
+def json2lz4(fname, force=False, band_rows=BAND_ROWS, threads=None, encoding=None):
+    """
+    Compress a json data buffer in a .lz4 buffer file by bands of band_rows
+    rows, in the smallest dtype that fits and with an optional row encoding
+    (see lz4buffer.py), or in a single raw int32 lz4 frame when band_rows is 0
+    """
+    outname = json_buffer_root(fname)+'.lz4'
+    if not force and is_up_to_date(fname, outname):
+        return None
+    histo = read_json_buffer(fname)
+    if band_rows:
+        write_lz4_buffer(outname, histo, band_rows, threads, encoding=encoding)
+        return outname
+    linear = histo.astype(np.int32).ravel()
     compressed = lz4.frame.compress(linear,
                                     compression_level=lz4.frame.COMPRESSIONLEVEL_MINHC)
-    outname = root+'.lz4'
     with open(outname, mode='wb') as outlz4:
         outlz4.write(compressed)
+    return outname
 
 if __name__ == '__main__':
-    import sys
-    for arg in sys.argv[1:]:
-        json2lz4(arg)
+    import argparse
+    from functools import partial
+
+    parser = argparse.ArgumentParser(description='Compress json data buffers with lz4')
+    parser.add_argument('paths', nargs='+',
+                        help='json data buffers, or directories of _cat_*.json buffers')
+    parser.add_argument('--jobs', type=int, default=1, nargs='?',
+                        help='number of processes converting the buffers')
+    parser.add_argument('--force', action='store_true',
+                        help='convert the buffers even when their .lz4 file is newer')
+    parser.add_argument('--band-rows', type=int, default=BAND_ROWS, nargs='?',
+                        help='rows per compressed band, 0 for a single raw lz4 frame')
+    parser.add_argument('--threads', type=int, default=None, nargs='?',
+                        help='number of threads compressing the bands of a buffer')
+    parser.add_argument('--encoding', default=None, choices=ENCODINGS[1:],
+                        help='encode the rows as differences with the previous row, zigzag mapped to unsigned integers or not')
+    args = parser.parse_args()
+    convert = partial(json2lz4, band_rows=args.band_rows, threads=args.threads,
+                      encoding=args.encoding)
+    for outname in convert_buffers(convert, args.paths, jobs=args.jobs, force=args.force):
+        print(outname)
@@ -1,29 +1,30 @@
 #!/usr/bin/env python
 
-import os.path
-import json
-import gzip
 import numpy as np
 from PIL import Image
-from scipy.misc import toimage
-from scipy.special import cbrt
+from databuffer import json_buffer_root, read_json_buffer, is_up_to_date, convert_buffers
 
-def json2png(fname):
-    root, ext = os.path.splitext(fname)
-    fopen = open
-    if ext == '.gz':
-        fopen = gzip.open
-        root, ext = os.path.splitext(root)
-    if ext != '.json':
-        raise ValueError('Not a json file (%s): %s'%(ext, fname))
-    with fopen(fname, 'r') as injson:
-        histo = np.array(json.load(injson))
-    histo = cbrt(histo)
-    image = toimage(histo, high=65536, low=0, mode='I')
+def json2png(fname, force=False):
+    outname = json_buffer_root(fname)+'.png'
+    if not force and is_up_to_date(fname, outname):
+        return None
+    histo = read_json_buffer(fname)
+    histo = np.cbrt(histo, out=histo)
+    image = Image.fromarray(histo.astype(np.uint16))
     # image = image.transpose(Image.FLIP_TOP_BOTTOM)
-    image.save(root+'.png', format='PNG', bits=16)
+    image.save(outname, format='PNG')
+    return outname
 
 if __name__ == '__main__':
-    import sys
-    for arg in sys.argv[1:]:
-        json2png(arg)
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Save json data buffers as 16 bits PNG images')
+    parser.add_argument('paths', nargs='+',
+                        help='json data buffers, or directories of _cat_*.json buffers')
+    parser.add_argument('--jobs', type=int, default=1, nargs='?',
+                        help='number of processes converting the buffers')
+    parser.add_argument('--force', action='store_true',
+                        help='convert the buffers even when their .png file is newer')
+    args = parser.parse_args()
+    for outname in convert_buffers(json2png, args.paths, jobs=args.jobs, force=args.force):
+        print(outname)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""
+Read and write data buffers compressed with lz4 by bands of rows.
+
+A .lz4 buffer file has the layout of the binary data buffers:
+- 4 bytes: the magic string MDLZ
+- 4 bytes: the length of the header, as a little-endian uint32
+- the header, a json object with the dtype and shape (height, width) of the
+  buffer, the number of rows per band (bandRows), the encoding of the rows
+  (see databuffer.encode_rows), and the offset and size of each compressed
+  band from the start of the data, padded to 64 bytes
+- the bands, each one an independent lz4 frame of bandRows rows
+so that a range of rows can be read by decompressing only its bands.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import lz4.frame
+from databuffer import write_header, read_header, encode_rows, decode_rows
+
+MAGIC = b"MDLZ"
+BAND_ROWS = 64
+
+
+def write_lz4_buffer(filename, histo, band_rows=BAND_ROWS, threads=None,
+                     compression_level=lz4.frame.COMPRESSIONLEVEL_MINHC,
+                     encoding=None):
+    """
+    Compress a 2D histogram by bands of band_rows rows in threads (lz4
+    releases the GIL) and write them with their index in filename.
+    The rows are stored in the smallest dtype that fits, after encoding.
+    """
+    histo = encode_rows(np.asarray(histo), encoding, band_rows)
+    histo = np.ascontiguousarray(histo, dtype=histo.dtype.newbyteorder("<"))
+    bands = [histo[start:start + band_rows] for start in range(0, len(histo), band_rows)]
+    with ThreadPoolExecutor(threads) as executor:
+        compressed = list(executor.map(
+            lambda band: lz4.frame.compress(band, compression_level=compression_level),
+            bands))
+    index = []
+    offset = 0
+    for data in compressed:
+        index.append([offset, len(data)])
+        offset += len(data)
+    header = {"dtype": histo.dtype.str,
+              "shape": list(histo.shape),
+              "bandRows": band_rows,
+              "encoding": encoding,
+              "bands": index}
+    with open(filename, "wb") as outf:
+        write_header(outf, header, MAGIC)
+        for data in compressed:
+            outf.write(data)
+
+
+def read_lz4_header(filename):
+    "Read the header of a .lz4 buffer file, adding the offset of the data"
+    return read_header(filename, MAGIC)
+
+
+def read_lz4_rows(filename, start=0, stop=None, threads=None, header=None):
+    """
+    Read the rows [start, stop) of a .lz4 buffer file, decompressing and
+    decoding only the bands that hold them, in threads
+    """
+    if header is None:
+        header = read_lz4_header(filename)
+    dtype = np.dtype(header["dtype"])
+    encoding = header.get("encoding")
+    height, width = header["shape"]
+    band_rows = header["bandRows"]
+    start, stop, _ = slice(start, stop).indices(height)
+    stop = max(start, stop)
+    first = start // band_rows
+    last = -(-stop // band_rows)
+    bands = header["bands"][first:last]
+    with open(filename, "rb") as inf:
+        data = []
+        for (offset, size) in bands:
+            inf.seek(header["offset"] + offset)
+            data.append(inf.read(size))
+    rows = np.empty((stop - start, width), dtype=np.int64 if encoding else dtype)
+
+    def decompress(i):
+        band = np.frombuffer(lz4.frame.decompress(data[i]), dtype=dtype).reshape(-1, width)
+        band = decode_rows(band, encoding)
+        row = (first + i) * band_rows
+        lo, hi = max(start, row), min(stop, row + len(band))
+        rows[lo - start:hi - start] = band[lo - row:hi - row]
+    with ThreadPoolExecutor(threads) as executor:
+        list(executor.map(decompress, range(len(data))))
+    return rows
+
+
+def read_lz4_buffer(filename, threads=None):
+    "Read all the rows of a .lz4 buffer file"
+    return read_lz4_rows(filename, threads=threads)
+
+
+def compare_encodings(filenames, band_rows=BAND_ROWS, repeat=5):
+    """
+    Compress json data buffers as a single int32 frame (the former .lz4
+    files) and as .lz4 buffer files with each encoding, returning for each
+    buffer and encoding the compressed size and the time to read it back
+    """
+    import os
+    import time
+    import tempfile
+    from databuffer import read_json_buffer, is_integral, ENCODINGS
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        outname = os.path.join(directory, "buffer.lz4")
+        for filename in filenames:
+            histo = read_json_buffer(filename)
+            frame = lz4.frame.compress(histo.astype(np.int32),
+                                       compression_level=lz4.frame.COMPRESSIONLEVEL_MINHC)
+            start = time.perf_counter()
+            for _ in range(repeat):
+                np.frombuffer(lz4.frame.decompress(frame), dtype=np.int32)
+            results.append({"buffer": filename, "encoding": "int32 frame",
+                            "dtype": "<i4", "size": len(frame),
+                            "decode": (time.perf_counter() - start) / repeat})
+            # the row differences of non integral buffers are not encoded
+            for encoding in ENCODINGS if is_integral(histo) else [None]:
+                write_lz4_buffer(outname, histo, band_rows, encoding=encoding)
+                header = read_lz4_header(outname)
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    read_lz4_buffer(outname, threads=1)
+                results.append({"buffer": filename, "encoding": str(encoding),
+                                "dtype": header["dtype"], "size": os.path.getsize(outname),
+                                "decode": (time.perf_counter() - start) / repeat})
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compare the size and decoding time of the lz4 encodings of json data buffers")
+    parser.add_argument("buffers", nargs="+", help="json data buffers")
+    parser.add_argument("--band-rows", type=int, default=BAND_ROWS, nargs="?",
+                        help="rows per compressed band")
+    args = parser.parse_args()
+    for result in compare_encodings(args.buffers, args.band_rows):
+        print("%-34s %-12s %4s %10d bytes %8.2f ms"%(
+            result["buffer"], result["encoding"], result["dtype"], result["size"],
+            result["decode"] * 1000))
@@ -1,16 +1,42 @@
 #!/usr/bin/env python
 
-import json
+import multiprocessing
+from contextlib import nullcontext
 import numpy as np
+from databuffer import write_databuffers, FORMATS, SPARSE_DENSITY
+from binning import histogram_cube
 
-def mn2json(root, size, width, height, means, cov, bounds, sample_size = 1000):
+def sample_block(task):
+    """
+    Draw a block of samples from a Gaussian with its own random stream and
+    bin them, returning the class index, the block index, the histogram and
+    the first samples
+    """
+    (i, block, mean, cov, size, entropy, bins, bounds, sample_size) = task
+    # the stream only depends on the seed, the class and the block
+    rng = np.random.Generator(np.random.PCG64(
+        np.random.SeedSequence(entropy, spawn_key=(i, block))))
+    dataset = rng.multivariate_normal(mean, cov, size=size)
+    histo = histogram_cube(dataset[:,0], dataset[:,1], None, 1,
+                           bins, bounds)[0]
+    return i, block, histo, dataset[:sample_size]
+
+def mn2json(root, size, width, height, means, cov, bounds, sample_size = 1000,
+            buffer_format='json', seed=None, block_size=1000000, jobs=1,
+            sparse=None):
     """
     mn2json('mn', 100000, 256, 256,
             [[-1, -1], [1, -1], [-1, 1], [1, 1]],
             [[3, 0], [3, 0]], [[-7, 7], [-7, 7]])
+
+    The samples are drawn and binned by blocks of block_size points, in jobs
+    processes, each block with its own random stream. For a given seed and
+    block_size, the buffers are the same whatever the number of jobs.
     """
-    description = {'source': {"program": "mn2json", "type": "python"}}
-    cov = np.array(cov, dtype=np.float)
+    entropy = np.random.SeedSequence(seed).entropy
+    description = {'source': {"program": "mn2json", "type": "python",
+                              "seed": entropy}}
+    cov = np.array(cov, dtype=np.float64)
     x = 'x'
     y = 'y'
     category = 'category'
@@ -26,29 +52,29 @@ def mn2json(root, size, width, height, means, cov, bounds, sample_size = 1000):
     histograms = {}
     counts = {}
     values = [str(i+1) for i in range(len(means))]
-    samples = []
+    samples = [None] * len(means)
+    tasks = []
 
     for i, mean in enumerate(means):
-        mean = np.array(mean, dtype=np.float)
-        dataset = np.random.multivariate_normal(mean, cov, size=size)
-        samples.append(dataset[:sample_size])
+        mean = np.array(mean, dtype=np.float64)
+        for block, start in enumerate(range(0, size, block_size)):
+            tasks.append((i, block, mean, cov, min(block_size, size - start),
+                          entropy, bins, bounds, sample_size))
+        histograms[values[i]] = np.zeros((height, width), dtype=np.int64)
 
-        (histo, xedges, yedges) = np.histogram2d(dataset[:,0], dataset[:,1],
-                                                 normed=False,
-                                                 bins=bins, range=bounds)
-        if isinstance(bins, list):
-            if (xedges != bins[0]).any():
-                print('X Edges differ: %s'%xedges)
-                bins = [xedges, yedges]
-            if (yedges != bins[1]).any():
-                print('Y Edges differ: %s'%yedges)
-                bins = [xedges, yedges]
+    # the pool is terminated even when a block raises
+    with multiprocessing.Pool(jobs) if jobs > 1 else nullcontext() as pool:
+        if pool is None:
+            blocks = map(sample_block, tasks)
         else:
-            bins = [xedges, yedges]
-        key = values[i]
-        histograms[key] = histo
-        count = histo.sum()
-        counts[key] = count
+            blocks = pool.imap_unordered(sample_block, tasks)
+        for (i, block, histo, sample) in blocks:
+            histograms[values[i]] += histo
+            if block == 0:
+                samples[i] = sample
+
+    for key in values:
+        counts[key] = int(histograms[key].sum())
 
     xtype = "quantitative"
     ytype = "quantitative"
@@ -82,27 +108,8 @@ def mn2json(root, size, width, height, means, cov, bounds, sample_size = 1000):
                   }
              }
         }
-    print('Writing files')
-    count = 0
-    buffers = []
-    for (key, histo) in histograms.items():
-        histo = histo.T
-        histo = np.flipud(histo)
-        hmin = np.min(histo)
-        hmax = np.max(histo)
-        outfile = root + '_cat_%s.json'%key
-        with open(outfile, 'w') as outf:
-            json.dump(histo.tolist(), outf)
-        data = {'url': outfile,
-                'count': counts[key],
-                'value': key,
-                'range': [int(hmin), int(hmax)]}
-        buffers.append(data)
-        count += counts[key]
-    description['buffers'] = buffers
-    description['source']['rows'] = count
-    with open(root + '_data.json', 'w') as outf:
-        json.dump(description, outf, indent=2)
+    write_databuffers(root, description, histograms, counts, buffer_format,
+                      sparse=sparse)
 
     with open(root + '_sample.txt', 'w') as outf:
         for i, sample in enumerate(samples):
@@ -110,6 +117,29 @@ def mn2json(root, size, width, height, means, cov, bounds, sample_size = 1000):
                 print("{} {} {}".format(i, s[0], s[1]), file=outf)
 
 if __name__ == "__main__":
-    mn2json('mn', 10000000, 256, 256,
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Compute data buffers from samples of 4 Gaussians')
+    parser.add_argument('--size', type=int, default=10000000, nargs='?',
+                        help='number of samples per Gaussian')
+    parser.add_argument('--width', type=int, default=256, nargs='?',
+                        help='width of the binned image')
+    parser.add_argument('--height', type=int, default=256, nargs='?',
+                        help='height of the binned image')
+    parser.add_argument('--seed', type=int, default=None, nargs='?',
+                        help='seed of the random generator, for reproducible buffers')
+    parser.add_argument('--blocksize', type=int, default=1000000, nargs='?',
+                        help='number of samples drawn and binned at once')
+    parser.add_argument('--jobs', type=int, default=1, nargs='?',
+                        help='number of processes drawing the samples in parallel')
+    parser.add_argument('--format', dest='buffer_format', default='json', choices=FORMATS,
+                        help='format of the data buffers')
+    parser.add_argument('--sparse', type=float, default=None, nargs='?', const=SPARSE_DENSITY,
+                        help='write the json and binary buffers with at most this fraction of non-empty bins (%g by default) as sparse buffers'%SPARSE_DENSITY)
+    args = parser.parse_args()
+    print('args: %s'%args)
+    mn2json('mn', args.size, args.width, args.height,
             [[-1, -1], [1, -1], [-1, 1], [1, 1]],
-            [[3, 0], [0, 3]], [[-7, 7], [-7, 7]])
+            [[3, 0], [0, 3]], [[-7, 7], [-7, 7]],
+            buffer_format=args.buffer_format, seed=args.seed,
+            block_size=args.blocksize, jobs=args.jobs, sparse=args.sparse)
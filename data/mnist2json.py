@@ -1,54 +1,48 @@
 #!/usr/bin/env python
 
 import os.path
-import json
 import numpy as np
+import pandas as pd
+from databuffer import write_databuffers, FORMATS, SPARSE_DENSITY
+from binning import histogram_cube, class_counts
+from profiler import Profiler
 
 def read_embedding(filename):
-    inf = open(filename)
-    points = []
-
-    for line in inf.readlines():
-        line = line.strip()
-        x, y = line.split(' ')
-        points.append((float(x), float(y)))
-    
-    inf.close()
-
-    return points
+    "Read the x y lines of an embedding into an array of shape (n, 2)"
+    df = pd.read_csv(filename, sep=r'\s+', header=None, usecols=[0, 1],
+                     dtype=np.float64)
+    return df.values
 
 def read_labels(filename):
-    inf = open(filename)
-    labels = []
-
-    for line in inf.readlines():
-        line = line.strip()
-        labels.append(int(line))
-
-    return labels
+    "Read one label per line into an array"
+    df = pd.read_csv(filename, sep=r'\s+', header=None, usecols=[0])
+    return df[0].values
 
 
 def mnist_to_databuffers(filename, category, width=512, height=None,
-                       xmin=None, ymin=None, xmax=None, ymax=None):
-
-    get_x = lambda x: x[0]
-    get_y = lambda x: x[1]
+                       xmin=None, ymin=None, xmax=None, ymax=None,
+                       buffer_format='json', profile=False, sparse=None):
 
     root, ext = os.path.splitext(filename)
 
     description = {'source': {"filename": filename, "type": "txt"}}
 
-    embedding = read_embedding(filename)
-    labels = read_labels(category)
+    profiler = Profiler(profile)
+    with profiler.stage('read') as record:
+        embedding = read_embedding(filename)
+        labels = read_labels(category)
+        record['rows'] = len(embedding)
+    if len(labels) != len(embedding):
+        raise ValueError('Expected %d labels, got %d'%(len(embedding), len(labels)))
 
     if xmin is None:
-        xmin = min(map(get_x, embedding))
+        xmin = embedding[:, 0].min()
     if ymin is None:
-        ymin = min(map(get_y, embedding))
+        ymin = embedding[:, 1].min()
     if xmax is None:
-        xmax = max(map(get_x, embedding))
+        xmax = embedding[:, 0].max()
     if ymax is None:
-        ymax = max(map(get_y, embedding))
+        ymax = embedding[:, 1].max()
 
     xy_range = [[float(xmin), float(xmax)], [float(ymin), float(ymax)]]
     if ymax == ymin or xmax == xmin:
@@ -63,30 +57,18 @@ def mnist_to_databuffers(filename, category, width=512, height=None,
 
     histograms = {}
     counts = {}
-    num_digits = 10
-
-    for i in range(num_digits):
-        points_i = []
-
-        for j, point in enumerate(embedding):
-            if labels[j] == i:
-                points_i.append(point)
-
-        (histo, xedges, yedges) = np.histogram2d(list(map(get_x, points_i)), list(map(get_y, points_i)),
-                                                 normed=False,
-                                                 bins=bins, range=xy_range)
-        if isinstance(bins, list):
-            if (xedges != bins[0]).any():
-                print('X Edges differ: %s'%xedges)
-                bins = [xedges, yedges]
-            if (yedges != bins[1]).any():
-                print('Y Edges differ: %s'%yedges)
-                bins = [xedges, yedges]
-        else:
-            bins = [xedges, yedges]
-        
-        histograms[i] = histo
-        counts[i] = len(points_i)
+    with profiler.stage('categorize', rows=len(labels)):
+        values, codes = np.unique(labels, return_inverse=True)
+
+    with profiler.stage('bin', rows=len(embedding)):
+        cube = histogram_cube(embedding[:, 0], embedding[:, 1], codes, len(values),
+                              bins, xy_range)
+        totals = class_counts(codes, len(values))
+
+    for i, value in enumerate(values):
+        key = value.item() if isinstance(value, np.generic) else value
+        histograms[key] = cube[i]
+        counts[key] = int(totals[i])
 
     x = 'x'
     y = 'y'
@@ -124,27 +106,10 @@ def mnist_to_databuffers(filename, category, width=512, height=None,
              }
         }
 
-    print('Writing files')
-    count = 0
-    buffers = []
-    for (key, histo) in histograms.items():
-        histo = histo.T
-        histo = np.flipud(histo)
-        hmin = np.min(histo)
-        hmax = np.max(histo)
-        outfile = root + '_cat_%s.json'%key
-        with open(outfile, 'w') as outf:
-            json.dump(histo.tolist(), outf)
-        data = {'url': outfile,
-                'count': counts[key],
-                'value': key,
-                'range': [int(hmin), int(hmax)]}
-        buffers.append(data)
-        count += counts[key]
-    description['buffers'] = buffers
-    description['source']['rows'] = count
-    with open(root + '_data.json', 'w') as outf:
-        json.dump(description, outf, indent=2)
+    with profiler.stage('write'):
+        write_databuffers(root, description, histograms, counts, buffer_format,
+                          sparse=sparse)
+    profiler.write(root)
 
 
 if __name__ == '__main__':
@@ -152,7 +117,7 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='Compute heatmap from tsne result')
     parser.add_argument('infile', help='tsne embedding ')
-    parser.add_argument('category', help='tsne lables (MNIST digits)')
+    parser.add_argument('category', help='tsne labels (e.g., MNIST digits), one per line')
     parser.add_argument('--width', type=int, default=512, nargs='?',
                         help='width of the binned image')
     parser.add_argument('--height', type=int, default=None, nargs='?',
@@ -165,8 +130,16 @@ if __name__ == '__main__':
                         help='xmax of bbox')
     parser.add_argument('--ymax', type=float, default=None, nargs='?',
                         help='ymax of bbox')
+    parser.add_argument('--format', dest='buffer_format', default='json', choices=FORMATS,
+                        help='format of the data buffers')
+    parser.add_argument('--sparse', type=float, default=None, nargs='?', const=SPARSE_DENSITY,
+                        help='write the json and binary buffers with at most this fraction of non-empty bins (%g by default) as sparse buffers'%SPARSE_DENSITY)
+    parser.add_argument('--profile', action='store_true',
+                        help='write the time and memory of each stage in _profile.json')
     args = parser.parse_args()
     print('args: %s'%args)
     mnist_to_databuffers(args.infile, args.category,
                        width=args.width, height=args.height,
-                       xmin=args.xmin, xmax=args.xmax, ymin=args.ymin, ymax=args.ymax)
+                       xmin=args.xmin, xmax=args.xmax, ymin=args.ymin, ymax=args.ymax,
+                       buffer_format=args.buffer_format, profile=args.profile,
+                       sparse=args.sparse)
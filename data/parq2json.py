@@ -1,28 +1,208 @@
 #!/usr/bin/env python
 
 import os.path
-import json
+import multiprocessing
+from contextlib import nullcontext
 import numpy as np
-from fastparquet.util import check_column_names
 import fastparquet
-import pyproj
+from databuffer import write_databuffers, load_for_append, write_appended, schema_root, \
+    class_keys, schema_categories, FORMATS, SPARSE_DENSITY, QUANTILES
+from binning import histogram_cube, class_counts, merge_histograms, grid
+from cache import add_cache_arguments, cache_from_arguments
+from profiler import Profiler
+from stats import Statistics, load_stats, save_stats, stats_path
+from projection import projected_columns, to_lonlat
+from expressions import Expression, read_columns, statistics_columns, evaluate_xy
+from buckets import category_buckets, add_bucket_arguments
+from tiling import add_rebin_arguments, rebin_from_arguments
+from smoothing import add_smooth_arguments, smooth_from_arguments
+
+def row_groups_statistics(pf, row_groups, x, y, source_projection=None, projection=None,
+                          threads=1, profiler=None, first=0):
+    """
+    Compute the statistics of the x and y expressions, and of their
+    projection from source_projection to projection, over some row groups,
+    the first one having the index first in the file
+    """
+    profiler = profiler or Profiler(False)
+    stats = Statistics(statistics_columns(x, y, source_projection, projection))
+    for i, rg in enumerate(row_groups):
+        with profiler.stage("bounds", index=first + i) as record:
+            df = pf.read_row_group_file(rg, read_columns(x, y), [])
+            record["rows"] = len(df)
+        evaluate_xy(df, x, y, stats, profiler, first + i, source_projection, projection, threads)
+    return stats
+
+def merge_statistics(stats1, stats2):
+    return stats1.merge(stats2)
+
+def bin_row_groups(pf, row_groups, x, y, category, bins, xy_range,
+                   source_projection=None, projection=None, threads=1,
+                   profiler=None, first=0):
+    """
+    Compute the histograms and counts of each category, and the statistics
+    of the x and y expressions, of some row groups, the first one having the
+    index first in the file. With source_projection, x and y are projected
+    from it to projection before binning.
+    The categories of each row group are its own, so the histograms are
+    keyed by category and not by code.
+    """
+    profiler = profiler or Profiler(False)
+    histograms = {}
+    counts = {}
+    stats = Statistics(statistics_columns(x, y, source_projection, projection))
+    # a category column is read as a pandas categorical
+    categories = [category.column] if category.column is not None \
+        and category.buckets is None else []
+    for index, rg in enumerate(row_groups, first):
+        with profiler.stage("read", index=index) as record:
+            df = pf.read_row_group_file(rg, read_columns(x, y, category), categories)
+            record["rows"] = len(df)
+        print("Accessing row_group len=%d"%len(df))
+        xs, ys = evaluate_xy(df, x, y, stats, profiler, index, source_projection, projection,
+                             threads)
+        with profiler.stage("bin", index=index, rows=len(df)):
+            values, codes = category.categorize(df)
+            cube = histogram_cube(xs, ys, codes, len(values), bins, xy_range)
+            totals = class_counts(codes, len(values))
+        part = {}
+        part_counts = {}
+        for i, cat in enumerate(values):
+            part[cat] = cube[i]
+            part_counts[cat] = int(totals[i])
+        merge_histograms(histograms, counts, part, part_counts)
+    return histograms, counts, stats
+
+def _row_groups_task(task):
+    """
+    Run a function over a slice of the row groups in a worker process,
+    returning its result and the records of its profiler
+    """
+    (function, filename, start, stop, profile) = task[:5]
+    pf = fastparquet.ParquetFile(filename)
+    profiler = Profiler(profile)
+    result = function(pf, pf.row_groups[start:stop], *task[5:],
+                      profiler=profiler, first=start)
+    return result, profiler.records
+
+def _slices(count, jobs):
+    "Split range(count) into contiguous slices, a few per job"
+    step = max(1, -(-count // (jobs * 4)))
+    return [(start, min(start + step, count)) for start in range(0, count, step)]
+
+def _tree_reduce(function, parts):
+    "Merge an ordered list of partial results two by two"
+    while len(parts) > 1:
+        merged = [function(parts[i], parts[i+1]) for i in range(0, len(parts) - 1, 2)]
+        if len(parts) % 2:
+            merged.append(parts[-1])
+        parts = merged
+    return parts[0]
+
+def _merge_parts(part1, part2):
+    return merge_histograms(part1[0], part1[1], part2[0], part2[1]) + \
+        (part1[2].merge(part2[2]),)
+
+def parallel_row_groups(pool, jobs, profiler, function, filename, nrow_groups, *args):
+    """
+    Map function over slices of the row groups in a pool, returning the
+    ordered results and adding the records of the workers to profiler
+    """
+    tasks = [(function, filename, start, stop, profiler.enabled) + args
+             for (start, stop) in _slices(nrow_groups, jobs)]
+    results = []
+    for (result, records) in pool.map(_row_groups_task, tasks):
+        results.append(result)
+        profiler.records += records
+    return results
+
+def bin_parquet(pf, filename, x, y, category, bounds, width, height=None, jobs=1,
+                profiler=None, source_projection=None, projection=None, threads=1):
+    """
+    Bin the row groups of a parquet file in jobs processes, scanning them
+    for the missing bounds [xmin, ymin, xmax, ymax]. With source_projection,
+    x and y are projected from it to projection by threads in each process
+    before binning, and the bounds are projected ones. Return the histograms
+    and counts of each category, the range and bins of the binning, and the
+    statistics of the file, computed while binning.
+    """
+    profiler = profiler or Profiler(False)
+    projections = (source_projection, projection, threads)
+    # the pool is terminated even when the scan or a worker raises
+    with multiprocessing.Pool(jobs) if jobs > 1 else nullcontext() as pool:
+        if None in bounds:
+            print("Incomplete stats, computing min/max")
+            if pool is None:
+                scanned = row_groups_statistics(pf, pf.row_groups, x, y, *projections,
+                                                profiler=profiler)
+            else:
+                scanned = _tree_reduce(merge_statistics,
+                                       parallel_row_groups(pool, jobs, profiler,
+                                                           row_groups_statistics,
+                                                           filename, len(pf.row_groups),
+                                                           x, y, *projections))
+            scanned = scanned.bounds(*projected_columns(x, y, source_projection, projection)) \
+                or [None] * 4
+            bounds = [s if b is None else b for (b, s) in zip(bounds, scanned)]
+        xy_range, bins = grid(bounds, width, height)
+        print("Range: %s, bins: %s"%(xy_range, bins))
+        if pool is None:
+            histograms, counts, stats = bin_row_groups(pf, pf.row_groups, x, y, category,
+                                                       bins, xy_range, *projections,
+                                                       profiler=profiler)
+        else:
+            parts = parallel_row_groups(pool, jobs, profiler, bin_row_groups,
+                                        filename, len(pf.row_groups),
+                                        x, y, category, bins, xy_range, *projections)
+    if pool is not None:
+        with profiler.stage("merge", count=len(parts)):
+            histograms, counts, stats = _tree_reduce(_merge_parts, parts)
+    stats.add_counts(str(category), counts)
+    return histograms, counts, xy_range, bins, stats
+
 
 def parquet_to_databuffers(filename, x, y, category, width=512, height=None,
                            xmin=None, ymin=None, xmax=None, ymax=None,
-                           projection=None):
-    proj = lambda x, y, inverse :  (x, y)
+                           projection=None, jobs=1, buffer_format="json",
+                           tile_size=None, append=None, profile=False, sparse=None,
+                           cache=None, source_projection=None, threads=1,
+                           catvalnum=None, catvalmin=None, catvalmax=None, catvaledges=None,
+                           catvalquantiles=False, rebin=None, smooth=None,
+                           quantiles=None):
     root, ext = os.path.splitext(filename)
     if ext != ".parq":
         raise ValueError("Expected a .parq file, got ({}) {}".format(ext, filename))
 
     pf = fastparquet.ParquetFile(filename)
-    check_column_names(pf.columns, [x, y, category]) # raise if columns not there
-    description = {"source": {"filename": filename, "type": "parquet"}}
-    if projection:
+    # raise if columns not there
+    expressions = [Expression(text, pf.columns) for text in (x, y, category)]
+    profiler = Profiler(profile)
+    if append:
+        # reuse the bounds and bins of the existing buffers
+        (description, [xmin, ymin, xmax, ymax], (width, height),
+         previous, previous_counts) = load_for_append(append)
+    else:
+        description = {"source": {"filename": filename, "type": "parquet"}}
+    if projection and not append:
         description["projection"] = {"type": projection}
-        proj = pyproj.Proj(init=projection, preserve_units=True)
+    if append and "projection" in description:
+        projection = description["projection"]["type"]
+    if source_projection:
+        if not projection:
+            raise ValueError("A --projection is required to project from {}".format(source_projection))
+        description["source"]["projection"] = source_projection
+    if append and "bin" in description["encoding"]["z"] and not catvaledges:
+        # the classes of a numeric category keep their edges
+        catvaledges = description["encoding"]["z"]["bin"]["edges"]
+    category_expr = expressions[2]
+    chunks = (pf.read_row_group_file(rg, category_expr.columns, []) for rg in pf.row_groups)
+    buckets = category_buckets(category_expr, catvalnum, catvalmin, catvalmax, catvaledges,
+                               catvalquantiles, profiler.iterate("buckets", chunks))
+    category_expr.buckets = buckets
 
-    stats = pf.statistics
+    # the statistics of the file are only those of plain, unprojected columns
+    plain = not source_projection and all(e.column is not None for e in expressions[:2])
+    stats = pf.statistics if plain else {}
 
     if "max" in stats:
         if xmax is None:
@@ -35,84 +215,65 @@ def parquet_to_databuffers(filename, x, y, category, width=512, height=None,
         if ymin is None:
             ymin = np.min(stats["min"][y])
 
-    if xmin is None or xmax is None or ymin is None or ymax is None:
-        compute_xmin = (xmin is None)
-        compute_xmax = (xmax is None)
-        compute_ymin = (ymin is None)
-        compute_ymax = (ymax is None)
-        print("Incomplete stats, computing min/max")
-        for df in pf.iter_row_groups(columns=[x, y]):
-            if compute_xmin:
-                if xmin is None:
-                    xmin = df[x].min()
-                else:
-                    xmin = np.min([xmin, df[x].min()])
-            if compute_ymin:
-                if ymin is None:
-                    ymin = df[y].min()
-                else:
-                    ymin = np.min([ymin, df[y].min()])
-            if compute_xmax:
-                if xmax is None:
-                    xmax = df[x].max()
-                else:
-                    xmax = np.max([xmax, df[x].max()])
-            if compute_ymax:
-                if ymax is None:
-                    ymax = df[y].max()
-                else:
-                    ymax = np.max([ymax, df[y].max()])
-    xy_range = [[float(xmin), float(xmax)], [float(ymin), float(ymax)]]
-    if ymax == ymin or xmax == xmin:
-        raise ValueError("Invalid bounds: {}".format(xy_range))
-    if height is None:
-        ratio = (ymax - ymin) / (xmax - xmin)
-        height = int(width * ratio)
-    bins = (width, height)
-    # description["bounds"] = xy_range
-    # description["bins"] = list(bins)
-    print("Range: %s, bins: %s"%(xy_range, bins))
+    bounds = [xmin, ymin, xmax, ymax]
+    if None in bounds:
+        # reuse the statistics of a previous conversion of the file
+        known = load_stats(filename)
+        known = known and known.bounds(*projected_columns(x, y, source_projection, projection))
+        if known:
+            print("Using the bounds of %s"%stats_path(filename))
+            bounds = [k if b is None else b for (b, k) in zip(bounds, known)]
+    cached = None
+    if cache and not append:
+        source = cache.source(filename, program="parq2json", x=x, y=y, category=category,
+                              source_projection=source_projection, projection=projection,
+                              buckets=buckets and buckets.to_json())
+        if None not in bounds:
+            xy_range, bins = grid(bounds, width, height)
+            cached = cache.lookup(source, bins, xy_range)
+    if cached:
+        cat_histograms, cat_counts = cached
+    else:
+        (cat_histograms, cat_counts,
+         xy_range, bins, stats) = bin_parquet(pf, filename, *expressions, bounds,
+                                              width, height, jobs, profiler,
+                                              source_projection, projection, threads)
+        save_stats(filename, stats)
+        if cache and not append:
+            cache.store(source, bins, xy_range, cat_histograms, cat_counts)
+    (xmin, xmax), (ymin, ymax) = xy_range
+    width, height = bins
+
     histograms = {}
     counts = {}
+    # the buckets stay in the order of their values, and the appended
+    # categories keep the keys of their buffers
+    cats = buckets.labels if buckets else sorted(cat_histograms)
+    keys, categories = class_keys(cats, all(isinstance(cat, str) for cat in cats),
+                                  schema_categories(description) if append else None)
+    for (key, cat) in zip(keys, cats):
+        histograms[key] = cat_histograms[cat]
+        counts[key] = cat_counts[cat]
 
-    for df in pf.iter_row_groups(columns=[x, y, category], categories=[category]):
-        print("Accessing row_group len=%d"%len(df))
-        values = df[category].cat.categories
-        cat_column = df[category]
-        for i, cat in enumerate(values):
-            df_cat = df.loc[cat_column == cat, [x, y]]
-            (histo, xedges, yedges) = np.histogram2d(df_cat[x], df_cat[y],
-                                                     normed=False,
-                                                     bins=bins, range=xy_range)
-            if isinstance(bins, list):
-                if (xedges != bins[0]).any():
-                    print("X Edges differ: %s"%xedges)
-                    bins = [xedges, yedges]
-                if (yedges != bins[1]).any():
-                    print("Y Edges differ: %s"%yedges)
-                    bins = [xedges, yedges]
-            else:
-                bins = [xedges, yedges]
-            if isinstance(cat, str):
-                key = cat
-            else:
-                key = i+1
-            if key in histograms:
-                histograms[key] += histo
-            else:
-                histograms[key] = histo
-            counts[key] = len(df_cat) + counts.get(key, 0)
+    if append:
+        with profiler.stage("write"):
+            write_appended(append, description, previous, previous_counts,
+                           histograms, counts, filename, tile_size, sparse, rebin, smooth,
+                           quantiles, dict(zip(keys, categories)))
+        profiler.write(schema_root(append))
+        return
 
     if projection:
-        xmin, ymin = proj(xmin, ymin, inverse=True)
-        xmax, ymax = proj(xmax, ymax, inverse=True)
+        # kept to append on the same edges, since the domains only round trip approximately
+        description["projection"]["bounds"] = [float(xmin), float(ymin), float(xmax), float(ymax)]
+        xmin, ymin = to_lonlat(xmin, ymin, projection)
+        xmax, ymax = to_lonlat(xmax, ymax, projection)
         xtype = "latitude"
         ytype = "longitude"
     else:
         xtype = "quantitative"
         ytype = "quantitative"
 
-    print(type(xmin), type(xmax))
     description["encoding"] = {
         "x": {"field": x,
               "type": xtype,
@@ -140,33 +301,18 @@ def parquet_to_databuffers(filename, x, y, category, width=512, height=None,
               "type": "nominal", # or ordinal
               "scale": {
                   "domain": list(histograms.keys())
-                  }
+                  },
+              "categories": categories
              }
         }
+    if buckets:
+        description["encoding"]["z"]["type"] = "ordinal"
+        description["encoding"]["z"]["bin"] = buckets.to_json()
 
-    print("Writing files")
-    count = 0
-    buffers = []
-    for (key, histo) in histograms.items():
-        histo = histo.T
-        histo = np.flipud(histo)
-        hmin = np.min(histo)
-        hmax = np.max(histo)
-        outfile = root + "_cat_%s.json"%key
-        with open(outfile, "w") as outf:
-            json.dump(histo.tolist(), outf)
-        data = {"url": outfile,
-                "count": counts[key],
-                "value": key,
-                "range": [int(hmin), int(hmax)]}
-        buffers.append(data)
-        count += counts[key]
-    description["buffers"] = buffers
-    description["source"]["rows"] = count
-    with open(root + "_data.json", "w") as outf:
-        json.dump(description, outf, indent=2)
-
-#parquet_to_databuffers("census.snappy.parq", "easting", "northing", "race")
+    with profiler.stage("write"):
+        write_databuffers(root, description, histograms, counts, buffer_format,
+                          tile_size, sparse, rebin, smooth, quantiles)
+    profiler.write(root)
 
 if __name__ == "__main__":
     import argparse
@@ -174,9 +320,9 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Compute data buffers from a parquet file")
     parser.add_argument("infile",
                         help="Input parquet file")
-    parser.add_argument("x", help="x column name")
-    parser.add_argument("y", help="y column name")
-    parser.add_argument("category", help="category column name")
+    parser.add_argument("x", help="x column name or expression, e.g., ARR_DELAY/DISTANCE")
+    parser.add_argument("y", help="y column name or expression")
+    parser.add_argument("category", help="category column name or expression")
     parser.add_argument("--width", type=int, default=512, nargs="?",
                         help="width of the binned image")
     parser.add_argument("--height", type=int, default=None, nargs="?",
@@ -191,9 +337,41 @@ if __name__ == "__main__":
                         help="ymax of bbox")
     parser.add_argument("--projection", default=None, nargs="?",
                         help="Geographic projection applied to these coordinates")
+    parser.add_argument("--source-projection", dest="source_projection", default=None, nargs="?",
+                        help="projection of the x and y columns, e.g., epsg:4326 for longitudes and latitudes, projected to --projection before binning")
+    parser.add_argument("--threads", type=int, default=1, nargs="?",
+                        help="number of threads projecting the coordinates in each process, and smoothing the buffers")
+    parser.add_argument("--jobs", type=int, default=1, nargs="?",
+                        help="number of processes binning the row groups in parallel")
+    parser.add_argument("--format", dest="buffer_format", default="json", choices=FORMATS,
+                        help="format of the data buffers")
+    parser.add_argument("--sparse", type=float, default=None, nargs="?", const=SPARSE_DENSITY,
+                        help="write the json and binary buffers with at most this fraction of non-empty bins (%g by default) as sparse buffers"%SPARSE_DENSITY)
+    parser.add_argument("--quantiles", type=int, default=None, nargs="?", const=QUANTILES,
+                        help="also write the quantiles of the non-empty bins of each buffer and of all of them, in this number of intervals (%d by default)"%QUANTILES)
+    parser.add_argument("--pyramid", dest="tile_size", type=int, default=None, nargs="?",
+                        help="also write a pyramid of tiles of this size")
+    parser.add_argument("--append", default=None, nargs="?",
+                        help="_data.json schema file of the buffers to add the rows into")
+    parser.add_argument("--profile", action="store_true",
+                        help="write the time and memory of each stage in _profile.json")
+    add_bucket_arguments(parser)
+    add_cache_arguments(parser)
+    add_rebin_arguments(parser)
+    add_smooth_arguments(parser)
     args = parser.parse_args()
     print("args: %s"%args)
     parquet_to_databuffers(args.infile, args.x, args.y, args.category,
                            width=args.width, height=args.height,
                            xmin=args.xmin, xmax=args.xmax, ymin=args.ymin, ymax=args.ymax,
-                           projection=args.projection)
+                           projection=args.projection, jobs=args.jobs,
+                           buffer_format=args.buffer_format, tile_size=args.tile_size,
+                           append=args.append, profile=args.profile, sparse=args.sparse,
+                           cache=cache_from_arguments(args),
+                           source_projection=args.source_projection, threads=args.threads,
+                           catvalnum=args.catvalnum, catvalmin=args.catvalmin,
+                           catvalmax=args.catvalmax, catvaledges=args.catvaledges,
+                           catvalquantiles=args.catvalquantiles,
+                           rebin=rebin_from_arguments(args),
+                           smooth=smooth_from_arguments(args),
+                           quantiles=args.quantiles)
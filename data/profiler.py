@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"Record the time, rows and memory of the stages of a conversion"
+
+import os
+import sys
+import json
+import time
+import resource
+from contextlib import contextmanager
+
+
+def peak_rss():
+    "Return the peak resident set size of this process in bytes"
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+class Profiler(object):
+    """
+    Record the wall time, CPU time, rows and peak RSS of each stage of a
+    conversion, e.g., reading or binning a chunk.
+    When disabled, stages are not measured.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.records = []
+        self.start = (time.perf_counter(), time.process_time())
+
+    def begin(self, name, **info):
+        "Start measuring a stage, returning its record"
+        record = dict(stage=name, **info)
+        if self.enabled:
+            record["wall"] = time.perf_counter()
+            record["cpu"] = time.process_time()
+        return record
+
+    def end(self, record):
+        "Stop measuring the stage of a record"
+        if not self.enabled:
+            return
+        record["wall"] = time.perf_counter() - record["wall"]
+        record["cpu"] = time.process_time() - record["cpu"]
+        record["peak_rss"] = peak_rss()
+        record["pid"] = os.getpid()
+        self.records.append(record)
+
+    @contextmanager
+    def stage(self, name, **info):
+        """
+        Measure the enclosed block as a stage; the block can set the "rows"
+        and other information of the yielded record
+        """
+        record = self.begin(name, **info)
+        yield record
+        self.end(record)
+
+    def iterate(self, name, iterable, rows=len):
+        "Measure getting each item of an iterable as a stage"
+        iterator = iter(iterable)
+        index = 0
+        while True:
+            record = self.begin(name, index=index)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            record["rows"] = rows(item)
+            self.end(record)
+            yield item
+            index += 1
+
+    def report(self):
+        "Return the records and their totals by stage"
+        stages = {}
+        for record in self.records:
+            total = stages.setdefault(record["stage"],
+                                      {"count": 0, "wall": 0, "cpu": 0, "rows": 0})
+            total["count"] += 1
+            total["wall"] += record["wall"]
+            total["cpu"] += record["cpu"]
+            total["rows"] += record.get("rows", 0)
+        return {"wall": time.perf_counter() - self.start[0],
+                "cpu": time.process_time() - self.start[1],
+                "peak_rss": peak_rss(),
+                "stages": stages,
+                "records": self.records}
+
+    def write(self, root):
+        "Write the report in root_profile.json, next to the schema file"
+        if not self.enabled:
+            return
+        with open(root + "_profile.json", "w") as outf:
+            json.dump(self.report(), outf, indent=2)
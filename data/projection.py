@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""
+Project coordinates between coordinate reference systems with pyproj.
+
+The transformers are created once per pair of systems and thread, and the
+coordinates are projected in large batches of NumPy arrays, optionally in
+several threads (pyproj releases the GIL while transforming).
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pyproj
+
+# the system of the longitudes and latitudes of the schema domains
+LONLAT = "epsg:4326"
+BATCH_SIZE = 1 << 20
+
+_local = threading.local()
+
+
+def transformer(source, target):
+    "Return the cached transformer from source to target of the current thread"
+    transformers = getattr(_local, "transformers", None)
+    if transformers is None:
+        transformers = _local.transformers = {}
+    key = (source, target)
+    if key not in transformers:
+        transformers[key] = pyproj.Transformer.from_crs(source, target, always_xy=True)
+    return transformers[key]
+
+
+def project(x, y, source, target, threads=1, batch_size=BATCH_SIZE):
+    """
+    Project the coordinates x, y from the source to the target system, by
+    batches of batch_size points in threads, returning two float64 arrays
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    px = np.empty_like(x)
+    py = np.empty_like(y)
+
+    def project_batch(start):
+        stop = start + batch_size
+        px[start:stop], py[start:stop] = transformer(source, target).transform(
+            x[start:stop], y[start:stop])
+    starts = range(0, len(x), batch_size)
+    if threads > 1 and len(starts) > 1:
+        with ThreadPoolExecutor(threads) as executor:
+            list(executor.map(project_batch, starts))
+    else:
+        for start in starts:
+            project_batch(start)
+    return px, py
+
+
+def to_lonlat(x, y, projection):
+    "Return the longitude and latitude of a point in a projection"
+    return transformer(projection, LONLAT).transform(x, y)
+
+
+def from_lonlat(lon, lat, projection):
+    "Return the coordinates in a projection of a longitude and latitude"
+    return transformer(LONLAT, projection).transform(lon, lat)
+
+
+def projected_columns(x, y, source=None, target=None):
+    "Return the names of the x and y columns once projected from source to target"
+    if not source:
+        return str(x), str(y)
+    return "%s@%s"%(x, target), "%s@%s"%(y, target)
+
+
+def project_values(x, y, source=None, target=None, threads=1):
+    "Return the x and y values projected from source to target, or as is without source"
+    if not source:
+        return x, y
+    if not target:
+        raise ValueError("A target projection is required to project from {}".format(source))
+    return project(x, y, source, target, threads)
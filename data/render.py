@@ -0,0 +1,422 @@
+#!/usr/bin/env python
+"""
+Render data buffers to PNG images with NumPy, without a browser.
+
+A specification (.mdm.json) or a schema file (_data.json) is rendered as the
+viewer does: the class buffers are styled, their counts are rescaled to
+[0, 1], mapped to colors between the color0 and color1 of each class, and
+assembled into one image. Each stage is computed at once over the whole cube
+of shape (classes, height, width) instead of pixel by pixel.
+The assemblies are none, mean, max, invmin, add, multiply, weaving (with
+the masks of weaving.py) and separate (the classes side by side); the
+rescales are linear, sqrt, cbrt, log and equidepth. The tiles of a rebin
+are drawn when the converter precomputed them (see tiling.py), and so are
+the gaussian preprocessings, with the buffers smoothed by the converter
+(see smoothing.py). As in the viewer, the first row of the buffers is the
+top of the image.
+"""
+
+import os
+import os.path
+import glob
+import re
+import json
+from functools import partial
+import numpy as np
+from PIL import Image
+from databuffer import load_buffers, buffer_path, is_up_to_date, convert_buffers
+from weaving import weaving_mask, weave
+from tiling import read_labels
+
+NONE = (0, 0, 0, 0)
+WHITE = (1, 1, 1, 1)
+
+
+def _rgb(r, g, b):
+    return (r / 255, g / 255, b / 255, 1)
+
+
+COLORS = {
+    "none": NONE,
+    "transparent": NONE,
+    "white": WHITE,
+    "black": (0, 0, 0, 1),
+    "blue": _rgb(31, 120, 180),
+    "orange": _rgb(255, 127, 0),
+    "green": _rgb(51, 160, 44),
+    "red": _rgb(211, 39, 40),
+    "purple": _rgb(148, 103, 189),
+    "brown": _rgb(140, 86, 75),
+    "pink": _rgb(227, 119, 194),
+    "gray": _rgb(127, 127, 127),
+    "yellow": _rgb(255, 240, 65),
+    "cyan": _rgb(0, 190, 255),
+    "magenta": _rgb(241, 31, 141),
+    "skyblue": _rgb(23, 190, 207),
+}
+CATEGORY10 = [COLORS[name] for name in ("blue", "orange", "green", "red", "purple",
+                                        "brown", "pink", "gray", "yellow", "skyblue")]
+
+ASSEMBLIES = ["none", "mean", "max", "invmin", "add", "multiply", "weaving", "separate"]
+SCALES = ["linear", "sqrt", "cbrt", "log", "equidepth"]
+
+
+def parse_color(name):
+    "Return the RGBA tuple in [0, 1] of a color name, rgba(), rgb() or #hex code"
+    code = name.strip().lower()
+    if code in COLORS:
+        return COLORS[code]
+    match = re.match(r"^rgba?\(([^)]*)\)$", code)
+    if match:
+        parts = [float(part) for part in match.group(1).split(",")]
+        if len(parts) in (3, 4):
+            return (parts[0] / 255, parts[1] / 255, parts[2] / 255,
+                    parts[3] if len(parts) == 4 else 1)
+    match = re.match(r"^#([0-9a-f]{3}|[0-9a-f]{6})$", code)
+    if match:
+        digits = match.group(1)
+        if len(digits) == 3:
+            digits = "".join(digit * 2 for digit in digits)
+        return _rgb(*[int(digits[i:i + 2], 16) for i in (0, 2, 4)])
+    raise ValueError("Unknown color: {}".format(name))
+
+
+def load_spec(filename):
+    """
+    Return a specification and the name of its schema file; a schema file
+    is rendered with an empty specification
+    """
+    with open(filename) as inf:
+        spec = json.load(inf)
+    if "buffers" in spec:
+        return {}, filename
+    url = spec["data"]["url"]
+    return spec, os.path.join(os.path.dirname(filename), url)
+
+
+def assembly_spec(spec):
+    "Return the assembly of a specification, with the old names of the viewer"
+    assembly = dict(spec.get("assembly") or spec.get("compose") or {})
+    if "mix" in assembly and "type" not in assembly:
+        assembly["type"] = assembly["mix"]
+    if "mixing" in assembly and "blending" not in assembly:
+        assembly["blending"] = assembly["mixing"]
+    kind = assembly.setdefault("type", "mean")
+    if kind in ("weavingrandom", "weavingsquare", "weavinghex", "weavingtri"):
+        assembly["type"] = "weaving"
+        assembly["shape"] = "square" if kind == "weavingrandom" else kind[len("weaving"):]
+        assembly["random"] = assembly.get("random", False) or kind == "weavingrandom"
+    elif kind == "weaving" and assembly.get("shape") == "random":
+        assembly["shape"] = "square"
+        assembly["random"] = True
+    elif kind == "blend":
+        assembly["type"] = {"multiplicative": "multiply",
+                            "additive": "add"}.get(assembly.get("blending"), kind)
+    return assembly
+
+
+def scale_spec(spec):
+    "Return the rescale of a specification"
+    scale = spec.get("rescale") or spec.get("style", {}).get("scale") or {}
+    return dict({"type": "linear", "levels": 4}, **scale)
+
+
+def reencoded(reencoding, values, channel):
+    """
+    Return the range of a channel (label or color) of a reencoding by class
+    value, when it covers every class, as the viewer does; the values are
+    the buffers' values in their domain, or taken in order without a domain
+    """
+    scale = (reencoding.get(channel) or {}).get("scale") or {}
+    domain = scale.get("domain") or (reencoding.get("label") or {}).get("scale", {}).get("domain")
+    scale_range = scale.get("range") or []
+    if len(scale_range) < len(values):
+        return {}
+    if not domain:
+        return dict(zip(values, scale_range))
+    domain = [str(value) for value in domain]
+    return {value: scale_range[domain.index(str(value))] for value in values
+            if str(value) in domain and domain.index(str(value)) < len(scale_range)}
+
+
+def style_classes(description, histograms, spec):
+    """
+    Return the names, the (classes, height, width) cube of counts, and the
+    color0 and color1 arrays of shape (classes, 4) of the styled classes;
+    the style of the classes overrides the labels and colors of the
+    reencoding
+    """
+    values = list(histograms.keys())
+    reencoding = spec.get("reencoding") or {}
+    labels = reencoded(reencoding, values, "label")
+    colors = reencoded(reencoding, values, "color")
+    names = [str(value) for value in values]
+    colors0 = [None] * len(values)
+    colors1 = [parse_color(colors[value]) if value in colors else None for value in values]
+    classes = spec.get("style", {}).get("classes")
+    if classes:
+        if len(classes) != len(values):
+            raise ValueError("The length of the classes does not match {} != {}".format(
+                len(classes), len(values)))
+        order = []
+        for cl in classes:
+            if str(cl["name"]) not in names:
+                raise ValueError("Cannot find a class buffer with name {}".format(cl["name"]))
+            order.append(names.index(str(cl["name"])))
+        values = [values[i] for i in order]
+        names = [str(cl.get("alias") or cl["name"]) for cl in classes]
+        colors0 = [parse_color(cl["color0"]) if cl.get("color0") else None for cl in classes]
+        colors1 = [parse_color(cl["color1"]) if cl.get("color1") else colors1[i]
+                   for (cl, i) in zip(classes, order)]
+    else:
+        names = [str(labels.get(value, name)) for (value, name) in zip(values, names)]
+    colors0 = [color or WHITE for color in colors0]
+    colors1 = [color or CATEGORY10[i % len(CATEGORY10)] for (i, color) in enumerate(colors1)]
+    cube = np.stack([np.asarray(histograms[value], dtype=np.float64) for value in values])
+    return names, cube, np.array(colors0, dtype=np.float64), np.array(colors1, dtype=np.float64)
+
+
+def _quiet(function):
+    "Return function computing without warnings, e.g., a division by a zero maximum"
+    def quiet(values):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return function(values)
+    return quiet
+
+
+def rescale(cube, scale):
+    """
+    Return a function mapping counts to [0, 1] with a scale spec over the
+    counts of a cube, and the domain of the scale; the log scale maps 0 to NaN
+    """
+    kind = scale["type"]
+    vmax = float(cube.max()) if cube.size else 0.0
+    if kind == "linear":
+        return _quiet(lambda v: np.clip(v / vmax, 0, 1)), (0, vmax)
+    if kind in ("sqrt", "cbrt"):
+        degree = 2 if kind == "sqrt" else 3
+        top = vmax ** (1 / degree)
+        return _quiet(lambda v: np.clip(np.power(v, 1 / degree) / top, 0, 1)), (0, vmax)
+    if kind == "log":
+        top = np.log(vmax) if vmax > 0 else np.nan
+        return _quiet(lambda v: np.clip(np.log(np.where(v == 0, np.nan, v)) / top, 0, 1)), \
+            (1, vmax)
+    if kind == "equidepth":
+        # the viewer seeds its digest with the domain, i.e., with vmax
+        levels = int(scale["levels"])
+        points = np.append(cube[cube > 0], vmax)
+        bounds = np.quantile(points, (np.arange(levels) + 1) / levels)[:levels - 1]
+
+        def equidepth(v):
+            t = np.searchsorted(bounds, v, side="right") / (levels - 1)
+            return np.where(v <= 0, 0.0, np.where(v >= vmax, 1.0, t))
+        return equidepth, (0, vmax)
+    raise ValueError("Unsupported rescale type: {}".format(kind))
+
+
+def color_map(colors0, colors1, t):
+    "Interpolate the colors of the classes of t, of shape (classes, ...), to RGBA"
+    shape = (len(colors0),) + (1,) * (t.ndim - 1) + (4,)
+    t = t[..., np.newaxis]
+    return colors0.reshape(shape) * (1 - t) + colors1.reshape(shape) * t
+
+
+def class_color(colors0, colors1, index, t):
+    "Return the RGBA colors of the classes of an index array at the rescaled values t"
+    t = t[..., np.newaxis]
+    return colors0[index] * (1 - t) + colors1[index] * t
+
+
+def assemble(cube, colors0, colors1, scale, assembly):
+    "Return the RGBA image of shape (height, width, 4) of a cube of counts"
+    kind = assembly["type"]
+    classes, height, width = cube.shape
+    transform, domain = rescale(cube, scale)
+    if kind == "none" or classes == 0:
+        return np.zeros((height, width, 4))
+    if kind == "separate":
+        return np.concatenate(list(color_map(colors0, colors1, transform(cube))), axis=1)
+    if kind == "mean":
+        nonzero = (cube != 0)[..., np.newaxis]
+        colors = color_map(colors0, colors1, transform(cube)) * cube[..., np.newaxis]
+        total = cube.sum(axis=0)[..., np.newaxis]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(total > 0, np.where(nonzero, colors, 0).sum(axis=0) / total, 0)
+    if kind == "add":
+        return np.array([0, 0, 0, 1]) + color_map(colors0, colors1, transform(cube)).sum(axis=0)
+    if kind == "multiply":
+        return color_map(colors0, colors1, transform(cube)).prod(axis=0)
+    if kind == "max":
+        index = cube.argmax(axis=0)
+        return class_color(colors0, colors1, index, transform(cube.max(axis=0)))
+    if kind == "invmin":
+        threshold = assembly.get("threshold", 1)
+        candidates = np.where(cube >= threshold, cube, np.inf)
+        index = candidates.argmin(axis=0)
+        best = candidates.min(axis=0)
+        found = np.isfinite(best)
+        index[~found] = 0
+        with np.errstate(invalid="ignore"):
+            t = transform(np.where(found, domain[1] - best, 0))
+        return class_color(colors0, colors1, index, t)
+    if kind == "weaving":
+        pattern = "random" if assembly.get("random") else assembly.get("shape", "square")
+        index = weaving_mask(width, height, pattern, classes, assembly.get("size", 8),
+                             xincr=assembly.get("xincr", 1))
+        return class_color(colors0, colors1, index, transform(weave(cube, index)))
+    raise ValueError("Unsupported assembly type: {}".format(kind))
+
+
+def to_rgba8(image, background=None):
+    """
+    Return an RGBA image in [0, 1] as uint8, clamped as by a canvas, over an
+    optional background color
+    """
+    image = np.clip(np.nan_to_num(image, nan=0.0), 0, 1)
+    if background is not None:
+        background = np.asarray(background, dtype=np.float64)
+        alpha = image[..., 3:]
+        bg_alpha = background[3] * (1 - alpha)
+        out_alpha = alpha + bg_alpha
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rgb = np.where(out_alpha > 0,
+                           (image[..., :3] * alpha + background[:3] * bg_alpha) / out_alpha, 0)
+        image = np.concatenate([rgb, out_alpha], axis=-1)
+    return np.rint(image * 255).astype(np.uint8)
+
+
+def rebinned(description, schema, histograms, rebin):
+    """
+    Return the histograms whose bins hold the aggregate of their tile, as
+    precomputed by the converters for the rebin spec, and the mask of the
+    bins outside the tiles
+    """
+    precomputed = description.get("rebin", {})
+    if any(precomputed.get(key) != value for (key, value) in rebin.items()
+           if key not in ("stroke", "url")):
+        raise ValueError("The rebin {} is not precomputed in {}".format(rebin, schema))
+    labels = read_labels(buffer_path(schema, precomputed["labels"]))
+    outside = labels < 0
+    return {buf["value"]: np.where(outside, 0, np.asarray(buf["tiles"])[labels])
+            for buf in description["buffers"]}, outside
+
+
+def smoothed_buffers(description, schema, bandwidth):
+    "Return the entries of the buffers smoothed by the converter with a bandwidth"
+    for level in description.get("smooth", {}).get("levels", []):
+        if level["bandwidth"] == bandwidth:
+            return level["buffers"]
+    raise ValueError("The gaussian {} is not precomputed in {}".format(bandwidth, schema))
+
+
+def render(filename, assembly=None, scale=None, background=None, flip=False,
+           gaussian=None):
+    """
+    Render a specification or schema file, returning an RGBA uint8 array;
+    assembly, scale, background and the bandwidth of the gaussian
+    preprocessing override those of the specification
+    """
+    spec, schema = load_spec(filename)
+    with open(schema) as inf:
+        description = json.load(inf)
+    gaussian = gaussian or (spec.get("preprocess") or {}).get("gaussian")
+    buffers = smoothed_buffers(description, schema, gaussian) if gaussian else \
+        description["buffers"]
+    histograms = load_buffers(schema, buffers)
+    assembly = dict(assembly_spec(spec), **(assembly or {}))
+    scale = dict(scale_spec(spec), **(scale or {}))
+    # a schema file is rendered with its tiles, if any, unless smoothed
+    rebin = dict({"aggregation": "max"}, **spec["rebin"]) if spec.get("rebin") else \
+        {} if spec or gaussian else description.get("rebin", {})
+    outside = None
+    if rebin.get("type", "none") != "none":
+        if gaussian:
+            raise ValueError("The tiles of the smoothed buffers are not precomputed")
+        histograms, outside = rebinned(description, schema, histograms, rebin)
+    names, cube, colors0, colors1 = style_classes(description, histograms, spec)
+    if flip:
+        cube = cube[:, ::-1]
+        outside = outside if outside is None else outside[::-1]
+    image = assemble(cube, colors0, colors1, scale, assembly)
+    if outside is not None:
+        # the bins outside the tiles are not drawn, in each image of separate
+        image[np.tile(outside, (1, image.shape[1] // outside.shape[1]))] = 0
+    background = background or spec.get("background")
+    return to_rgba8(image, parse_color(background) if background else None)
+
+
+def png_name(filename, directory=None):
+    "Return the name of the PNG image of a specification or schema file"
+    root = filename[:-len(".json")] if filename.endswith(".json") else filename
+    root = root[:-len(".mdm")] if root.endswith(".mdm") else root
+    if directory is not None:
+        root = os.path.join(directory, os.path.basename(root))
+    return root + ".png"
+
+
+def spec_files(paths):
+    "Expand the directories of paths into their .mdm.json specifications"
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(glob.glob(os.path.join(path, "*.mdm.json")))
+        else:
+            files.append(path)
+    return files
+
+
+def render_png(filename, force=False, directory=None, **options):
+    "Render a specification or schema file to a PNG image, returning its name"
+    outname = png_name(filename, directory)
+    if not force and is_up_to_date(filename, outname) and \
+       is_up_to_date(load_spec(filename)[1], outname):
+        return None
+    Image.fromarray(render(filename, **options), "RGBA").save(outname, format="PNG")
+    return outname
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Render specifications or schema files to PNG images")
+    parser.add_argument("paths", nargs="+",
+                        help=".mdm.json specifications, _data.json schema files, or directories of specifications")
+    parser.add_argument("--assembly", default=None, nargs="?", choices=ASSEMBLIES,
+                        help="assembly overriding the one of the specifications")
+    parser.add_argument("--shape", default=None, nargs="?", choices=["square", "hex", "tri"],
+                        help="shape of the cells of the weaving")
+    parser.add_argument("--size", type=int, default=None, nargs="?",
+                        help="size of the cells of the weaving")
+    parser.add_argument("--random", action="store_true",
+                        help="weave the classes at random")
+    parser.add_argument("--threshold", type=float, default=None, nargs="?",
+                        help="threshold of the invmin assembly")
+    parser.add_argument("--scale", default=None, nargs="?", choices=SCALES,
+                        help="rescale overriding the one of the specifications")
+    parser.add_argument("--levels", type=int, default=None, nargs="?",
+                        help="number of levels of the equidepth rescale")
+    parser.add_argument("--gaussian", type=float, default=None, nargs="?",
+                        help="bandwidth of the smoothed buffers to render, written by the converter")
+    parser.add_argument("--background", default=None, nargs="?",
+                        help="background color, e.g., Black or #202020")
+    parser.add_argument("--flip", action="store_true",
+                        help="put the first row of the buffers at the bottom of the images")
+    parser.add_argument("--directory", default=None, nargs="?",
+                        help="directory of the images, the directory of each file by default")
+    parser.add_argument("--jobs", type=int, default=1, nargs="?",
+                        help="number of processes rendering the files")
+    parser.add_argument("--force", action="store_true",
+                        help="render the files even when their .png image is newer")
+    args = parser.parse_args()
+    assembly = {key: value for (key, value) in [("type", args.assembly), ("shape", args.shape),
+                                                ("size", args.size),
+                                                ("threshold", args.threshold)]
+                if value is not None}
+    if args.random:
+        assembly["random"] = True
+    scale = {key: value for (key, value) in [("type", args.scale), ("levels", args.levels)]
+             if value is not None}
+    function = partial(render_png, directory=args.directory, assembly=assembly, scale=scale,
+                       background=args.background, flip=args.flip, gaussian=args.gaussian)
+    for outname in convert_buffers(function, spec_files(args.paths), jobs=args.jobs, force=args.force):
+        print(outname)
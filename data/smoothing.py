@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""
+Smooth the data buffers with a Gaussian blur, as the gaussian preprocessing
+of the viewer does, so that the smoothed buffers can be written once by the
+converters instead of blurred by each client.
+
+All the classes of a (classes, height, width) cube are blurred at once by
+two 1D passes, along the rows then along the columns, the bins beyond the
+edges repeating the edge bins like in the viewer. The gaussian method
+convolves with a Gaussian kernel truncated at 4 standard deviations,
+directly for small kernels and by FFT for large ones; the box method
+approximates it with a cascade of three box blurs computed with cumulative
+sums, like the viewer (without rounding the bins to integers after each box).
+The classes are split between threads, NumPy releasing the GIL.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+try:
+    import scipy.fft as fft
+except ImportError:  # scipy is optional
+    fft = np.fft
+
+METHODS = ["gaussian", "box"]
+TRUNCATE = 4.0
+# the kernels longer than this are convolved by FFT
+FFT_KERNEL_SIZE = 31
+
+
+def gaussian_kernel(sigma, truncate=TRUNCATE):
+    "Return the normalized 1D Gaussian kernel of standard deviation sigma"
+    radius = max(int(truncate * sigma + 0.5), 0)
+    x = np.arange(-radius, radius + 1, dtype=np.float64)
+    kernel = np.exp(-0.5 * (x / sigma) ** 2) if sigma > 0 else (x == 0).astype(np.float64)
+    return kernel / kernel.sum()
+
+
+def boxes_for_gauss(sigma, n=3):
+    "Return the widths of the n boxes whose cascade approximates a Gaussian of sigma"
+    ideal = np.sqrt(12 * sigma * sigma / n + 1)
+    wl = int(np.floor(ideal))
+    if wl % 2 == 0:
+        wl -= 1
+    wu = wl + 2
+    m = int(round((12 * sigma * sigma - n * wl * wl - 4 * n * wl - 3 * n) / (-4 * wl - 4)))
+    return [wl if i < m else wu for i in range(n)]
+
+
+def _edge_pad(cube, radius, axis):
+    pad = [(0, 0)] * cube.ndim
+    pad[axis] = (radius, radius)
+    return np.pad(cube, pad, mode="edge")
+
+
+def _slice(array, start, stop, axis):
+    index = [slice(None)] * array.ndim
+    index[axis] = slice(start, stop)
+    return array[tuple(index)]
+
+
+def convolve_axis(cube, kernel, axis):
+    "Convolve a cube with a symmetric odd kernel along an axis, the edges repeated"
+    radius = len(kernel) // 2
+    size = cube.shape[axis]
+    padded = _edge_pad(cube, radius, axis)
+    if len(kernel) > FFT_KERNEL_SIZE:
+        length = padded.shape[axis] + len(kernel) - 1
+        if hasattr(fft, "next_fast_len"):
+            length = fft.next_fast_len(length, real=True)
+        shape = [1] * cube.ndim
+        shape[axis] = length // 2 + 1
+        spectrum = fft.rfft(padded, length, axis=axis) * \
+            fft.rfft(kernel, length).reshape(shape)
+        full = fft.irfft(spectrum, length, axis=axis)
+        return _slice(full, 2 * radius, 2 * radius + size, axis)
+    result = np.zeros(cube.shape, dtype=np.float64)
+    for (i, weight) in enumerate(kernel):
+        result += weight * _slice(padded, i, i + size, axis)
+    return result
+
+
+def box_axis(cube, width, axis):
+    "Return the means of the boxes of odd width of a cube along an axis, the edges repeated"
+    radius = width // 2
+    size = cube.shape[axis]
+    sums = np.cumsum(_edge_pad(np.asarray(cube, dtype=np.float64), radius, axis), axis=axis)
+    pad = [(0, 0)] * cube.ndim
+    pad[axis] = (1, 0)
+    sums = np.pad(sums, pad)
+    return (_slice(sums, width, width + size, axis) - _slice(sums, 0, size, axis)) / width
+
+
+def blur(cube, sigma, method="gaussian"):
+    "Return the blur of the last two axes, rows and columns, of a cube"
+    cube = np.asarray(cube, dtype=np.float64)
+    if method == "gaussian":
+        kernel = gaussian_kernel(sigma)
+        return convolve_axis(convolve_axis(cube, kernel, -1), kernel, -2)
+    if method == "box":
+        for width in boxes_for_gauss(sigma):
+            cube = box_axis(box_axis(cube, width, -1), width, -2)
+        return cube
+    raise ValueError("Unknown smoothing method: {}".format(method))
+
+
+def smooth_cube(cube, sigma, method="gaussian", threads=1):
+    "Return the blur of the classes of a (classes, height, width) cube, by threads"
+    cube = np.asarray(cube)
+    if threads <= 1 or len(cube) <= 1:
+        return blur(cube, sigma, method)
+    parts = np.array_split(np.arange(len(cube)), min(threads, len(cube)))
+    with ThreadPoolExecutor(len(parts)) as executor:
+        blurred = list(executor.map(lambda part: blur(cube[part], sigma, method), parts))
+    return np.concatenate(blurred)
+
+
+def parse_bandwidths(text):
+    "Return the bandwidths of a comma separated list"
+    return [float(bandwidth) for bandwidth in text.split(",")]
+
+
+def add_smooth_arguments(parser):
+    "Add the options of the smoothed buffers to an argument parser"
+    parser.add_argument("--smooth", type=parse_bandwidths, default=None, nargs="?",
+                        help="also write the buffers blurred with these comma separated bandwidths, in bins")
+    parser.add_argument("--smooth-method", dest="smooth_method", default="gaussian",
+                        nargs="?", choices=METHODS,
+                        help="Gaussian kernel, or cascade of box blurs like the viewer")
+
+
+def smooth_from_arguments(args):
+    "Return the smoothing spec of the parsed options, or None"
+    if not args.smooth:
+        return None
+    return {"method": args.smooth_method, "bandwidths": args.smooth, "threads": args.threads}
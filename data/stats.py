@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+"""
+Streaming statistics of the columns of an input file: the number of rows,
+the min, max and number of values of numeric columns, and the number of
+rows of each category of category columns.
+
+The statistics are computed chunk by chunk, usually while binning, and kept
+next to the input in a <filename>.stats.json sidecar file, with the size and
+modification time of the input, so that later conversions of the same file
+get their bounds without scanning it.
+A quantile sketch estimates the quantiles of a column chunk by chunk too.
+"""
+
+import os
+import os.path
+import json
+import numpy as np
+import pandas as pd
+
+SKETCH_SIZE = 100000
+
+
+def _python(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+
+class Statistics(object):
+    "Statistics of some numeric and category columns, updated chunk by chunk"
+    def __init__(self, numeric=(), categories=()):
+        self.rows = 0
+        self.columns = {name: {"min": None, "max": None, "count": 0} for name in numeric}
+        self.categories = {name: {} for name in categories}
+
+    def update(self, df, values=None):
+        """
+        Add the rows of a data frame; values has the arrays of the numeric
+        columns that are computed from its columns
+        """
+        self.rows += len(df)
+        for (name, column) in self.columns.items():
+            column_values = pd.Series(values[name], copy=False) \
+                if values and name in values else df[name]
+            count = int(column_values.count())
+            if count == 0:
+                continue
+            vmin = _python(column_values.min())
+            vmax = _python(column_values.max())
+            if column["count"]:
+                vmin = min(vmin, column["min"])
+                vmax = max(vmax, column["max"])
+            column.update(min=vmin, max=vmax, count=column["count"] + count)
+        for (name, counts) in self.categories.items():
+            self.add_counts(name, df[name].value_counts())
+
+    def add_counts(self, name, counts):
+        "Add the number of rows of each category of a column, e.g., computed while binning"
+        total = self.categories.setdefault(name, {})
+        for (value, count) in counts.items():
+            value = _python(value)
+            total[value] = int(count) + total.get(value, 0)
+
+    def merge(self, other):
+        "Add the statistics of other rows, returning self"
+        self.rows += other.rows
+        for (name, other_column) in other.columns.items():
+            column = self.columns.setdefault(name, {"min": None, "max": None, "count": 0})
+            if not other_column["count"]:
+                continue
+            if column["count"]:
+                column["min"] = min(column["min"], other_column["min"])
+                column["max"] = max(column["max"], other_column["max"])
+            else:
+                column["min"] = other_column["min"]
+                column["max"] = other_column["max"]
+            column["count"] += other_column["count"]
+        for (name, counts) in other.categories.items():
+            self.add_counts(name, counts)
+        return self
+
+    def bounds(self, x, y):
+        "Return the bounds [xmin, ymin, xmax, ymax] of the x and y columns, or None"
+        if not (self.columns.get(x, {}).get("count") and self.columns.get(y, {}).get("count")):
+            return None
+        return [self.columns[x]["min"], self.columns[y]["min"],
+                self.columns[x]["max"], self.columns[y]["max"]]
+
+    def cardinality(self, name):
+        "Return the number of categories of a column, or None"
+        if name not in self.categories:
+            return None
+        return len(self.categories[name])
+
+    def to_json(self):
+        return {"rows": self.rows,
+                "columns": self.columns,
+                # as pairs, since the categories are not always strings
+                "categories": {name: sorted(counts.items(), key=lambda item: str(item[0]))
+                               for (name, counts) in self.categories.items()}}
+
+    @classmethod
+    def from_json(cls, data):
+        stats = cls()
+        stats.rows = data["rows"]
+        stats.columns = data["columns"]
+        stats.categories = {name: {value: count for (value, count) in counts}
+                            for (name, counts) in data["categories"].items()}
+        return stats
+
+
+class QuantileSketch(object):
+    """
+    A uniform sample of at most size values of a stream, and its exact min
+    and max, to estimate the quantiles of the stream chunk by chunk.
+    Each value gets a random key and the values of the smallest keys are
+    kept, so that sketches of parts of the stream merge into a sketch of the
+    whole stream.
+    """
+    def __init__(self, size=SKETCH_SIZE, seed=0):
+        self.size = size
+        self.random = np.random.RandomState(seed)
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.keys = np.empty(0)
+        self.values = np.empty(0)
+
+    def _keep(self, keys, values):
+        if len(keys) > self.size:
+            index = np.argpartition(keys, self.size)[:self.size]
+            keys, values = keys[index], values[index]
+        self.keys, self.values = keys, values
+
+    def _extend(self, count, vmin, vmax):
+        self.count += count
+        self.min = vmin if self.min is None else min(self.min, vmin)
+        self.max = vmax if self.max is None else max(self.max, vmax)
+
+    def update(self, values):
+        "Add some values, ignoring NaNs"
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+        self._extend(len(values), float(values.min()), float(values.max()))
+        self._keep(np.concatenate([self.keys, self.random.random_sample(len(values))]),
+                   np.concatenate([self.values, values]))
+
+    def merge(self, other):
+        "Add the values of another sketch, returning self"
+        if other.count:
+            self._extend(other.count, other.min, other.max)
+            self._keep(np.concatenate([self.keys, other.keys]),
+                       np.concatenate([self.values, other.values]))
+        return self
+
+    def quantiles(self, q):
+        "Return the estimated quantiles q of the values, the 0 and 1 quantiles being exact"
+        q = np.asarray(q, dtype=np.float64)
+        result = np.quantile(self.values, q)
+        result[q == 0] = self.min
+        result[q == 1] = self.max
+        return result
+
+
+def stats_path(filename):
+    "Return the name of the sidecar statistics file of an input file"
+    return filename + ".stats.json"
+
+
+def _fingerprint(filename):
+    stat = os.stat(filename)
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+
+def load_stats(filename):
+    "Return the statistics of an input file from its sidecar file, or None if missing or stale"
+    try:
+        with open(stats_path(filename)) as inf:
+            data = json.load(inf)
+    except (OSError, ValueError):
+        return None
+    if data.get("source") != _fingerprint(filename):
+        return None
+    return Statistics.from_json(data)
+
+
+def save_stats(filename, stats):
+    """
+    Save the statistics of all the rows of an input file in its sidecar
+    file, keeping the statistics of the other columns already there
+    """
+    known = load_stats(filename)
+    if known is not None and known.rows == stats.rows:
+        known.columns.update(stats.columns)
+        known.categories.update(stats.categories)
+        stats = known
+    data = stats.to_json()
+    data["source"] = _fingerprint(filename)
+    try:
+        with open(stats_path(filename), "w") as outf:
+            json.dump(data, outf, indent=2)
+    except OSError as e:  # e.g., a read-only directory
+        print("Cannot save the statistics of %s: %s"%(filename, e))
@@ -0,0 +1,9 @@
+"""
+The modules of data/ are scripts run from that directory, importing each
+other by name, so the tests import them the same way.
+"""
+
+import os.path
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
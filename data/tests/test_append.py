@@ -0,0 +1,104 @@
+import numpy as np
+import pandas as pd
+import pytest
+from csv2json import csv_to_databuffers
+from databuffer import load_databuffers, load_for_append, FORMATS
+
+BOUNDS = {"xmin": 0.0, "ymin": 0.0, "xmax": 10.0, "ymax": 5.0}
+
+
+def make_rows(n, categories, seed):
+    rng = np.random.RandomState(seed)
+    return pd.DataFrame({"x": rng.uniform(0, 10, n),
+                         "y": rng.uniform(0, 5, n),
+                         "k": rng.choice(categories, n)})
+
+
+def convert(tmp_path, name, df, buffer_format, append=None, **options):
+    filename = str(tmp_path / (name + ".csv"))
+    df.to_csv(filename, index=False)
+    csv_to_databuffers(filename, "x", "y", "k", width=16, height=8,
+                       buffer_format=buffer_format, append=append, **dict(BOUNDS, **options))
+    return str(tmp_path / (name + "_data.json"))
+
+
+def buffers(schema):
+    description, histograms = load_databuffers(schema)
+    counts = {buf["value"]: buf["count"] for buf in description["buffers"]}
+    return counts, {key: np.asarray(histo) for (key, histo) in histograms.items()}
+
+
+def assert_same_buffers(schema, expected):
+    counts, histograms = buffers(schema)
+    expected_counts, expected_histograms = buffers(expected)
+    assert counts == expected_counts
+    assert histograms.keys() == expected_histograms.keys()
+    for key in histograms:
+        np.testing.assert_array_equal(histograms[key], expected_histograms[key])
+
+
+@pytest.mark.parametrize("buffer_format", FORMATS)
+def test_append_matches_full_conversion(tmp_path, buffer_format):
+    base = make_rows(3000, ["a", "b", "c"], 0)
+    delta = make_rows(1000, ["a", "b", "c"], 1)
+    full = convert(tmp_path, "full", pd.concat([base, delta]), buffer_format, catnames=True)
+    schema = convert(tmp_path, "base", base, buffer_format, catnames=True)
+    convert(tmp_path, "delta", delta, buffer_format, append=schema, catnames=True)
+    assert_same_buffers(schema, full)
+
+
+@pytest.mark.parametrize("buffer_format", FORMATS)
+@pytest.mark.parametrize("catnames", [False, True])
+def test_append_delta_missing_a_class(tmp_path, buffer_format, catnames):
+    base = make_rows(3000, ["a", "b", "c", "d"], 0)
+    delta = make_rows(1000, ["b", "c", "d"], 1)
+    full = convert(tmp_path, "full", pd.concat([base, delta]), buffer_format,
+                   catnames=catnames)
+    schema = convert(tmp_path, "base", base, buffer_format, catnames=catnames)
+    convert(tmp_path, "delta", delta, buffer_format, append=schema, catnames=catnames)
+    assert_same_buffers(schema, full)
+
+
+def test_append_new_class(tmp_path):
+    base = make_rows(3000, ["b", "c"], 0)
+    delta = make_rows(1000, ["a", "c"], 1)
+    schema = convert(tmp_path, "base", base, "json", catnames=False)
+    convert(tmp_path, "delta", delta, "json", append=schema, catnames=False)
+    description, _ = load_databuffers(schema)
+    z = description["encoding"]["z"]
+    assert z["scale"]["domain"] == [1, 2, 3]
+    assert z["categories"] == ["b", "c", "a"]
+    counts, _ = buffers(schema)
+    assert counts == {1: (base.k == "b").sum(), 2: (base.k == "c").sum() + (delta.k == "c").sum(),
+                      3: (delta.k == "a").sum()}
+
+
+def test_append_keeps_the_sparse_density(tmp_path):
+    # about 40% of the bins are non-empty, above the default density
+    base = make_rows(60, ["a"], 0)
+    schema = convert(tmp_path, "base", base, "json", sparse=0.9)
+    assert load_databuffers(schema)[0]["buffers"][0]["sparse"] == "csr"
+    convert(tmp_path, "delta", make_rows(20, ["a"], 1), "json", append=schema)
+    description, _ = load_databuffers(schema)
+    assert description["sparseDensity"] == 0.9
+    assert description["buffers"][0]["sparse"] == "csr"
+
+
+def test_append_keeps_the_projected_bounds(tmp_path):
+    pytest.importorskip("pyproj")
+    bounds = {"xmin": 100000.1, "ymin": 5000000.3, "xmax": 700000.7, "ymax": 5300000.9}
+    rng = np.random.RandomState(0)
+    df = pd.DataFrame({"x": rng.uniform(bounds["xmin"], bounds["xmax"], 2000),
+                       "y": rng.uniform(bounds["ymin"], bounds["ymax"], 2000),
+                       "k": rng.choice(["a", "b"], 2000)})
+    schemas = {}
+    for (name, part) in [("full", df), ("base", df[:1500]), ("delta", df[1500:])]:
+        filename = str(tmp_path / (name + ".csv"))
+        part.to_csv(filename, index=False)
+        csv_to_databuffers(filename, "x", "y", "k", width=16, height=8, projection="epsg:3857",
+                           append=schemas.get("base") if name == "delta" else None,
+                           **bounds)
+        schemas[name] = str(tmp_path / (name + "_data.json"))
+    expected = [bounds[key] for key in ("xmin", "ymin", "xmax", "ymax")]
+    assert load_for_append(schemas["base"])[1] == expected
+    assert_same_buffers(schemas["base"], schemas["full"])
@@ -0,0 +1,34 @@
+import numpy as np
+from binning import histogram_cube, class_counts
+
+
+def test_histogram_cube_matches_histogram2d():
+    rng = np.random.RandomState(0)
+    n = 10000
+    x = rng.uniform(-1, 11, n)
+    y = rng.uniform(-5, 25, n)
+    # points on the edges, the last one being in the last bin
+    x[:4] = [0, 10, 10, 3.3]
+    y[:4] = [0, 20, 7.7, 20]
+    codes = rng.randint(-1, 3, n)
+    bins = (7, 13)
+    xy_range = [[0, 10], [0, 20]]
+    cube = histogram_cube(x, y, codes, 3, bins, xy_range)
+    assert cube.shape == (3, 13, 7)
+    for c in range(3):
+        keep = codes == c
+        histo, _, _ = np.histogram2d(x[keep], y[keep], bins=bins, range=xy_range)
+        np.testing.assert_array_equal(cube[c], histo.T)
+
+
+def test_histogram_cube_without_codes_adds_to_out():
+    rng = np.random.RandomState(1)
+    x, y = rng.uniform(0, 1, 1000), rng.uniform(0, 1, 1000)
+    histo, _, _ = np.histogram2d(x, y, bins=(5, 4), range=[[0, 1], [0, 1]])
+    out = histogram_cube(x, y, None, 1, (5, 4), [[0, 1], [0, 1]])
+    histogram_cube(x, y, None, 1, (5, 4), [[0, 1], [0, 1]], out=out)
+    np.testing.assert_array_equal(out[0], 2 * histo.T)
+
+
+def test_class_counts():
+    np.testing.assert_array_equal(class_counts([0, 2, 2, -1, 5], 3), [1, 0, 2])
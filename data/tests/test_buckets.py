@@ -0,0 +1,9 @@
+import numpy as np
+from buckets import Buckets
+
+
+def test_codes_follow_np_histogram():
+    buckets = Buckets.uniform(0, 10, 4)
+    values = np.array([-1, 0, 2.5, 4.9, 7.5, 10, 11, np.nan])
+    np.testing.assert_array_equal(buckets.codes(values), [-1, 0, 1, 1, 3, 3, -1, -1])
+    assert len(buckets.labels) == 4
@@ -0,0 +1,114 @@
+import os
+import json
+import glob
+import numpy as np
+from binning import histogram_cube
+from cache import ConversionCache
+
+XY_RANGE = [[0.0, 10.0], [0.0, 5.0]]
+
+
+def points(n=5000, seed=0):
+    rng = np.random.RandomState(seed)
+    return rng.uniform(0, 10, n), rng.uniform(0, 5, n), rng.randint(3, size=n)
+
+
+def binned(bins, xy_range):
+    "Return the histograms and counts of the points binned with bins over xy_range"
+    x, y, codes = points()
+    cube = histogram_cube(x, y, codes, 3, bins, xy_range)
+    return ({value: cube[i] for (i, value) in enumerate("abc")},
+            {value: int(cube[i].sum()) for (i, value) in enumerate("abc")})
+
+
+def store(cache, bins, xy_range=XY_RANGE):
+    cache.store("source", bins, xy_range, *binned(bins, xy_range))
+
+
+def assert_hit(cache, bins, xy_range):
+    cached = cache.lookup("source", bins, xy_range)
+    assert cached is not None
+    histograms, _ = cached
+    expected, _ = binned(bins, xy_range)
+    assert histograms.keys() == expected.keys()
+    for key in expected:
+        np.testing.assert_array_equal(histograms[key], expected[key])
+
+
+def entry_files(cache, bins):
+    "Return the files of the entry of the cache with bins"
+    for name in glob.glob(os.path.join(cache.directory, "*.json")):
+        with open(name) as inf:
+            if json.load(inf)["bins"] == list(bins):
+                return [name, name[:-len(".json")] + ".npy"]
+    return []
+
+
+def directory_size(directory):
+    return sum(os.path.getsize(name) for name in glob.glob(os.path.join(directory, "*")))
+
+
+def test_same_bins(tmp_path):
+    cache = ConversionCache(str(tmp_path))
+    store(cache, (16, 8))
+    histograms, counts = cache.lookup("source", (16, 8), XY_RANGE)
+    expected, expected_counts = binned((16, 8), XY_RANGE)
+    assert counts == expected_counts
+    for key in expected:
+        np.testing.assert_array_equal(histograms[key], expected[key])
+
+
+def test_width_dividing_the_cached_width(tmp_path):
+    cache = ConversionCache(str(tmp_path))
+    store(cache, (16, 8))
+    assert_hit(cache, (8, 4), XY_RANGE)
+    assert_hit(cache, (4, 8), XY_RANGE)
+
+
+def test_aligned_sub_rectangle(tmp_path):
+    cache = ConversionCache(str(tmp_path))
+    store(cache, (16, 8))
+    # the bins of the entry are 0.625 wide and high
+    assert_hit(cache, (8, 4), [[1.25, 6.25], [0.625, 3.125]])
+    assert_hit(cache, (2, 1), [[5.0, 7.5], [1.25, 2.5]])
+
+
+def test_unaligned_edges_miss(tmp_path):
+    cache = ConversionCache(str(tmp_path))
+    store(cache, (16, 8))
+    assert cache.lookup("source", (16, 8), [[0.3, 10.3], [0.0, 5.0]]) is None
+    assert cache.lookup("source", (12, 8), XY_RANGE) is None
+    assert cache.lookup("source", (8, 4), [[0.0, 10.0], [-0.625, 4.375]]) is None
+    assert cache.lookup("other", (16, 8), XY_RANGE) is None
+
+
+def test_changed_input_misses(tmp_path):
+    cache = ConversionCache(str(tmp_path / "cache"))
+    filename = str(tmp_path / "input.csv")
+    with open(filename, "w") as outf:
+        outf.write("x,y,k\n")
+    source = cache.source(filename, x="x", y="y", category="k")
+    cache.store(source, (16, 8), XY_RANGE, *binned((16, 8), XY_RANGE))
+    assert cache.lookup(source, (16, 8), XY_RANGE) is not None
+    stat = os.stat(filename)
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    source = cache.source(filename, x="x", y="y", category="k")
+    assert cache.lookup(source, (16, 8), XY_RANGE) is None
+
+
+def test_least_recently_used_eviction(tmp_path):
+    cache = ConversionCache(str(tmp_path))
+    # the widths are not multiples of each other, so each entry only serves itself
+    store(cache, (16, 8))
+    store(cache, (15, 8))
+    for (bins, used) in [((16, 8), 1000), ((15, 8), 2000)]:
+        for name in entry_files(cache, bins):
+            os.utime(name, (used, used))
+    assert cache.lookup("source", (16, 8), XY_RANGE) is not None
+    # room for the two entries, so the next one evicts the least recently used
+    cache.max_size = directory_size(cache.directory)
+    store(cache, (14, 8))
+    assert entry_files(cache, (15, 8)) == []
+    assert cache.lookup("source", (15, 8), XY_RANGE) is None
+    assert_hit(cache, (16, 8), XY_RANGE)
+    assert_hit(cache, (14, 8), XY_RANGE)
@@ -0,0 +1,27 @@
+import numpy as np
+import pandas as pd
+from csv2json import csv_to_databuffers
+from databuffer import load_databuffers
+
+BOUNDS = {"xmin": 0.0, "ymin": 0.0, "xmax": 1.0, "ymax": 1.0}
+
+
+def test_chunks_with_categories_of_other_types(tmp_path):
+    rng = np.random.RandomState(0)
+    # the first chunk is read as integers, and the second one as strings
+    k = list(rng.choice([1, 2], 300)) + list(rng.choice(["1", "x"], 300))
+    df = pd.DataFrame({"x": rng.uniform(0, 1, 600), "y": rng.uniform(0, 1, 600), "k": k})
+    schemas = []
+    for chunksize in (None, 300):
+        filename = str(tmp_path / ("t%s.csv"%chunksize))
+        df.to_csv(filename, index=False)
+        csv_to_databuffers(filename, "x", "y", "k", width=4, height=4, chunksize=chunksize,
+                           catnames=True, **BOUNDS)
+        schemas.append(load_databuffers(filename[:-len(".csv")] + "_data.json"))
+    (description, histograms), (chunked, chunked_histograms) = schemas
+    assert chunked["encoding"]["z"] == description["encoding"]["z"]
+    assert chunked["encoding"]["z"]["categories"] == ["1", "2", "x"]
+    assert [buf["count"] for buf in chunked["buffers"]] == \
+        [(df.k.astype(str) == cat).sum() for cat in ["1", "2", "x"]]
+    for key in histograms:
+        np.testing.assert_array_equal(chunked_histograms[key], histograms[key])
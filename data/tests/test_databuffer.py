@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+from databuffer import buffer_dtype, encode_rows, decode_rows, write_databuffers, \
+    load_databuffers, ENCODINGS
+
+
+@pytest.mark.parametrize("values, dtype", [
+    ([0, 255], "|u1"),
+    ([0, 256], "<u2"),
+    ([0, 65535], "<u2"),
+    ([0, 65536], "<u4"),
+    ([0, 2**32 - 1], "<u4"),
+    ([0, 2**32], "<f8"),
+    ([-1, 127], "|i1"),
+    ([-1, 128], "<i2"),
+    ([-32769, 0], "<i4"),
+    ([0.0, 3.0], "|u1"),
+    ([0.0, 0.5], "<f8"),
+    ([0.0, np.nan], "<f8"),
+])
+def test_buffer_dtype_is_the_smallest(values, dtype):
+    assert buffer_dtype(np.array(values)) == np.dtype(dtype)
+
+
+def test_buffer_dtype_of_an_empty_buffer():
+    assert buffer_dtype(np.zeros((0, 4), dtype=np.int64)) == np.dtype("|u1")
+
+
+@pytest.mark.parametrize("encoding", ENCODINGS)
+def test_encoded_rows_round_trip(encoding):
+    rng = np.random.RandomState(0)
+    histo = rng.poisson(1000, size=(20, 7))
+    encoded = encode_rows(histo, encoding)
+    # the row differences are signed, unless they are zigzag encoded
+    assert encoded.dtype.kind == {None: "u", "delta": "i", "zigzag": "u"}[encoding]
+    np.testing.assert_array_equal(decode_rows(encoded, encoding), histo)
+    banded = encode_rows(histo, encoding, band_rows=8)
+    np.testing.assert_array_equal(decode_rows(banded[8:16], encoding), histo[8:16])
+
+
+@pytest.mark.parametrize("buffer_format", ["npy", "multiclass"])
+def test_cube_offsets_round_trip(tmp_path, buffer_format):
+    rng = np.random.RandomState(0)
+    histograms = {"a": rng.poisson(300, size=(5, 7)), "b": rng.poisson(2, size=(5, 7))}
+    root = str(tmp_path / "t")
+    write_databuffers(root, {"source": {}}, histograms, {"a": 1, "b": 2}, buffer_format)
+    description, loaded = load_databuffers(root + "_data.json")
+    with open(description["buffers"][0]["url"], "rb") as inf:
+        data = inf.read()
+    for (index, buf) in enumerate(description["buffers"]):
+        assert buf["index"] == index
+        # the whole cube has one dtype, large enough for a
+        assert buf["dtype"] == "<u2"
+        histo = np.frombuffer(data, dtype=buf["dtype"], count=5 * 7, offset=buf["offset"])
+        np.testing.assert_array_equal(histo.reshape(5, 7), np.flipud(histograms[buf["value"]]))
+        np.testing.assert_array_equal(loaded[buf["value"]], np.flipud(histograms[buf["value"]]))
+
+
+def test_quantiles_in_the_schema(tmp_path):
+    histograms = {"a": np.array([[0, 1, 2], [3, 0, 4]]), "b": np.array([[0, 0, 10], [0, 0, 0]])}
+    root = str(tmp_path / "t")
+    write_databuffers(root, {"source": {}}, histograms, {"a": 10, "b": 10}, quantiles=4)
+    description, _ = load_databuffers(root + "_data.json")
+    # the empty bins are left out
+    assert description["distribution"] == {"levels": 4, "bins": 5,
+                                           "quantiles": [1, 2, 3, 4, 10]}
+    a, b = description["buffers"]
+    assert a["distribution"] == {"levels": 4, "bins": 4, "quantiles": [1, 1.75, 2.5, 3.25, 4]}
+    assert b["distribution"] == {"levels": 4, "bins": 1, "quantiles": [10] * 5}
+
+
+def test_quantiles_of_empty_buffers(tmp_path):
+    root = str(tmp_path / "t")
+    write_databuffers(root, {"source": {}}, {"a": np.zeros((2, 3), dtype=int)}, {"a": 0},
+                      quantiles=4)
+    description, _ = load_databuffers(root + "_data.json")
+    assert description["distribution"] == {"levels": 4, "bins": 0, "quantiles": []}
+    # without quantiles, there is no distribution
+    write_databuffers(root, {"source": {}}, {"a": np.zeros((2, 3), dtype=int)}, {"a": 0})
+    description, _ = load_databuffers(root + "_data.json")
+    assert "distribution" not in description
+    assert "distribution" not in description["buffers"][0]
@@ -0,0 +1,89 @@
+import numpy as np
+import pandas as pd
+import pytest
+import expressions
+from expressions import Expression, read_columns
+
+DF = pd.DataFrame({"a": np.array([1, 2, 3, 4]),
+                   "b": np.array([2.0, 0.5, -1.0, 8.0]),
+                   "arrival delay": np.array([10, -5, 0, 30]),
+                   "k": ["x", "y", "x", "z"]})
+
+
+@pytest.fixture(params=["numexpr", "numpy"])
+def engine(request, monkeypatch):
+    "Evaluate the expressions with numexpr, when installed, or NumPy"
+    if request.param == "numexpr":
+        pytest.importorskip("numexpr")
+    else:
+        monkeypatch.setattr(expressions, "numexpr", None)
+    return request.param
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("a / b", DF.a / DF.b),
+    ("a // 2 + a % 2", DF.a // 2 + DF.a % 2),
+    ("-a ** 2", -DF.a ** 2),
+    ("log1p(a) * pi", np.log1p(DF.a) * np.pi),
+    ("clip(b, 0, 1)", np.clip(DF.b, 0, 1)),
+    ("where(b > 0, a, -a)", np.where(DF.b > 0, DF.a, -DF.a)),
+    ("`arrival delay` / a", DF["arrival delay"] / DF.a),
+    ("(a > 1) & (b < 1)", (DF.a > 1) & (DF.b < 1)),
+    ("k == 'x'", DF.k == "x"),
+])
+def test_evaluate(engine, text, expected):
+    expression = Expression(text, DF.columns)
+    np.testing.assert_allclose(expression.evaluate(DF), np.asarray(expected, dtype=float))
+
+
+def test_numexpr_is_used_when_installed(engine):
+    assert Expression("a / b", DF.columns)._numexpr == (engine == "numexpr")
+    # numexpr has no floor division
+    assert not Expression("a // 2", DF.columns)._numexpr
+
+
+def test_plain_column_is_not_copied(engine):
+    expression = Expression("b", DF.columns)
+    assert expression.column == "b"
+    assert np.shares_memory(expression.evaluate(DF), DF["b"].values)
+
+
+def test_columns():
+    expression = Expression("`arrival delay` / a + a", DF.columns)
+    assert expression.columns == ["arrival delay", "a"]
+    assert read_columns(expression, Expression("b", DF.columns)) == ["arrival delay", "a", "b"]
+    # a column whose name could be parsed is still the column
+    assert Expression("arrival delay", ["arrival delay"]).column == "arrival delay"
+
+
+@pytest.mark.parametrize("text", ["a +", "__import__('os')", "a.real", "c * 2", "f(a)"])
+def test_invalid_expressions(text):
+    with pytest.raises(ValueError):
+        Expression(text, DF.columns)
+
+
+def test_categorize(engine):
+    values, codes = Expression("a % 2", DF.columns).categorize(DF)
+    assert list(values) == [0, 1]
+    np.testing.assert_array_equal(codes, [1, 0, 1, 0])
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("a & b", [True, True, False]),
+    ("a | b", [True, True, False]),
+    ("~a", [False, False, True]),
+    ("(a > 0) & ~(b > 1)", [False, False, False]),
+    ("(a > 1) | ~b", [False, True, True]),
+])
+def test_logical_operators_on_integers(engine, text, expected):
+    # bitwise, 1 & 2 would be 0
+    df = pd.DataFrame({"a": np.array([1, 2, 0]), "b": np.array([2, 2, 0])})
+    np.testing.assert_array_equal(Expression(text, df.columns).evaluate(df), expected)
+
+
+def test_columns_named_like_constants(engine):
+    df = pd.DataFrame({"e": np.array([1.0, 2.0]), "pi": np.array([3, 4])})
+    np.testing.assert_allclose(Expression("e * 2 + pi", df.columns).evaluate(df), [5, 8])
+    assert Expression("e * 2 + pi", df.columns).columns == ["e", "pi"]
+    # the constants are still constants in tables without such columns
+    np.testing.assert_allclose(Expression("a * e", DF.columns).evaluate(DF), DF.a * np.e)
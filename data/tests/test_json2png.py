@@ -0,0 +1,16 @@
+import json
+import numpy as np
+from PIL import Image
+from json2png import json2png
+
+
+def test_json2png_writes_16_bits_cube_roots(tmp_path):
+    histo = np.array([[0, 1, 8], [27, 1000, 64 ** 3]])
+    filename = str(tmp_path / "t_cat_a.json")
+    with open(filename, "w") as outf:
+        json.dump(histo.tolist(), outf)
+    outname = json2png(filename)
+    image = Image.open(outname)
+    assert image.mode == "I;16"
+    np.testing.assert_array_equal(np.array(image), [[0, 1, 2], [3, 10, 64]])
+    assert json2png(filename) is None
@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+from databuffer import ENCODINGS
+from lz4buffer import write_lz4_buffer, read_lz4_buffer, read_lz4_rows, read_lz4_header
+
+
+@pytest.mark.parametrize("encoding", ENCODINGS)
+def test_band_round_trip(tmp_path, encoding):
+    rng = np.random.RandomState(0)
+    histo = rng.poisson(3, size=(150, 37))
+    histo[10:20] = 0
+    filename = str(tmp_path / "histo.lz4")
+    write_lz4_buffer(filename, histo, band_rows=16, threads=2, encoding=encoding)
+    header = read_lz4_header(filename)
+    assert header["shape"] == [150, 37]
+    assert len(header["bands"]) == 10
+    np.testing.assert_array_equal(read_lz4_buffer(filename), histo)
+    for (start, stop) in [(0, 1), (15, 17), (33, 150), (140, 200), (5, 5)]:
+        np.testing.assert_array_equal(read_lz4_rows(filename, start, stop, threads=2),
+                                      histo[start:stop])
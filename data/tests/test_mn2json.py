@@ -0,0 +1,28 @@
+import multiprocessing
+import numpy as np
+import pytest
+from databuffer import load_databuffers
+from mn2json import mn2json
+
+MEANS = [[-1, -1], [1, 1]]
+BOUNDS = [[-5, 5], [-5, 5]]
+
+
+def test_buffers_do_not_depend_on_jobs(tmp_path):
+    mn2json(str(tmp_path / "one"), 5000, 16, 8, MEANS, [[1, 0], [0, 1]], BOUNDS,
+            seed=3, block_size=1000)
+    mn2json(str(tmp_path / "jobs"), 5000, 16, 8, MEANS, [[1, 0], [0, 1]], BOUNDS,
+            seed=3, block_size=1000, jobs=2)
+    _, expected = load_databuffers(str(tmp_path / "one_data.json"))
+    _, histograms = load_databuffers(str(tmp_path / "jobs_data.json"))
+    for key in expected:
+        np.testing.assert_array_equal(histograms[key], expected[key])
+
+
+def test_pool_is_terminated_when_a_block_raises(tmp_path):
+    # a covariance of the wrong shape makes every block raise in the workers,
+    # and the traceback keeps the frame of the pool alive
+    with pytest.raises(ValueError) as raised:
+        mn2json(str(tmp_path / "mn"), 5000, 16, 8, MEANS, [[1, 0, 0]], BOUNDS,
+                seed=3, block_size=1000, jobs=2)
+    assert raised.traceback and multiprocessing.active_children() == []
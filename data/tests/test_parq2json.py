@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+import pytest
+from databuffer import load_databuffers
+
+fastparquet = pytest.importorskip("fastparquet")
+from parq2json import parquet_to_databuffers  # noqa: E402
+
+BOUNDS = {"xmin": 0.0, "ymin": 0.0, "xmax": 10.0, "ymax": 5.0}
+
+
+def rows(n, categories, seed):
+    rng = np.random.RandomState(seed)
+    return pd.DataFrame({"x": rng.uniform(0, 10, n),
+                         "y": rng.uniform(0, 5, n),
+                         "k": rng.choice(categories, n)})
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_row_groups_with_other_categories(tmp_path, jobs):
+    # the first row group has no k == 1
+    df = pd.concat([rows(1000, [2, 3], 0), rows(2000, [1, 2, 3], 1)], ignore_index=True)
+    parquet = str(tmp_path / "t.parq")
+    fastparquet.write(parquet, df, row_group_offsets=[0, 1000, 2000])
+    parquet_to_databuffers(parquet, "x", "y", "k + 0", width=16, height=8, jobs=jobs, **BOUNDS)
+    description, histograms = load_databuffers(str(tmp_path / "t_data.json"))
+    expected = df["k"].value_counts()
+    assert {buf["value"]: buf["count"] for buf in description["buffers"]} == \
+        {1: expected[1], 2: expected[2], 3: expected[3]}
+    for (key, cat) in [(1, 1), (2, 2), (3, 3)]:
+        part = df[df["k"] == cat]
+        histo, _, _ = np.histogram2d(part["x"], part["y"], bins=(16, 8),
+                                     range=[[0, 10], [0, 5]])
+        np.testing.assert_array_equal(np.flipud(histograms[key]), histo.T)
+
+
+def test_append_delta_missing_a_class(tmp_path):
+    base = rows(2000, [1, 2, 3], 0)
+    delta = rows(1000, [2, 3], 1)
+    for (name, df) in [("base", base), ("delta", delta), ("full", pd.concat([base, delta]))]:
+        # a category column is read as a categorical, so it is dictionary encoded
+        fastparquet.write(str(tmp_path / (name + ".parq")), df.astype({"k": "category"}))
+    schema = str(tmp_path / "base_data.json")
+    parquet_to_databuffers(str(tmp_path / "base.parq"), "x", "y", "k", width=16, height=8,
+                           **BOUNDS)
+    parquet_to_databuffers(str(tmp_path / "delta.parq"), "x", "y", "k", width=16, height=8,
+                           append=schema, **BOUNDS)
+    parquet_to_databuffers(str(tmp_path / "full.parq"), "x", "y", "k", width=16, height=8,
+                           **BOUNDS)
+    description, histograms = load_databuffers(schema)
+    full_description, full_histograms = load_databuffers(str(tmp_path / "full_data.json"))
+    assert description["buffers"] == [dict(buf, url=buf["url"].replace("full", "base"))
+                                      for buf in full_description["buffers"]]
+    for key in full_histograms:
+        np.testing.assert_array_equal(histograms[key], full_histograms[key])
+
+
+def test_pool_is_terminated_when_binning_raises(tmp_path):
+    import multiprocessing
+    parquet = str(tmp_path / "t.parq")
+    fastparquet.write(parquet, rows(100, [1, 2], 0), row_group_offsets=[0, 50])
+    # equal bounds make grid raise once the pool is open, and the traceback
+    # keeps the frame of the pool alive, as it would in a caller
+    with pytest.raises(ValueError) as raised:
+        parquet_to_databuffers(parquet, "x", "y", "k", width=16, height=8, jobs=2,
+                               xmin=1.0, xmax=1.0, ymin=0.0, ymax=5.0)
+    assert raised.traceback and multiprocessing.active_children() == []
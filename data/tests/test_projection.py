@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("pyproj")
+from projection import to_lonlat, from_lonlat, project, projected_columns  # noqa: E402
+
+# points whose projected coordinates follow from the definitions of the systems
+KNOWN = [
+    ("epsg:3857", (0, 0), (0, 0)),
+    ("epsg:3857", (180, 45), (20037508.342789244, 5621521.486192066)),
+    ("epsg:3857", (-90, -45), (-10018754.171394622, -5621521.486192066)),
+    # the origin of Lambert-93
+    ("epsg:2154", (3, 46.5), (700000, 6600000)),
+]
+
+
+@pytest.mark.parametrize("projection, lonlat, xy", KNOWN)
+def test_known_coordinates(projection, lonlat, xy):
+    np.testing.assert_allclose(from_lonlat(*lonlat, projection), xy, rtol=0, atol=1e-6)
+    np.testing.assert_allclose(to_lonlat(*xy, projection), lonlat, rtol=0, atol=1e-9)
+
+
+def test_batches_and_threads_project_like_one_call():
+    rng = np.random.RandomState(0)
+    lon, lat = rng.uniform(-5, 10, 1000), rng.uniform(41, 51, 1000)
+    x, y = project(lon, lat, "epsg:4326", "epsg:2154")
+    expected = [from_lonlat(*point, "epsg:2154") for point in zip(lon[:10], lat[:10])]
+    np.testing.assert_allclose(np.column_stack([x[:10], y[:10]]), expected)
+    bx, by = project(lon, lat, "epsg:4326", "epsg:2154", threads=4, batch_size=64)
+    np.testing.assert_array_equal(bx, x)
+    np.testing.assert_array_equal(by, y)
+
+
+def test_projected_columns():
+    assert projected_columns("x", "y") == ("x", "y")
+    assert projected_columns("x", "y", "epsg:4326", "epsg:3857") == \
+        ("x@epsg:3857", "y@epsg:3857")
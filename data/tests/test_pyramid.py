@@ -0,0 +1,38 @@
+import json
+import os.path
+import numpy as np
+from databuffer import write_pyramid
+
+
+def test_pyramid_levels(tmp_path):
+    rng = np.random.RandomState(0)
+    histograms = {"a": rng.poisson(2, size=(70, 40)), "b": rng.poisson(1, size=(70, 40))}
+    # the last column of tiles of the max zoom is empty
+    for histo in histograms.values():
+        histo[:, 32:] = 0
+    root = str(tmp_path / "t")
+    pyramid = write_pyramid(root, histograms, tile_size=16)
+    # 70 rows need 16 << 3 bins at zoom 0
+    assert pyramid["maxZoom"] == 3
+    levels = pyramid["levels"]
+    assert [level["zoom"] for level in levels] == [0, 1, 2, 3]
+    assert [(level["width"], level["height"]) for level in levels] == \
+        [(5, 9), (10, 18), (20, 35), (40, 70)]
+    assert [level["binSize"] for level in levels] == [8, 4, 2, 1]
+    for level in levels:
+        sums = {"a": 0, "b": 0}
+        for (tx, ty) in level["tiles"]:
+            for key in sums:
+                url = pyramid["url"].format(z=level["zoom"], x=tx, y=ty, value=key)
+                with open(url) as inf:
+                    tile = np.array(json.load(inf))
+                assert tile.shape == (16, 16)
+                sums[key] += tile.sum()
+        assert sums == {key: histo.sum() for (key, histo) in histograms.items()}
+    # the top tile of zoom 0 is the whole map, flipped and summed by 8 x 8 bins
+    with open(pyramid["url"].format(z=0, x=0, y=0, value="a")) as inf:
+        top = np.array(json.load(inf))
+    assert top[0, 0] == np.flipud(histograms["a"])[:8, :8].sum()
+    assert top[8, 0] == np.flipud(histograms["a"])[64:, :8].sum()
+    assert sorted(levels[3]["tiles"]) == [[tx, ty] for tx in range(2) for ty in range(5)]
+    assert not os.path.exists(pyramid["url"].format(z=3, x=2, y=0, value="a"))
@@ -0,0 +1,36 @@
+import numpy as np
+from render import style_classes, spec_files, COLORS, CATEGORY10
+
+HISTOGRAMS = {"a": np.ones((2, 3)), "b": np.zeros((2, 3))}
+REENCODING = {"label": {"scale": {"domain": ["b", "a"], "range": ["Bee", "Ay"]}},
+              "color": {"scale": {"range": ["Red", "Green"]}}}
+
+
+def test_reencoding_colors_and_labels():
+    names, cube, _, colors1 = style_classes({}, HISTOGRAMS, {"reencoding": REENCODING})
+    assert names == ["Ay", "Bee"]
+    np.testing.assert_array_equal(colors1, [COLORS["green"], COLORS["red"]])
+    assert cube.shape == (2, 2, 3)
+
+
+def test_reencoding_not_covering_every_buffer():
+    spec = {"reencoding": {"color": {"scale": {"range": ["Red"]}}}}
+    names, _, _, colors1 = style_classes({}, HISTOGRAMS, spec)
+    assert names == ["a", "b"]
+    np.testing.assert_array_equal(colors1, CATEGORY10[:2])
+
+
+def test_style_overrides_reencoding():
+    spec = {"reencoding": REENCODING,
+            "style": {"classes": [{"name": "b", "color1": "Blue"}, {"name": "a"}]}}
+    names, cube, _, colors1 = style_classes({}, HISTOGRAMS, spec)
+    assert names == ["b", "a"]
+    np.testing.assert_array_equal(colors1, [COLORS["blue"], COLORS["green"]])
+    np.testing.assert_array_equal(cube[1], HISTOGRAMS["a"])
+
+
+def test_spec_files_expands_directories(tmp_path):
+    for name in ("a.mdm.json", "a_data.json", "a_cat_x.json"):
+        (tmp_path / name).write_text("{}")
+    assert spec_files([str(tmp_path), "b_data.json"]) == \
+        [str(tmp_path / "a.mdm.json"), "b_data.json"]
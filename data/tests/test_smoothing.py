@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+from smoothing import smooth_cube, box_axis
+
+ndimage = pytest.importorskip("scipy.ndimage")
+
+
+@pytest.mark.parametrize("sigma", [0.8, 3, 12])
+@pytest.mark.parametrize("threads", [1, 3])
+def test_gaussian_matches_scipy(sigma, threads):
+    # sigma 12 has a kernel of 97 taps, convolved by FFT
+    cube = np.random.RandomState(0).poisson(2, size=(4, 60, 70))
+    blurred = smooth_cube(cube, sigma, threads=threads)
+    for (histo, expected) in zip(cube, blurred):
+        np.testing.assert_allclose(
+            expected, ndimage.gaussian_filter(histo.astype(float), sigma, mode="nearest"),
+            atol=1e-10)
+
+
+def test_box_axis_matches_uniform_filter():
+    cube = np.random.RandomState(1).poisson(3, size=(2, 20, 30))
+    np.testing.assert_allclose(box_axis(cube, 5, -1),
+                               ndimage.uniform_filter1d(cube.astype(float), 5, axis=-1,
+                                                        mode="nearest"))
@@ -0,0 +1,45 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+from csv2json import csv_to_databuffers
+from databuffer import load_databuffers
+from stats import load_stats
+
+
+def convert(filename):
+    "Convert a csv file by chunks, returning the stages of its profile and its schema"
+    csv_to_databuffers(filename, "x", "y", "k", width=16, height=8, chunksize=300,
+                       profile=True)
+    root = filename[:-len(".csv")]
+    with open(root + "_profile.json") as inf:
+        stages = json.load(inf)["stages"]
+    return stages, load_databuffers(root + "_data.json")
+
+
+def test_sidecar_bounds_are_reused(tmp_path):
+    rng = np.random.RandomState(0)
+    df = pd.DataFrame({"x": rng.uniform(-3, 7, 1000), "y": rng.uniform(2, 4, 1000),
+                       "k": rng.choice(["a", "b"], 1000)})
+    filename = str(tmp_path / "t.csv")
+    df.to_csv(filename, index=False)
+    stages, (description, histograms) = convert(filename)
+    # the bounds are missing, so the file is scanned once before binning
+    assert stages["bounds"]["rows"] == 1000
+    stats = load_stats(filename)
+    assert stats.rows == 1000
+    assert stats.bounds("x", "y") == [df.x.min(), df.y.min(), df.x.max(), df.y.max()]
+    assert stats.categories["k"] == df.k.value_counts().to_dict()
+
+    stages, (reused, reused_histograms) = convert(filename)
+    assert "bounds" not in stages
+    assert reused["encoding"] == description["encoding"]
+    for key in histograms:
+        np.testing.assert_array_equal(reused_histograms[key], histograms[key])
+
+    # a modified file is scanned again
+    stat = os.stat(filename)
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert load_stats(filename) is None
+    stages, _ = convert(filename)
+    assert stages["bounds"]["rows"] == 1000
@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+from tiling import aggregate_tiles, rect_labels, AGGREGATIONS
+
+
+def brute_force(histos, labels, aggregation, tiles):
+    result = np.zeros((len(histos), tiles))
+    for c, histo in enumerate(histos):
+        for t in range(tiles):
+            values = histo[labels == t]
+            if aggregation == "min":
+                values = values[values != 0]
+            if len(values):
+                result[c, t] = {"max": np.max, "min": np.min, "sum": np.sum,
+                                "mean": np.mean}[aggregation](values)
+    return result
+
+
+@pytest.mark.parametrize("aggregation", AGGREGATIONS)
+def test_aggregate_tiles(aggregation):
+    rng = np.random.RandomState(0)
+    histos = rng.poisson(1, size=(3, 23, 31))
+    labels = rect_labels(31, 23, 10, 7)
+    labels[0, :5] = -1
+    tiles = int(labels.max()) + 1
+    aggregates, pixels = aggregate_tiles(histos, labels, aggregation, tiles)
+    np.testing.assert_allclose(aggregates, brute_force(histos, labels, aggregation, tiles))
+    np.testing.assert_array_equal(pixels, [(labels == t).sum() for t in range(tiles)])
@@ -0,0 +1,70 @@
+import math
+import numpy as np
+import pytest
+from weaving import weaving_mask, weave
+
+
+def viewer_square(m, size, width, height, xincr=1):
+    "The squareMasks of src/weaving.ts, as a mask of the class of each pixel"
+    if xincr < 0:
+        xincr = m + int(math.fmod(xincr, m))
+    mask = np.full((height, width), -1)
+    for i in range(math.ceil(height / size)):
+        for j in range(math.ceil(width / size)):
+            mask[i * size:(i + 1) * size, j * size:(j + 1) * size] = (i * xincr + j) % m
+    return mask
+
+
+def viewer_hex_cells(m, size, width, height):
+    "The class and center of the hexagons of hexMasks in src/weaving.ts"
+    for j in range(math.ceil(height / size)):
+        for i in range(math.ceil(width / size)):
+            col, row = i * size, j * size
+            if j % 2 == 1:
+                col += size / 2
+            yield (i + (j * 2) % 8) % m, col + size / 2, row + size / 2
+
+
+def viewer_tri_class(m, i, j):
+    "The class of the triangle i of row j in triangleMasks of src/weaving.ts"
+    selected = i % (m / 2)
+    if j % 2 == 1:
+        selected = i % (m / 2) + m / 2
+    return selected
+
+
+@pytest.mark.parametrize("m", [1, 2, 3, 5])
+@pytest.mark.parametrize("xincr", [1, 2, -1, -4])
+def test_square_masks_match_the_viewer(m, xincr):
+    weaving_mask.cache_clear()
+    mask = weaving_mask(29, 21, "square", m, 4, xincr=xincr)
+    np.testing.assert_array_equal(mask, viewer_square(m, 4, 29, 21, xincr))
+
+
+@pytest.mark.parametrize("m", [2, 3, 5])
+def test_hex_masks_match_the_viewer(m):
+    mask = weaving_mask(40, 32, "hex", m, 8)
+    for (selected, x, y) in viewer_hex_cells(m, 8, 40, 32):
+        if x < 40 and y < 32:
+            assert mask[int(y), int(x)] == selected
+
+
+@pytest.mark.parametrize("m", [2, 4, 6])
+def test_tri_masks_match_the_viewer(m):
+    size = 8
+    mask = weaving_mask(40, 32, "tri", m, size)
+    for j in range(32 // size):
+        for i in range(40 * 2 // size):
+            # a pixel on the axis of the triangle, halfway up
+            assert mask[j * size + size // 2, i * size // 2] == viewer_tri_class(m, i, j)
+
+
+def test_tri_masks_need_an_even_number_of_classes():
+    with pytest.raises(ValueError):
+        weaving_mask(40, 32, "tri", 3, 8)
+
+
+def test_weave_gathers_the_classes_of_the_mask():
+    cube = np.arange(2 * 3 * 4).reshape(2, 3, 4)
+    mask = weaving_mask(4, 3, "square", 2, 1)
+    np.testing.assert_array_equal(weave(cube, mask), np.where(mask == 0, cube[0], cube[1]))
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+"""
+Rebin data buffers into tiles: squares, rectangles, the regions of a
+topojson feature or the cells of a Voronoi diagram, as the rebin of the
+viewer does.
+
+The tiling is rasterized once into a label map of shape (height, width),
+holding the index of the tile of each bin, or -1 for the bins outside all
+the tiles. The tiles of each class are then aggregated with np.bincount (or
+a reduceat over the bins sorted by tile for max and min). The bins are in
+the order of the written buffers, the first row being the top (ymax).
+The label map is written next to the buffers, and the schema gets the rebin
+with the url of the labels and the number of bins of each tile, and each
+buffer the aggregates of its tiles, so that the viewer does not rebin.
+"""
+
+import json
+import numpy as np
+
+REBIN_TYPES = ["square", "rect", "topojson", "voronoi"]
+AGGREGATIONS = ["max", "mean", "sum", "min"]
+
+
+def rect_labels(width, height, tile_width=10, tile_height=10):
+    "Return the labels of the rectangles of tile_width x tile_height bins, in rows from the top left"
+    cols = -(-width // tile_width)
+    rows, columns = np.indices((height, width))
+    return ((rows // tile_height) * cols + columns // tile_width).astype(np.int32)
+
+
+def voronoi_sites(width, height, count=10, seed=0):
+    "Return count random sites [x, y] in the bins"
+    rng = np.random.RandomState(seed)
+    return np.column_stack([rng.randint(width, size=count),
+                            rng.randint(height, size=count)]).tolist()
+
+
+def voronoi_labels(width, height, sites):
+    "Return the labels of the cells of the sites [x, y], the nearest site of each bin center"
+    y, x = np.indices((height, width)) + 0.5
+    labels = np.zeros((height, width), dtype=np.int32)
+    best = np.full((height, width), np.inf)
+    for (i, (sx, sy)) in enumerate(sites):
+        distance = (x - sx) ** 2 + (y - sy) ** 2
+        closer = distance < best
+        labels[closer] = i
+        best[closer] = distance[closer]
+    return labels
+
+
+def topojson_arcs(topology):
+    "Return the arcs of a topology as arrays of absolute coordinates"
+    transform = topology.get("transform")
+    arcs = []
+    for arc in topology["arcs"]:
+        arc = np.array(arc, dtype=np.float64)[:, :2]
+        if transform:
+            arc = np.cumsum(arc, axis=0) * transform["scale"] + transform["translate"]
+        arcs.append(arc)
+    return arcs
+
+
+def _ring(arcs, indices):
+    "Return the points of a ring made of arcs, a negative index ~i being arc i reversed"
+    points = [arcs[i] if i >= 0 else arcs[~i][::-1] for i in indices]
+    return np.concatenate(points)
+
+
+def geometry_rings(arcs, geometry):
+    "Return the rings of the polygons of a topojson geometry"
+    if geometry["type"] == "Polygon":
+        return [_ring(arcs, ring) for ring in geometry["arcs"]]
+    if geometry["type"] == "MultiPolygon":
+        return [_ring(arcs, ring) for polygon in geometry["arcs"] for ring in polygon]
+    if geometry["type"] == "GeometryCollection":
+        return [ring for child in geometry["geometries"] for ring in geometry_rings(arcs, child)]
+    return []
+
+
+def fill_rings(rings, width, height):
+    """
+    Return the boolean raster of the bins whose center is inside rings of
+    points in bin coordinates, with the even-odd rule so that the holes and
+    separate polygons need no special case
+    """
+    toggles = np.zeros((height, width + 1), dtype=np.int32)
+    for ring in rings:
+        x0, y0 = ring[:-1, 0], ring[:-1, 1]
+        x1, y1 = ring[1:, 0], ring[1:, 1]
+        low, high = np.minimum(y0, y1), np.maximum(y0, y1)
+        first = np.maximum(np.ceil(low - 0.5), 0).astype(np.int64)
+        last = np.minimum(np.ceil(high - 0.5), height).astype(np.int64)
+        spans = np.maximum(last - first, 0)
+        if spans.sum() == 0:
+            continue
+        # one crossing per edge and bin row whose center is in [low, high)
+        edge = np.repeat(np.arange(len(spans)), spans)
+        row = first[edge] + np.arange(spans.sum()) - np.repeat(np.cumsum(spans) - spans, spans)
+        yc = row + 0.5
+        xc = x0[edge] + (yc - y0[edge]) * (x1[edge] - x0[edge]) / (y1[edge] - y0[edge])
+        col = np.clip(np.ceil(xc - 0.5), 0, width).astype(np.int64)
+        np.add.at(toggles, (row, col), 1)
+    return (np.cumsum(toggles, axis=1)[:, :width] % 2).astype(bool)
+
+
+def feature_geometries(topology, feature):
+    "Return the geometries of a feature of a topology"
+    if feature not in topology["objects"]:
+        raise ValueError("No feature {} in the topojson, only {}".format(
+            feature, list(topology["objects"])))
+    obj = topology["objects"][feature]
+    return obj["geometries"] if obj["type"] == "GeometryCollection" else [obj]
+
+
+def topojson_labels(width, height, topology, feature, bounds, projection=None):
+    """
+    Return the labels of the geometries of a topojson feature over the bins
+    of bounds [xmin, ymin, xmax, ymax], the coordinates of the topology
+    being longitudes and latitudes projected with projection, if any.
+    A bin of overlapping geometries goes to the last one.
+    """
+    geometries = feature_geometries(topology, feature)
+    arcs = topojson_arcs(topology)
+    if projection:
+        from projection import project, LONLAT
+        arcs = [np.column_stack(project(arc[:, 0], arc[:, 1], LONLAT, projection))
+                for arc in arcs]
+    xmin, ymin, xmax, ymax = bounds
+    # bin coordinates, the first row being the top
+    scale = np.array([width / (xmax - xmin), -height / (ymax - ymin)])
+    origin = np.array([xmin, ymax])
+    arcs = [(arc - origin) * scale for arc in arcs]
+    labels = np.full((height, width), -1, dtype=np.int32)
+    for (i, geometry) in enumerate(geometries):
+        labels[fill_rings(geometry_rings(arcs, geometry), width, height)] = i
+    return labels
+
+
+def tile_labels(rebin, width, height, bounds=None, projection=None):
+    """
+    Return the label map of a rebin spec over bins (width, height), its
+    number of tiles, and the rebin spec completed with the sites of a random
+    Voronoi diagram or the ids of the topojson geometries
+    """
+    kind = rebin["type"]
+    if kind in ("square", "rect"):
+        tile_width = (rebin.get("size") if kind == "square" else rebin.get("width")) or 10
+        tile_height = (rebin.get("size") if kind == "square" else rebin.get("height")) or 10
+        tiles = -(-width // tile_width) * -(-height // tile_height)
+        return rect_labels(width, height, tile_width, tile_height), tiles, rebin
+    if kind == "voronoi":
+        if not rebin.get("points"):
+            rebin = dict(rebin, points=voronoi_sites(width, height, rebin.get("size") or 10))
+        return voronoi_labels(width, height, rebin["points"]), len(rebin["points"]), rebin
+    if kind == "topojson":
+        with open(rebin["url"]) as inf:
+            topology = json.load(inf)
+        labels = topojson_labels(width, height, topology, rebin["feature"], bounds, projection)
+        ids = [geometry.get("id") for geometry in feature_geometries(topology, rebin["feature"])]
+        return labels, len(ids), dict(rebin, ids=ids)
+    raise ValueError("Unknown rebin type: {}".format(kind))
+
+
+def aggregate_tiles(histos, labels, aggregation="max", tiles=None):
+    """
+    Return the aggregates of the bins of each tile of the label map in
+    histos, of shape (classes, height, width), as an array (classes, tiles),
+    and the number of bins of each tile; without tiles, the number of tiles
+    is the largest label plus one. As in the viewer, the min of a tile is the min of
+    its non-empty bins.
+    """
+    if aggregation not in AGGREGATIONS:
+        raise ValueError("Unknown aggregation: {}".format(aggregation))
+    histos = np.asarray(histos)
+    if tiles is None:
+        tiles = int(labels.max()) + 1 if labels.size else 0
+    inside = labels.ravel() >= 0
+    index = labels.ravel()[inside]
+    values = histos.reshape(len(histos), -1)[:, inside]
+    pixels = np.bincount(index, minlength=tiles)
+    if aggregation in ("sum", "mean"):
+        sums = np.array([np.bincount(index, weights=v, minlength=tiles) for v in values])
+        if aggregation == "mean":
+            return np.divide(sums, pixels, out=np.zeros_like(sums), where=pixels > 0), pixels
+        return sums.astype(histos.dtype), pixels
+    order = np.argsort(index, kind="stable")
+    starts = np.searchsorted(index[order], np.arange(tiles))
+    present = pixels > 0
+    result = np.zeros((len(histos), tiles), dtype=np.float64 if aggregation == "min" else histos.dtype)
+    if present.any():
+        values = values[:, order]
+        if aggregation == "max":
+            result[:, present] = np.maximum.reduceat(values, starts[present], axis=1)
+        else:
+            nonzero = np.where(values != 0, values, np.inf)
+            result[:, present] = np.minimum.reduceat(nonzero, starts[present], axis=1)
+            result[np.isinf(result)] = 0
+            result = result.astype(histos.dtype)
+    return result, pixels
+
+
+def write_rebin(root, rebin, histos, bounds, projection=None, buffer_format="json"):
+    """
+    Write the label map of a rebin spec over histos, of shape (classes,
+    height, width) with the first row at the top, and return the rebin of
+    the schema and the aggregates of the tiles of each class
+    """
+    height, width = histos.shape[1:]
+    labels, tiles, rebin = tile_labels(rebin, width, height, bounds, projection)
+    aggregation = rebin.get("aggregation") or "max"
+    aggregates, pixels = aggregate_tiles(histos, labels, aggregation, tiles)
+    if buffer_format == "json":
+        url = root + "_rebin.json"
+        with open(url, "w") as outf:
+            json.dump(labels.tolist(), outf)
+    else:
+        url = root + "_rebin.npy"
+        np.save(url, labels)
+    rebin = dict(rebin, aggregation=aggregation, labels=url, tiles=tiles,
+                 pixels=pixels.tolist())
+    return rebin, aggregates
+
+
+def read_labels(filename):
+    "Return the label map written by write_rebin"
+    if filename.endswith(".npy"):
+        return np.load(filename)
+    with open(filename) as inf:
+        return np.array(json.load(inf), dtype=np.int32)
+
+
+def add_rebin_arguments(parser):
+    "Add the options of the rebinning to an argument parser"
+    parser.add_argument("--rebin", default=None, nargs="?", choices=REBIN_TYPES,
+                        help="also aggregate the buffers into tiles of this type")
+    parser.add_argument("--rebin-size", dest="rebin_size", type=int, default=None, nargs="?",
+                        help="size of the square tiles, or number of random Voronoi sites (10 by default)")
+    parser.add_argument("--rebin-width", dest="rebin_width", type=int, default=None, nargs="?",
+                        help="width of the rect tiles (10 by default)")
+    parser.add_argument("--rebin-height", dest="rebin_height", type=int, default=None, nargs="?",
+                        help="height of the rect tiles (10 by default)")
+    parser.add_argument("--rebin-topojson", dest="rebin_topojson", default=None, nargs="?",
+                        help="topojson file of the regions of the topojson tiles, in longitudes and latitudes")
+    parser.add_argument("--rebin-feature", dest="rebin_feature", default=None, nargs="?",
+                        help="object of the topojson file whose geometries are the tiles, e.g., states")
+    parser.add_argument("--rebin-aggregation", dest="rebin_aggregation", default="max",
+                        nargs="?", choices=AGGREGATIONS,
+                        help="aggregation of the bins of a tile")
+
+
+def rebin_from_arguments(args):
+    "Return the rebin spec of the parsed options, or None"
+    if args.rebin is None:
+        return None
+    if args.rebin == "topojson" and not (args.rebin_topojson and args.rebin_feature):
+        raise ValueError("A topojson rebin requires --rebin-topojson and --rebin-feature")
+    rebin = {"type": args.rebin,
+             "size": args.rebin_size,
+             "width": args.rebin_width,
+             "height": args.rebin_height,
+             "url": args.rebin_topojson,
+             "feature": args.rebin_feature,
+             "aggregation": args.rebin_aggregation}
+    return {key: value for (key, value) in rebin.items() if value is not None}
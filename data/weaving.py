@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+"""
+Weaving masks: the class shown at each pixel by the weaving assembly.
+
+A mask is a uint8 raster of shape (height, width) holding a class index per
+pixel, instead of one binary mask per class. The pixels are grouped in cells
+of size pixels, squares, hexagons (on rows shifted by half a cell) or
+triangles, and each cell goes to a class in turn, with the formulas of the
+viewer (src/weaving.ts), or to a random class.
+The masks are computed once for each size and pattern, and weaving a cube of
+shape (classes, height, width) is a single gather of the values at the mask.
+"""
+
+from functools import lru_cache
+import numpy as np
+
+PATTERNS = ["square", "hex", "tri", "random"]
+MASK_CACHE_SIZE = 64
+
+
+def _square_cells(width, height, size):
+    "Return the row and column of the square cell of each pixel"
+    rows, cols = np.indices((height, width))
+    return rows // size, cols // size
+
+
+def _hex_cells(width, height, size):
+    """
+    Return the row and column of the hexagonal cell of each pixel: the
+    nearest center of cells of size pixels, whose odd rows are shifted by
+    half a cell
+    """
+    y, x = np.indices((height, width)) + 0.5
+    best_row = best_col = best = None
+    base = np.floor(y / size).astype(np.int64)
+    for shift in (-1, 0, 1):
+        row = base + shift
+        offset = (row % 2) * (size / 2)
+        col = np.floor((x - offset) / size).astype(np.int64)
+        distance = (x - (col + 0.5) * size - offset) ** 2 + (y - (row + 0.5) * size) ** 2
+        if best is None:
+            best_row, best_col, best = row, col, distance
+        else:
+            closer = distance < best
+            best_row = np.where(closer, row, best_row)
+            best_col = np.where(closer, col, best_col)
+            best = np.where(closer, distance, best)
+    return best_row, best_col
+
+
+def _tri_cells(width, height, size):
+    """
+    Return the row and index in their row of the triangular cells of each
+    pixel: rows of size pixels of triangles of base size, alternately
+    pointing up and down
+    """
+    y, x = np.indices((height, width)) + 0.5
+    row = np.floor(y / size).astype(np.int64)
+    fy = y / size - row
+    half = x / (size / 2)
+    col = np.floor(half).astype(np.int64)
+    fx = half - col
+    left = np.where((col + row) % 2 == 0, fx + fy < 1, fx < fy)
+    return row, np.where(left, col, col + 1)
+
+
+def _classes(rows, cols, classes, pattern, seed, xincr=1):
+    """
+    Return the class of the cells (rows, cols), in turn as in the viewer or
+    at random; the square cells of a row start xincr classes after those of
+    the previous row (a negative xincr counting backwards)
+    """
+    if pattern == "random":
+        rows, cols = rows - rows.min(), cols - cols.min()
+        cells = np.random.RandomState(seed).randint(
+            classes, size=(rows.max() + 1, cols.max() + 1))
+        return cells[rows, cols]
+    if pattern == "hex":
+        return (cols + (2 * rows) % 8) % classes
+    if pattern == "tri":
+        # the first half of the classes on even rows, the second on odd rows
+        half = classes // 2
+        return cols % half + (rows % 2) * half
+    return (rows * (xincr % classes) + cols) % classes
+
+
+@lru_cache(maxsize=MASK_CACHE_SIZE)
+def weaving_mask(width, height, pattern, classes, size=8, seed=0, xincr=1):
+    """
+    Return the read-only uint8 mask of shape (height, width) of the class of
+    each pixel of a weaving pattern with cells of size pixels; the random
+    pattern draws the classes of square cells with seed, and the rows of
+    the square pattern are shifted by xincr classes
+    """
+    if pattern not in PATTERNS:
+        raise ValueError("Unknown weaving pattern: {}".format(pattern))
+    if not 0 < classes <= 256:
+        raise ValueError("Cannot weave {} classes in a uint8 mask".format(classes))
+    if pattern == "tri" and classes % 2:
+        # the viewer cannot either
+        raise ValueError("Cannot weave {} classes in triangles, only an even number".format(
+            classes))
+    size = max(int(size), 1)
+    cells = {"hex": _hex_cells, "tri": _tri_cells}.get(pattern, _square_cells)
+    rows, cols = cells(width, height, size)
+    mask = _classes(rows, cols, classes, pattern, seed, xincr).astype(np.uint8)
+    mask.setflags(write=False)
+    return mask
+
+
+def weave(cube, mask):
+    "Return the values of a (classes, height, width) cube at the classes of a mask"
+    rows, cols = np.indices(mask.shape, sparse=True)
+    return cube[mask, rows, cols]
+
+
+if __name__ == "__main__":
+    import argparse
+    from PIL import Image
+
+    parser = argparse.ArgumentParser(description="Save a weaving mask as a .npy array or a PNG image")
+    parser.add_argument("output", help=".npy or .png file of the mask")
+    parser.add_argument("--width", type=int, default=512, nargs="?",
+                        help="width of the mask")
+    parser.add_argument("--height", type=int, default=512, nargs="?",
+                        help="height of the mask")
+    parser.add_argument("--pattern", default="square", nargs="?", choices=PATTERNS,
+                        help="shape of the cells")
+    parser.add_argument("--classes", type=int, default=2, nargs="?",
+                        help="number of classes")
+    parser.add_argument("--size", type=int, default=8, nargs="?",
+                        help="size of the cells in pixels")
+    parser.add_argument("--seed", type=int, default=0, nargs="?",
+                        help="seed of the random pattern")
+    parser.add_argument("--xincr", type=int, default=1, nargs="?",
+                        help="shift in classes of each row of the square pattern")
+    args = parser.parse_args()
+    mask = weaving_mask(args.width, args.height, args.pattern, args.classes,
+                        args.size, args.seed, args.xincr)
+    if args.output.endswith(".npy"):
+        np.save(args.output, mask)
+    else:
+        Image.fromarray(mask, "L").save(args.output, format="PNG")
@@ -104,6 +104,10 @@ export interface EncodingSpec {
 export interface DataBufferSpec {
     value: string; // the class
     url?: string;
+    index?: number; // the class index in a multiclass binary or npy buffer
+    offset?: number; // the byte offset of the class in a multiclass binary or npy buffer
+    dtype?: string; // and its dtype
+    sparse?: string; // "csr" when the buffer only has its non-empty bins
     binnedPixels?: number[][];
     count?: number;
     range?: NumPair;
@@ -113,6 +117,100 @@ interface ProjectionSpec {
     type: string;
 }
 
+interface BinaryBufferHeader {
+    dtype: string;
+    shape: number[];
+    values: string[];
+    sparse?: string;
+    nnz?: number;
+    indexDtype?: string;
+}
+
+interface SparseBufferSpec {
+    shape: NumPair; // [height, width]
+    indptr: ArrayLike<number>;
+    indices: ArrayLike<number>;
+    counts: ArrayLike<number>;
+}
+
+const binaryArrayTypes: { [dtype: string]: any } = {
+    "|u1": Uint8Array, "|i1": Int8Array,
+    "<u2": Uint16Array, "<i2": Int16Array,
+    "<u4": Uint32Array, "<i4": Int32Array,
+    "<f4": Float32Array, "<f8": Float64Array
+};
+
+/**
+ * Make the binned pixels of a sparse buffer dense: the columns and counts of
+ * the non-empty bins of row i are at indptr[i] to indptr[i+1] (CSR layout).
+ */
+export function denseFromSparse(sparse: SparseBufferSpec): number[][] {
+    let [height, width] = sparse.shape;
+    let rows = util.create2D(width, height, 0);
+
+    for (let i = 0; i < height; i++)
+        for (let k = sparse.indptr[i]; k < sparse.indptr[i + 1]; k++)
+            rows[i][sparse.indices[k]] = sparse.counts[k];
+    return rows;
+}
+
+function binaryArray(data: ArrayBuffer, dtype: string, offset: number, length: number) {
+    let arrayType = binaryArrayTypes[dtype];
+    if (!arrayType)
+        throw new Error(`unsupported dtype ${dtype}`);
+    return new arrayType(data, offset, length);
+}
+
+/**
+ * Read the binned pixels of one class in a binary data buffer file, as written
+ * by data/databuffer.py: "MDMB", the header length (uint32), a json header and
+ * little-endian counts of shape [classes, height, width].
+ * The rows are typed-array views over the file content, not copies, except
+ * for sparse buffers, whose indptr, indices and counts arrays (each padded to
+ * 8 bytes) are made dense.
+ */
+export function readBinaryBuffer(data: ArrayBuffer, index = 0): number[][] {
+    let bytes = new Uint8Array(data);
+    if (String.fromCharCode(...Array.from(bytes.subarray(0, 4))) != "MDMB")
+        throw new Error("not a binary data buffer");
+    let length = new DataView(data).getUint32(4, true);
+    let header = <BinaryBufferHeader>JSON.parse(decodeURIComponent(escape(
+        String.fromCharCode(...Array.from(bytes.subarray(8, 8 + length))))));
+    let [height, width] = header.shape.slice(-2);
+    if (header.sparse) {
+        let offset = 8 + length;
+        let arrays: ArrayLike<number>[] = [];
+        for (let [dtype, size] of <[string, number][]>[["<u4", height + 1],
+                [header.indexDtype!, header.nnz!], [header.dtype, header.nnz!]]) {
+            let array = binaryArray(data, dtype, offset, size);
+            arrays.push(array);
+            offset += size * array.BYTES_PER_ELEMENT;
+            offset += (8 - offset % 8) % 8;
+        }
+        return denseFromSparse({
+            shape: [height, width], indptr: arrays[0], indices: arrays[1], counts: arrays[2]
+        });
+    }
+    let arrayType = binaryArrayTypes[header.dtype];
+    if (!arrayType)
+        throw new Error(`unsupported dtype ${header.dtype}`);
+    let offset = 8 + length + index * height * width * arrayType.BYTES_PER_ELEMENT;
+    return readBufferRows(data, header.dtype, offset, height, width);
+}
+
+/**
+ * Return the rows of the binned pixels stored from offset in data, as
+ * typed-array views.
+ */
+export function readBufferRows(data: ArrayBuffer, dtype: string, offset: number,
+    height: number, width: number): number[][] {
+    let rows = new Array<number[]>(height);
+
+    for (let i = 0; i < height; i++)
+        rows[i] = binaryArray(data, dtype, offset + i * width * binaryArrayTypes[dtype].BYTES_PER_ELEMENT, width);
+    return rows;
+}
+
 export class GeoSpec {
     constructor(public projection: string = "mercator",
         public latitudes?: NumPair,
@@ -160,20 +258,33 @@ export class SchemaSpec {
      */
     load(base: string, useCache = true) {
         let requests: Promise<DataBufferSpec>[] = [];
+        let files: { [url: string]: Promise<any> } = {}; // multiclass buffers share their file
 
         this.dataBuffers.forEach(buffer => {
             if (!buffer.binnedPixels) {
                 let url = base + buffer.url!;
                 let responseType = undefined;
 
-                if (url.toLowerCase().endsWith(".png")) {
+                if (url.toLowerCase().endsWith(".png") ||
+                    url.toLowerCase().endsWith(".dbuf") ||
+                    url.toLowerCase().endsWith(".npy")) {
                     responseType = "arraybuffer";
                 }
 
-                let promise = util.get(url, useCache, responseType)
+                if (!(url in files))
+                    files[url] = util.get(url, useCache, responseType);
+
+                let promise = files[url]
                     .then((data) => {
-                        if (url.toLowerCase().endsWith(".json"))
-                            buffer.binnedPixels = JSON.parse(data);
+                        if (url.toLowerCase().endsWith(".json")) {
+                            let parsed = JSON.parse(data);
+                            buffer.binnedPixels = Array.isArray(parsed) ? parsed : denseFromSparse(parsed);
+                        }
+                        else if (buffer.offset !== undefined && buffer.dtype)
+                            buffer.binnedPixels = readBufferRows(data, buffer.dtype, buffer.offset,
+                                this.encoding.y.bin.maxbins, this.encoding.x.bin.maxbins);
+                        else if (url.toLowerCase().endsWith(".dbuf"))
+                            buffer.binnedPixels = readBinaryBuffer(data, buffer.index);
                         else {
                             let pngBuffer = new Buffer(data);
                             let png = PNG.sync.read(pngBuffer, { skipRescale: true });